@@ -27,8 +27,13 @@ Command Line
 The command line interface (in sweepcoins.py) can be used to
 - generate watch files that hold the data needed to sweep an address
 - add to existing watch files
-- list the contents of a watch file
-- run a sweep operation on the set of watch addresses in a watch file
+- import many watches at once from a CSV or JSONL file
+- list the contents of a watch file, filtered and paged, as a table,
+  JSON or CSV
+- run a sweep operation on the set of watch addresses in a watch file,
+  or in several watch files at once
+- keep a ledger of every run's outcomes and report on it (what each
+  destination received, which addresses fail most)
 
 Other
 =====
@@ -47,9 +52,20 @@ be usable in non-console programs.
 
 You can, of course, send the balance back to the sending address.
 
+By default sweeps are sent through the blockchain.info wallet API, which
+means handing it the private key. With --sign-locally the transaction
+is built and signed here instead (see sweeptx) and only the signed
+transaction is broadcast.
+
 :author:     Ron Helwig
 :contact:    ron@ronhelwig.com
 
 """
 
-__all__ = ["sweepcoins", "cryptconfig", "sweepaddress", "sweepblockchain"]
+__all__ = ["sweepcoins", "cryptconfig", "sweepaddress", "sweepblockchain",
+           "sweepshard", "sweepmonitor", "sweepstate",
+           "sweepsim", "sweepnet", "sweepproviders", "sweepkeys",
+           "sweepsign", "sweeptx", "sweepimport", "sweeplist",
+           "sweepmulti", "sweepfees", "sweeptrack", "sweepreload",
+           "sweepledger", "sweeptrace", "sweepschedule",
+           "sweepsnapshot", "sweepindex"]
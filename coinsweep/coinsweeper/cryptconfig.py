@@ -135,6 +135,41 @@ class CryptConfig(object):
                 s = cipher.decrypt(es)
         return s
 
+    def read_encrypted_changes(self, file_, old_es="", old_s=""):
+        """
+        Reads ``file_`` like read_encrypted_file, but only decrypts what
+        changed since it was ``old_es`` (encrypted), ``old_s`` (decrypted).
+        In CBC mode a block decrypts from itself and the block before it,
+        so everything before the first changed block is the same as
+        before and only the rest needs decrypting. An appended watch, or
+        an edit near the end, is a small decrypt of a large file.
+
+        The return is a tuple: (es, s)
+
+        """
+        if not os.path.exists(file_):
+            return ("", "")
+        with open(file_, 'rb') as ef:
+            es = ef.read()
+        size = AES.block_size
+        # the number of leading blocks that are the same, found by
+        # halving (comparing slices is done in C)
+        low, high = 0, min(len(es), len(old_es), len(old_s)) // size
+        while low < high:
+            middle = (low + high + 1) // 2
+            if es[:middle * size] == old_es[:middle * size]:
+                low = middle
+            else:
+                high = middle - 1
+        same = low * size
+        iv = es[same - size:same] if same else self.iv
+        key = _derive_key(self.passphrase,
+                          self.iv,
+                          AES.key_size,
+                          AES.block_size)
+        cipher = AES.new(key, AES.MODE_CBC, iv)
+        return (es, old_s[:same] + cipher.decrypt(es[same:]))
+
     def write_encrypted_file(self, file_, s):
         """
         Encrypt string ``s`` and write it to ``file_``
@@ -5,9 +5,37 @@ Created on Jan 7, 2014
 :contact:    ron@ronhelwig.com
 """
 
+import calendar
 from datetime import datetime, timedelta
 
-__all__ = ["SweepAddressInfo", "TimeThreshold"]
+from sweepschedule import compile_schedule
+
+__all__ = ["SweepAddressInfo", "TimeThreshold", "parse_send_amount"]
+
+
+def parse_send_amount(amount):
+    """
+    Interpret a destination's send_amount string (see SweepAddressInfo).
+
+    The return is a tuple: (kind, value), where kind is one of
+    - "percent": value is a float percentage of the balance after fees
+    - "dollars": value is a float number of dollars
+    - "satoshis": value is a long (bitcoin amounts are converted)
+    - "balance": value is 0, the destination gets what's left over
+    Raises ValueError if the string can't be interpreted.
+
+    """
+    amount = amount.strip()
+    if "%" in amount:
+        return ("percent", float(amount[:-1]))
+    elif "$" == amount[0]:
+        return ("dollars", float(amount[1:]))
+    elif "." in amount:
+        return ("satoshis", long(round(float(amount) * 1e8)))
+    elif long(amount) <= 0:
+        return ("balance", 0)
+    else:
+        return ("satoshis", long(amount))
 
 
 class TimeThreshold(object):
@@ -22,10 +50,16 @@ class TimeThreshold(object):
     - specified intervals
     - don't wait at all
 
+    self.schedule is an optional calendar schedule (a cron expression,
+    see sweepschedule) that takes the place of the duration: a send is
+    allowed once it has fired since the last one. Thresholds saved
+    before it existed don't have it.
+
     """
 
     def __init__(self):
         self.duration = "P1D"  # default to one day
+        self.schedule = None
 
     def query_info(self):
         """
@@ -51,6 +85,15 @@ class TimeThreshold(object):
                                                        weeks,
                                                        days,
                                                        hours)
+        schedule = raw_input("Or a cron schedule, like 0 0 1 * * "
+                             "(blank for none)?")
+        while schedule.strip():
+            try:
+                compile_schedule(schedule)
+                self.schedule = schedule.strip()
+                break
+            except ValueError as e:
+                schedule = raw_input("{0}, try again?".format(e))
         return
 
     def write_info(self, indent="", verbose=False):
@@ -59,12 +102,14 @@ class TimeThreshold(object):
 
         """
         print indent + "ISO 8601 duration: {0}".format(self.duration)
+        if getattr(self, 'schedule', None):
+            print indent + "Schedule (UTC): {0}".format(self.schedule)
         return
 
-    def waited_enough(self, waited, verbose):
+    def wait_time(self):
         """
-        Check to see if the duration passed in as 'waited'
-        is longer than the threshold in self.duration.
+        Return the threshold in self.duration as a timedelta,
+        or None if there isn't a usable duration.
 
         This is a very naive implementation, assuming months
         are 30 days long and years are 365 days. We could
@@ -76,57 +121,109 @@ class TimeThreshold(object):
 
         """
         wait = timedelta()
-        if verbose:
-            print "Duration of {0}".format(self.duration)
-            print "Comparing to {0}".format(waited)
 
         # Yeah, we could use RE for this but RE *always*
         # makes code harder to read and understand plus it
         # gives you less vectors for handling errors
         temp = self.duration
-        if temp.startswith("P"):
-            temp = temp[1:]
-
-            f, s, a = temp.partition("Y")
-            if s == "Y":
-                val = int(f)
-                wait = wait + timedelta(days=val * 365)
-                temp = a
-            else:
-                temp = f
+        if not temp.startswith("P"):
+            return None
+        temp = temp[1:]
+
+        f, s, a = temp.partition("Y")
+        if s == "Y":
+            val = int(f)
+            wait = wait + timedelta(days=val * 365)
+            temp = a
+        else:
+            temp = f
 
-            f, s, a = temp.partition("M")
-            if s == "M":
-                val = int(f)
-                wait = wait + timedelta(days=val * 30)
-                temp = a
-            else:
-                temp = f
+        f, s, a = temp.partition("M")
+        if s == "M":
+            val = int(f)
+            wait = wait + timedelta(days=val * 30)
+            temp = a
+        else:
+            temp = f
 
-            f, s, a = temp.partition("W")
-            if s == "W":
-                val = int(f)
-                wait = wait + timedelta(days=val * 7)
-                temp = a
-            else:
-                temp = f
+        f, s, a = temp.partition("W")
+        if s == "W":
+            val = int(f)
+            wait = wait + timedelta(days=val * 7)
+            temp = a
+        else:
+            temp = f
 
-            f, s, a = temp.partition("D")
-            if s == "D":
-                val = int(f)
-                wait = wait + timedelta(days=val)
-                temp = a
-            else:
-                temp = f
+        f, s, a = temp.partition("D")
+        if s == "D":
+            val = int(f)
+            wait = wait + timedelta(days=val)
+            temp = a
+        else:
+            temp = f
 
-            f, s, a = temp.partition("H")
-            if s == "H":
-                val = int(f)
-                wait = wait + timedelta(hours=val)
-                temp = a
-            else:
-                temp = f
+        f, s, a = temp.partition("H")
+        if s == "H":
+            val = int(f)
+            wait = wait + timedelta(hours=val)
+            temp = a
         else:
+            temp = f
+        return wait
+
+    def next_allowed(self, last_send):
+        """
+        When (seconds since the epoch) the next send is allowed after
+        one at ``last_send`` (seconds since the epoch), or None if never.
+
+        With a schedule it is the next time the schedule fires,
+        otherwise it is the duration later, counted on the calendar
+        (unlike wait_time(), a month is a month). A duration that isn't
+        strictly ISO 8601 is read by wait_time(), as it always was.
+
+        >>> t = TimeThreshold()
+        >>> t.duration = "P0Y1M0W0D0H"
+        >>> jan31 = calendar.timegm((2023, 1, 31, 0, 0, 0))
+        >>> datetime.utcfromtimestamp(t.next_allowed(jan31))
+        datetime.datetime(2023, 2, 28, 0, 0)
+        >>> t.schedule = "0 0 * * fri"
+        >>> datetime.utcfromtimestamp(t.next_allowed(jan31))
+        datetime.datetime(2023, 2, 3, 0, 0)
+        >>> t.schedule = None
+        >>> t.duration = "P12D3"
+        >>> datetime.utcfromtimestamp(t.next_allowed(jan31))
+        datetime.datetime(2023, 2, 12, 0, 0)
+
+        """
+        schedule = getattr(self, 'schedule', None)
+        try:
+            return compile_schedule(schedule or self.duration).next_fire(
+                                                                    last_send)
+        except ValueError:
+            if schedule:
+                return None
+        try:
+            wait = self.wait_time()
+        except ValueError:
+            return None
+        if wait is None:
+            return None
+        return last_send + wait.total_seconds()
+
+    def waited_enough(self, waited, verbose):
+        """
+        Check to see if the duration passed in as 'waited'
+        is longer than the threshold in self.duration.
+
+        See wait_time() for how the duration is interpreted.
+
+        """
+        if verbose:
+            print "Duration of {0}".format(self.duration)
+            print "Comparing to {0}".format(waited)
+
+        wait = self.wait_time()
+        if wait is None:
             if verbose:
                 print "TimeThreshold has no duration."
             return False
@@ -150,6 +247,10 @@ class SweepAddressInfo(object):
     - $N.M: a float number of dollars
     - zero: balance of amount being sent
 
+    self.confirmation_target is the number of blocks its sweeps should
+    be confirmed within, or None for the run's target (see sweepfees).
+    Watches saved before it existed don't have it.
+
     """
 
     def __init__(self):
@@ -164,6 +265,7 @@ class SweepAddressInfo(object):
         self.time_threshold = TimeThreshold()
         self.balance_threshold = 0
         self.destinations = {}
+        self.confirmation_target = None
 
     def query_info(self):
         """
@@ -177,6 +279,10 @@ class SweepAddressInfo(object):
         self.balance_threshold = long(round(float(btc) * 1e8))
         # conversion back to btc from satoshi is "float(amount / 1e8)"
         self.time_threshold.query_info()
+        target = raw_input("Blocks to be confirmed within "
+                           "(blank for the default)?")
+        if target.strip():
+            self.confirmation_target = abs(int(target))
 
     def write_info(self, indent="", verbose=False):
         """
@@ -193,6 +299,9 @@ class SweepAddressInfo(object):
                         .format(self.balance_threshold)
         print indent + "Balance Threshold (in bitcoins): {0}"\
                         .format(float(self.balance_threshold / 1e8))
+        if getattr(self, 'confirmation_target', None):
+            print indent + "Confirmation target (in blocks): {0}"\
+                            .format(self.confirmation_target)
         for send_address, send_amount in self.destinations.iteritems():
             amount = send_amount.strip()
             if "%" in amount[-1]:
@@ -210,3 +319,8 @@ class SweepAddressInfo(object):
             else:
                 print indent + "# {0} gets {1} satoshis".format(send_address,
                                                         amount)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -6,14 +6,44 @@ Created on Jan 7, 2014
 """
 
 import json
+import time
 import urllib
-import urllib2
+import binascii
+import calendar
+from itertools import imap
+from multiprocessing.pool import ThreadPool
 from datetime import datetime, timedelta
 
 #from sweepaddress import SweepAddressInfo, TimeThreshold
+from sweepaddress import parse_send_amount
+from sweepcheckpoint import reconcile
+from sweepfees import fee_engine
+import sweepnet
+import sweeptrace
 
 
-__init__ = ["AddressDataBC", "TxnServiceBlockChain"]
+__init__ = ["AddressDataBC", "AddressSnapshot", "TxnServiceBlockChain",
+            "set_confirmations"]
+
+# confirmations a transaction needs before its outputs count
+DEFAULT_CONFIRMATIONS = 6
+# transactions per page of /rawaddr, and seconds a block height is reused
+RAWADDR_PAGE = 50
+BLOCK_HEIGHT_TTL = 30
+# seconds an exchange rate is reused (the ticker's rate is a 15m average)
+EXCHANGE_RATE_TTL = 60
+# the result of an address left for the next run
+DEFERRED = "Deferred: the run's deadline or call budget is used up"
+
+_block_height = {'height': None, 'time': 0}
+# currency => (rate, when it was fetched)
+_exchange_rates = {}
+
+
+def set_confirmations(count):
+    """Set the confirmations needed before coins can be swept."""
+    global DEFAULT_CONFIRMATIONS
+    DEFAULT_CONFIRMATIONS = count
 
 
 def _read_url(url, post_data=None, verbose=False):
@@ -24,29 +54,135 @@ def _read_url(url, post_data=None, verbose=False):
     errors is a dictionary.
 
     """
-    contents = ""
-    errors = {}
-    request = None
     headers = {'User-Agent':\
 'Mozilla/5.0 (Windows NT 6.2; Win64; x64) AppleWebKit/537.36"\
 " (KHTML, like Gecko) Chrome/32.0.1667.0 Safari/537.36'}
-    try:
-        data = None
-        if post_data:
-            data = urllib.urlencode(post_data)
-        if verbose:
-            print "Fetching URL={0}".format(url)
-            if data:
-                print "With post data ={0}".format(data)
-        request = urllib2.Request(url, data, headers)
-        response = urllib2.urlopen(request)
-        contents = response.read()
-        response.close()
-    except urllib2.HTTPError as he:
-        errors[url] = "HTTP error ({0}): {1}".format(he.code, he.reason)
-    except urllib2.URLError as e:
-        errors[url] = e.reason
-    return (contents, errors)
+    data = None
+    if post_data:
+        data = urllib.urlencode(post_data)
+    if verbose:
+        print "Fetching URL={0}".format(url)
+        if data:
+            print "With post data ={0}".format(data)
+    # timeouts, the run deadline and hedging are all taken care of there
+    return sweepnet.fetch(url, data, headers)
+
+
+def estimate_fee(input_count, output_count):
+    """
+    Return the fee (in satoshis) for a sweep spending ``input_count``
+    unspent outputs to ``output_count`` destinations.
+
+    Tx size roughly 148 * number_of_inputs + 34 * number_of_outputs + 10
+    This only uses integer arithmetic, so it works just the same on
+    NumPy arrays of counts.
+
+    """
+    input_size = 180  # newer ones could be only 148
+    output_size = 34
+    header_size = 10
+    tx_size = input_size * input_count\
+              + output_size * output_count\
+              + header_size\
+              + input_count  # margin of error
+    minimum_fee = 10000
+    # a fee for every started kB
+    return minimum_fee * (tx_size // 1000 + 1)
+
+
+def _window_opens(sweep_address, last_send):
+    """
+    Return when (in seconds since the epoch) the time threshold of
+    ``sweep_address`` allows the next send after one at ``last_send``,
+    or None if it never will. A duration gets a 5 minute margin, for
+    the clocks of the blockchain and this machine not quite agreeing;
+    a calendar schedule fires when it says.
+
+    """
+    threshold = sweep_address.time_threshold
+    opens = threshold.next_allowed(last_send)
+    if opens is None or getattr(threshold, 'schedule', None):
+        return opens
+    margin = timedelta(minutes=5)
+    return opens - margin.total_seconds()
+
+
+def _no_window(sweep_address):
+    """The errors of a watch whose time threshold never allows a send."""
+    threshold = sweep_address.time_threshold
+    return {sweep_address.address: "Bad time threshold {0!r}: no send is "
+            "ever allowed".format(getattr(threshold, 'schedule', None) or
+                                  threshold.duration)}
+
+
+def _journal_send(state, sweep_address, balance, result):
+    """Record a successful send in the journal ``state`` (if any)."""
+    if state is None:
+        return
+    now = time.time()
+    state.update(sweep_address,
+                 balance=balance,
+                 last_send=now,
+                 decision=result,
+                 next_change=_window_opens(sweep_address, now),
+                 swept=True)
+
+
+def _scrubbed(errors):
+    """
+    ``errors`` with the secrets in its keys and values replaced (see
+    sweepnet.scrub), for a trace, or None if there are none.
+
+    >>> _scrubbed({"https://blockchain.info/merchant/5Kb8/payment": "500"})
+    {u'https://blockchain.info/merchant/SCRUBBED/payment': u'500'}
+
+    """
+    if not errors:
+        return None
+    return dict((sweepnet.scrub(unicode(k)), sweepnet.scrub(unicode(v)))
+                for k, v in errors.iteritems())
+
+
+def _spendable(unspent, confirmations):
+    """The outputs in ``unspent`` with enough ``confirmations``."""
+    return [u for u in unspent or []
+            if u.get('confirmations', confirmations) >= confirmations]
+
+
+def _record_errors(record, errors):
+    """Mark a result record as failed with the ``errors`` dictionary."""
+    record['status'] = "error"
+    record['errors'] = errors
+    record['result'] = json.dumps(errors)
+
+
+class AddressSnapshot(object):
+    """
+    Everything a sweep needs to know about an address, at one moment.
+
+    ``self.balance`` is the confirmed balance (satoshis in outputs with
+    ``self.confirmations`` or more), ``self.unspent`` the unspent
+    outputs (as from /unspent, with their confirmations) and
+    ``self.newest_send`` the datetime of the newest payment from the
+    address (the epoch if there hasn't been one). ``self.complete`` is
+    False if the history wasn't read far enough to know the last two,
+    which happens when the balance is already known to be below the
+    threshold.
+
+    """
+
+    def __init__(self, address, confirmations):
+        self.address = address
+        self.confirmations = confirmations
+        self.height = None
+        self.balance = 0
+        self.unspent = []
+        self.newest_send = datetime.utcfromtimestamp(0)
+        self.complete = False
+
+    def spendable(self):
+        """The unspent outputs counted in the balance."""
+        return _spendable(self.unspent, self.confirmations)
 
 
 class AddressDataBC(object):
@@ -55,27 +191,33 @@ class AddressDataBC(object):
 
     """
 
-    def __init__(self):
+    def __init__(self, provider=None):
         """
-        Probably don't need this
+        ``provider`` is an optional read-side provider (or router,
+        see sweepproviders) to fetch the data from instead of
+        blockchain.info.
 
         """
+        self.provider = provider
 
     def fetch_balance(self, address, verbose=False):
         """
         Given an address (as a string), fetch the balance.
 
         We only want the balance of transactions that have
-        6 or more confirmations.
+        DEFAULT_CONFIRMATIONS (6) or more confirmations.
 
         The return is a tuple: (balance, errors), where
         balance is in satoshis
         errors is a dictionary.
         """
+        if self.provider is not None:
+            self.balance, errors = self.provider.balance(address, verbose)
+            return (self.balance, errors)
 
         url = "https://blockchain.info/q/addressbalance/"
         url += address
-        url += "?confirmations=6"
+        url += "?confirmations={0}".format(DEFAULT_CONFIRMATIONS)
         content, errors = _read_url(url, None)
         if errors:
             return (0, errors)
@@ -94,6 +236,10 @@ class AddressDataBC(object):
 
         """
         self.unspent_outputs = None
+        if self.provider is not None:
+            self.unspent_outputs, errors = self.provider.unspent(address,
+                                                                 verbose)
+            return (self.unspent_outputs, errors)
         url = "https://blockchain.info/unspent?active="
         url += address
         uo_json, errors = _read_url(url, None)
@@ -124,6 +270,10 @@ class AddressDataBC(object):
 
         """
         self.transactions = None
+        if self.provider is not None:
+            self.transactions, errors = self.provider.transactions(address,
+                                                                   verbose)
+            return (self.transactions, errors)
         url = "https://blockchain.info/rawaddr/"
         url += address
         uo_json, errors = _read_url(url, None)
@@ -174,9 +324,134 @@ class AddressDataBC(object):
             errors[address] = str(e)
         return (dt_result, errors)
 
+    def fetch_block_height(self, verbose=False):
+        """
+        Fetch the height of the newest block, reused for
+        BLOCK_HEIGHT_TTL seconds by every AddressDataBC.
+
+        The return is a tuple: (height, errors)
+
+        """
+        if _block_height['height'] is not None and \
+                time.time() - _block_height['time'] < BLOCK_HEIGHT_TTL:
+            sweeptrace.current().add('cache_hits')
+            return (_block_height['height'], {})
+        sweeptrace.current().add('cache_misses')
+        content, errors = _read_url("https://blockchain.info/q/getblockcount",
+                                    None, verbose)
+        if errors:
+            return (None, errors)
+        try:
+            height = long(content)
+        except ValueError as e:
+            return (None, {"getblockcount": str(e)})
+        _block_height['height'] = height
+        _block_height['time'] = time.time()
+        return (height, errors)
+
+    def fetch_snapshot(self,
+                       address,
+                       confirmations=None,
+                       threshold=None,
+                       verbose=False):
+        """
+        Get an AddressSnapshot of ``address``, from the pages of its
+        history (newest first) plus the (cached) block height: one
+        request for most addresses, instead of one each for the
+        balance, the history and the unspent outputs.
+
+        Paging stops as soon as every unspent output has been seen and
+        the newest send is known, or right after the first page if the
+        balance can't be more than ``threshold`` (satoshis).
+
+        The return is a tuple: (snapshot, errors)
+
+        """
+        if confirmations is None:
+            confirmations = DEFAULT_CONFIRMATIONS
+        snapshot = AddressSnapshot(address, confirmations)
+        if self.provider is not None:
+            return self._provider_snapshot(snapshot, verbose)
+        height, errors = self.fetch_block_height(verbose)
+        if errors:
+            return (None, errors)
+        snapshot.height = height
+
+        newest = 0
+        offset = 0
+        final_balance = 0
+        while True:
+            url = "https://blockchain.info/rawaddr/{0}?limit={1}&offset={2}"\
+                  .format(address, RAWADDR_PAGE, offset)
+            content, errors = _read_url(url, None, verbose)
+            if errors:
+                return (None, errors)
+            try:
+                with sweeptrace.span("json_decode", bytes=len(content)):
+                    page = json.loads(content)
+                if offset == 0:
+                    final_balance = long(page['final_balance'])
+                    total_sent = long(page['total_sent'])
+                    tx_count = page['n_tx']
+                for tx in page['txs']:
+                    tx_confirmations = 0
+                    if tx.get('block_height'):
+                        tx_confirmations = height - tx['block_height'] + 1
+                    for inp in tx['inputs']:
+                        if inp.get('prev_out', {}).get('addr') == address:
+                            newest = max(newest, tx['time'])
+                    for out in tx['out']:
+                        if out.get('addr') == address and \
+                                not out.get('spent'):
+                            snapshot.unspent.append({
+                                'tx_hash': binascii.hexlify(
+                                    binascii.unhexlify(tx['hash'])[::-1]),
+                                'tx_hash_big_endian': tx['hash'],
+                                'tx_output_n': out['n'],
+                                'script': out.get('script'),
+                                'value': long(out['value']),
+                                'confirmations': tx_confirmations})
+            except Exception as e:
+                return (None, {address: str(e)})
+            offset += len(page['txs'])
+            found = sum(u['value'] for u in snapshot.unspent)
+            snapshot.complete = found >= final_balance and \
+                                bool(newest or not total_sent)
+            if snapshot.complete or offset >= tx_count or not page['txs']:
+                break
+            if threshold is not None and final_balance <= threshold:
+                break
+        # outputs too new to count are in the newest transactions,
+        # which are on the pages read
+        snapshot.balance = final_balance - sum(
+                                u['value'] for u in snapshot.unspent
+                                if u['confirmations'] < confirmations)
+        snapshot.newest_send = datetime.utcfromtimestamp(newest)
+        if verbose:
+            print "Snapshot: balance {0}, {1} unspent outputs, newest send "\
+                  "{2}".format(snapshot.balance, len(snapshot.unspent),
+                               snapshot.newest_send)
+        return (snapshot, {})
+
+    def _provider_snapshot(self, snapshot, verbose):
+        """fetch_snapshot() through the provider."""
+        unspent, errors = self.fetch_unspent_outputs(snapshot.address,
+                                                     verbose)
+        if errors:
+            return (None, errors)
+        snapshot.unspent = unspent or []
+        snapshot.balance = sum(u['value'] for u in snapshot.spendable())
+        snapshot.newest_send, errors = self.newest_send(snapshot.address,
+                                                        verbose)
+        if errors:
+            return (None, errors)
+        snapshot.complete = True
+        return (snapshot, errors)
+
     def fetch_exchange_rate(self, currency, verbose=False):
         """
-        Fetch the current exchange rate for the currency
+        Fetch the current exchange rate for the currency. A rate
+        fetched less than EXCHANGE_RATE_TTL seconds ago is reused.
 
         The return is a tuple: (rate, errors), where
         rate is a float
@@ -185,6 +460,19 @@ class AddressDataBC(object):
         """
         if verbose:
             print "ENTER AddressDataBC.fetch_exchange_rate"
+        cached = _exchange_rates.get(currency)
+        if cached is not None and time.time() - cached[1] < EXCHANGE_RATE_TTL:
+            sweeptrace.current().add('cache_hits')
+            return (cached[0], {})
+        sweeptrace.current().add('cache_misses')
+        rate, errors = self._fetch_exchange_rate(currency, verbose)
+        if not errors:
+            _exchange_rates[currency] = (rate, time.time())
+        return (rate, errors)
+
+    def _fetch_exchange_rate(self, currency, verbose):
+        if self.provider is not None:
+            return self.provider.exchange_rate(currency, verbose)
         rate = 1.0
         url = "https://blockchain.info/ticker"
         ticker_json, errors = _read_url(url, None)
@@ -242,39 +530,61 @@ class TxnServiceBlockChain(object):
         for watch in self.watch_list.itervalues():
             watch.write_info("  ", verbose)
 
-    def send_transaction(self,
-                         address_info,
-                         balance,
-                         address_data=AddressDataBC(),
-                         verbose=False):
+    def build_transaction(self,
+                          address_info,
+                          balance,
+                          address_data=AddressDataBC(),
+                          verbose=False,
+                          unspent=None,
+                          details=None):
         """
-        Given a SweepAddressInfo instance, build the transaction, and send it.
+        Given a SweepAddressInfo instance, work out the fees and how much
+        each of its destinations gets out of ``balance``.
 
-        Returns the resulting transaction hash or an error message as a tuple:
-        (address, hash, errors)
+        ``unspent`` is the list of outputs the sweep spends (the ones
+        counted in ``balance``), fetched if not given.
+
+        The fees come from the FeeEngine set with sweepfees.set_fee_engine
+        if there is one (its quote is put in ``details``, if given, as
+        'fee_quote'), otherwise from estimate_fee().
+
+        The return is a tuple: (amounts, fees, errors), where
+        amounts is a dictionary of destination address => satoshis
+        fees is in satoshis
+        errors is a dictionary.
 
         """
-        if verbose:
-            print "Attempting to calculate and send {0} satoshis from {1}"\
-                    .format(balance, address_info.address)
+        with sweeptrace.span("allocate",
+                             destinations=len(address_info.destinations)) as s:
+            amounts, fees, errors = self._allocate(address_info, balance,
+                                                   address_data, verbose,
+                                                   unspent, details)
+            s.set(fees=fees, amounts=amounts, errors=_scrubbed(errors))
+        return (amounts, fees, errors)
+
+    def _allocate(self, address_info, balance, address_data, verbose,
+                  unspent, details):
+        """Do the work of build_transaction."""
         # Calculate fees and reduce balance by that amount
-        # Tx size roughly 148 * number_of_inputs + 34 * number_of_outputs + 10
         # Note: this assumes we are emptying the address
-        uo, errors = address_data.fetch_unspent_outputs(address_info.address,
-                                                        verbose)
-        if errors or not uo:
-            return (address_info.address, "", errors)
-        input_count = len(uo)
-        input_size = 180  # newer ones could be only 148
-        output_count = len(address_info.destinations)
-        output_size = 34
-        header_size = 10
-        tx_size = input_size * input_count\
-                  + output_size * output_count\
-                  + header_size\
-                  + input_count  # margin of error
-        minimum_fee = 10000
-        fees = minimum_fee * long(round(tx_size / 1000 + 0.5))
+        uo = unspent
+        if uo is None:
+            uo, errors = address_data.fetch_unspent_outputs(
+                                                    address_info.address,
+                                                    verbose)
+            if errors:
+                return (None, 0, errors)
+            uo = _spendable(uo, DEFAULT_CONFIRMATIONS)
+        if not uo:
+            return (None, 0, {})
+        fees = None
+        if fee_engine() is not None:
+            quote = fee_engine().quote(address_info, len(uo), verbose)
+            if details is not None:
+                details['fee_quote'] = quote
+            fees = quote['fees']
+        if fees is None:
+            fees = estimate_fee(len(uo), len(address_info.destinations))
 
         # now update our balance so we calculate after paying fees
         balance -= fees
@@ -285,23 +595,23 @@ class TxnServiceBlockChain(object):
         data = {}  # dictionary to hold JSON data
         btcusd = 0
         for send, amount in address_info.destinations.iteritems():
-            if "%" in amount:
+            kind, value = parse_send_amount(amount)
+            if kind == "percent":
                 # percentage
-                percent = float(amount.strip()[:-1])
-                temp_amount = long((balance * percent) / 100)
+                temp_amount = long((balance * value) / 100)
                 data[send] = temp_amount
                 current_balance -= temp_amount
                 if verbose:
-                    print "Sending {0}% ({1}) to {2}".format(percent, temp_amount, send)
-            elif "$" == amount[0]:
+                    print "Sending {0}% ({1}) to {2}".format(value, temp_amount, send)
+            elif kind == "dollars":
                 # float = dollars, convert to BTC
-                dollar_amount = float(amount[1:])
+                dollar_amount = value
                 if 0 == btcusd:
                     # fetch conversion rate (if we haven't already)
                     btcusd, errors = address_data.fetch_exchange_rate("USD",
                                                                       verbose)
                     if errors:
-                        return (address_info.address, "", errors)
+                        return (None, fees, errors)
                     if verbose:
                         print "USDBTC Exchange Rate={0}".format(btcusd)
                 # convert temp_amount to satoshis
@@ -313,30 +623,23 @@ class TxnServiceBlockChain(object):
                     print "Sending ${0} ({1}) to {2}".format(dollar_amount,
                                                              temp_amount,
                                                              send)
-            elif "." in amount:
-                # float = bitcoins
-                temp_amount = long(round(float(amount) * 1e8))
-                data[send] = temp_amount
-                current_balance -= temp_amount
-                if verbose:
-                    print "Sending {0} to {1}".format(temp_amount, send)
-            elif long(amount) <= 0:
+            elif kind == "balance":
                 # signal balance
                 data[send] = 0
                 receiving_balance_count += 1
                 if verbose:
                     print "Sending balance to {0}".format(send)
             else:
-                # satoshis
-                data[send] = long(amount)
-                current_balance -= long(amount)
+                # satoshis (bitcoin amounts have been converted)
+                data[send] = value
+                current_balance -= value
                 if verbose:
-                    print "Sending {0} to {1}".format(long(amount), send)
+                    print "Sending {0} to {1}".format(value, send)
         # If current balance is negative, we have an error!
         if current_balance < 0:
             # We can't create a valid transaction, bail
-            return (address_info.address,
-                    "",
+            return (None,
+                    fees,
                     {address_info.address: \
                      "Error: Insufficient funds for specified payouts!"})
         if receiving_balance_count > 0 and current_balance > 0:
@@ -348,11 +651,91 @@ class TxnServiceBlockChain(object):
             # the other destinations don't add up to the balance.
             # If we send, the balance will go to miner's fees,
             # which we probably don't want.
-            return (address_info.address,
-                    "",
+            return (None,
+                    fees,
                     {address_info.address: \
                      "Error: Too much in address, need a balance destination" +
                      "(AKA a change address)."})
+        return (data, fees, {})
+
+    def send_transaction(self,
+                         address_info,
+                         balance,
+                         address_data=AddressDataBC(),
+                         verbose=False,
+                         details=None,
+                         engine=None,
+                         checkpoint=None,
+                         unspent=None):
+        """
+        Given a SweepAddressInfo instance, build the transaction, and send it.
+
+        If ``details`` (a dictionary) is given, the amounts sent to each
+        destination and the fees are put in it as 'amounts' and 'fees'
+        (and how the fees were chosen as 'fee_quote', see
+        build_transaction).
+
+        With an ``engine`` (a sweeptx.LocalTxEngine) the transaction is
+        signed locally and only the signed transaction is broadcast,
+        otherwise the private key goes to the blockchain.info wallet API.
+
+        If ``checkpoint`` (a RunCheckpoint) is given, the send is logged
+        in it just before it goes out and again once it has.
+
+        ``unspent`` is the list of outputs to spend (the ones counted in
+        ``balance``), fetched if not given.
+
+        Returns the resulting transaction hash or an error message as a tuple:
+        (address, hash, errors)
+
+        """
+        if verbose:
+            print "Attempting to calculate and send {0} satoshis from {1}"\
+                    .format(balance, address_info.address)
+        if unspent is None:
+            unspent, errors = address_data.fetch_unspent_outputs(
+                                                    address_info.address,
+                                                    verbose)
+            if errors:
+                return (address_info.address, "", errors)
+            unspent = _spendable(unspent, DEFAULT_CONFIRMATIONS)
+        data, fees, errors = self.build_transaction(address_info,
+                                                    balance,
+                                                    address_data,
+                                                    verbose,
+                                                    unspent,
+                                                    details)
+        if details is not None:
+            details['amounts'] = data
+            details['fees'] = fees
+        if errors or data is None:
+            return (address_info.address, "", errors)
+        with sweeptrace.span("send",
+                             signer="local" if engine else "wallet") as s:
+            a, tx_hash, errors = self._send(address_info, data, fees,
+                                            verbose, engine, checkpoint,
+                                            unspent)
+            s.set(tx_hash=tx_hash, status="error" if errors else "ok")
+        return (a, tx_hash, errors)
+
+    def _send(self, address_info, data, fees, verbose, engine, checkpoint,
+              unspent):
+        """Send the sweep worked out by send_transaction."""
+        if engine is not None:
+            raw, errors = engine.build(address_info,
+                                       unspent,
+                                       data,
+                                       fees,
+                                       verbose)
+            if errors:
+                return (address_info.address, "", errors)
+            if checkpoint is not None:
+                checkpoint.sending(address_info.address,
+                                   engine.transaction_id(raw))
+            tx_hash, errors = engine.broadcast(raw, verbose)
+            if tx_hash and checkpoint is not None:
+                checkpoint.sent(address_info.address, tx_hash)
+            return (address_info.address, tx_hash, errors)
         try:
             json_values = json.dumps(data)
             url_values = "recipients=" + urllib.quote(json_values)
@@ -376,6 +759,8 @@ class TxnServiceBlockChain(object):
 
         # actually send the request
         tx_hash = ""
+        if checkpoint is not None:
+            checkpoint.sending(address_info.address)
         response, errors = _read_url(send_url)
         if response:
             try:
@@ -384,70 +769,300 @@ class TxnServiceBlockChain(object):
                     tx_hash = tx_data['tx_hash']
             except Exception as e:
                 errors[address_info.address] = str(e)
+        if tx_hash and checkpoint is not None:
+            checkpoint.sent(address_info.address, tx_hash)
         return (address_info.address, tx_hash, errors)
 
-    def process_transactions(self, verbose=False):
+    def iter_transactions(self, verbose=False, addresses=None, state=None,
+                          provider=None, engine=None, checkpoint=None,
+                          concurrency=1):
         """
         For each of the addresses in the watch list, send
-        their transactions.
+        their transactions, yielding a result record for each
+        address as soon as it is done.
 
-        Returns a dictionary of the results.
+        If ``addresses`` is given, only the watched addresses in it
+        are processed (this is how a shard handles its part of the
+        watch list).
+
+        If ``state`` (a RunState journal) is given, it is used to skip
+        API calls whose answers can't have changed since the last run,
+        and it is updated with this run's decisions. Saving it is up
+        to the caller. The addresses are also worked on in the order of
+        the value they are expected to sweep (see RunState.priority),
+        so a run with a deadline or a call budget (see sweepnet) spends
+        it on the largest balances first.
+
+        Once the run's deadline has passed or its call budget is used
+        up, the addresses left (and any cut off by it half way) are
+        "deferred" to the next run.
+
+        ``provider`` is passed on to AddressDataBC, to read the address
+        data from other APIs than blockchain.info (see sweepproviders).
+
+        ``engine`` is passed on to send_transaction, to sign the sweeps
+        locally (see sweeptx).
+
+        If ``checkpoint`` (a RunCheckpoint) is given, every address that
+        is finished with (other than with an error) is logged in it, and
+        addresses it has as completed are skipped. An address with a
+        send in flight in it is only processed if that send turns out
+        not to have gone out.
+
+        With a ``concurrency`` above 1 that many addresses are worked
+        on at once, in threads, and the records come in the order the
+        addresses finish.
+
+        Each record is a dictionary (that json.dumps can handle) of
+        - service: this service's name
+        - address: the watched address
+        - status: one of "sent", "too_soon", "below_threshold", "error",
+          "deferred"
+        - result: what process_transactions reports for the address
+        - tx_hash: the hash of the sweep transaction, if one was sent
+        - balance: the balance found, in satoshis (None if unknown)
+        - amounts: destination address => satoshis sent (or None)
+        - fees: the fees of the sweep, in satoshis (or None)
+        - fee_quote: how the fees were chosen, with a fee engine (see
+          sweepfees.FeeEngine.quote), or None
+        - started: when work on the address started (seconds since epoch)
+        - elapsed: the seconds spent on the address
+        - errors: a dictionary of the errors encountered
 
         """
-        r = {}
-        for sweep_address in self.watch_list.itervalues():
-            if verbose:
-                print "Processing {0}".format(sweep_address.address)
-            # first check the balance
-            fetcher = AddressDataBC()
-            balance, errors = fetcher.fetch_balance(sweep_address.address,
-                                                    verbose)
+        if addresses is None:
+            watches = self.watch_list.values()
+        else:
+            watches = [self.watch_list[a] for a in addresses
+                       if a in self.watch_list]
+        if checkpoint is not None:
+            watches = [w for w in watches
+                       if w.address not in checkpoint.completed]
+        if state is not None:
+            now = time.time()
+            watches.sort(key=lambda w: state.priority(w, now), reverse=True)
+
+        def process(sweep_address):
+            record = {'service': self.service_name,
+                      'address': sweep_address.address,
+                      'status': None,
+                      'result': None,
+                      'tx_hash': "",
+                      'balance': None,
+                      'amounts': None,
+                      'fees': None,
+                      'fee_quote': None,
+                      'started': time.time(),
+                      'elapsed': 0.0,
+                      'errors': {}}
+            if sweepnet.budget_spent():
+                record['status'] = "deferred"
+                record['result'] = DEFERRED
+                return record
+            with sweeptrace.span("address", sample=True,
+                                 address=sweep_address.address,
+                                 service=self.service_name) as s:
+                self._process_address(sweep_address, record, verbose, state,
+                                      provider, engine, checkpoint)
+                if record['status'] == "error" and \
+                        any(e in sweepnet.BUDGET_ERRORS
+                            for e in record['errors'].itervalues()):
+                    # cut off by the budget, not a failure of the address
+                    record['status'] = "deferred"
+                    record['result'] = DEFERRED
+                s.set(status=record['status'],
+                      decision=sweepnet.scrub(record['result']),
+                      errors=_scrubbed(record['errors']),
+                      balance=record['balance'],
+                      threshold=sweep_address.balance_threshold)
+            record['elapsed'] = time.time() - record['started']
+            return record
+
+        pool = None
+        if concurrency > 1 and len(watches) > 1:
+            pool = ThreadPool(min(concurrency, len(watches)))
+            records = pool.imap_unordered(process, watches)
+        else:
+            records = imap(process, watches)
+        try:
+            for record in records:
+                if checkpoint is not None and \
+                        record['status'] not in ("error", "deferred"):
+                    checkpoint.done(record)
+                yield record
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def _process_address(self, sweep_address, record, verbose, state,
+                         provider, engine, checkpoint):
+        """Do the work of iter_transactions for one address."""
+        if verbose:
+            print "Processing {0}".format(sweep_address.address)
+        if checkpoint is not None and \
+                sweep_address.address in checkpoint.in_flight:
+            # an earlier attempt at this run may have sent already
+            tx_hash, errors = reconcile(checkpoint,
+                                        sweep_address,
+                                        AddressDataBC(provider),
+                                        verbose)
             if errors:
-                r[sweep_address.address] = json.dumps(errors)
-                continue
-            if balance > sweep_address.balance_threshold:
-                # check the time criteria
-                most_recent, errors = fetcher.newest_send(sweep_address.address,
-                                                          verbose)
-                if errors:
-                    r[sweep_address.address] = json.dumps(errors)
-                    continue
-                if verbose:
-                    print "Most recent send time: {0}".format(most_recent)
-                if most_recent == datetime.utcfromtimestamp(0):
+                _record_errors(record, errors)
+                return
+            if tx_hash:
+                record['status'] = "sent"
+                record['tx_hash'] = tx_hash
+                record['result'] = "Success, Tx={0}".format(tx_hash)
+                _journal_send(state, sweep_address, 0, record['result'])
+                return
+        entry = None
+        if state is not None:
+            entry = state.get(sweep_address)
+        if entry and entry['next_change'] and \
+                time.time() < entry['next_change']:
+            # the time criteria can't be met yet, whatever the balance
+            if verbose:
+                print "Journal: not sweepable before {0}".format(
+                    datetime.utcfromtimestamp(entry['next_change']))
+            record['status'] = "too_soon"
+            record['result'] = "Not enough time elapsed"
+            return
+        if entry and entry.get('pending_tx') and \
+                time.time() < entry['pending_until']:
+            # the coins are spent until the last send confirms or is
+            # found to be dropped (see sweeptrack)
+            if verbose:
+                print "Journal: {0} is unconfirmed".format(entry['pending_tx'])
+            record['status'] = "too_soon"
+            record['result'] = "Waiting for {0} to confirm".format(
+                                                        entry['pending_tx'])
+            return
+        if entry and not state.balance_due(entry):
+            # at the rate coins have been coming in, the balance can't
+            # have reached the threshold yet
+            if verbose:
+                print "Journal: balance not due for a check before {0}"\
+                    .format(datetime.utcfromtimestamp(entry['next_check']))
+            record['status'] = "below_threshold"
+            record['result'] = "Balance not large enough"
+            return
+        # one look at the address gives the balance, the unspent
+        # outputs and the newest send
+        fetcher = AddressDataBC(provider)
+        snapshot, errors = fetcher.fetch_snapshot(
+                            sweep_address.address,
+                            threshold=sweep_address.balance_threshold,
+                            verbose=verbose)
+        if errors:
+            _record_errors(record, errors)
+            return
+        balance = snapshot.balance
+        record['balance'] = balance
+        if balance > sweep_address.balance_threshold:
+            # check the time criteria
+            if entry and entry['last_send'] is not None:
+                # the journal knows the newest send, so the history
+                # is only worth fetching once the window has opened
+                opens = _window_opens(sweep_address, entry['last_send'])
+                if opens is None:
+                    _record_errors(record, _no_window(sweep_address))
+                    return
+                if time.time() < opens:
                     if verbose:
-                        print "no sends from this address yet"
-                    # we haven't sent from this address yet
+                        print "Journal: last send at {0}".format(
+                            datetime.utcfromtimestamp(entry['last_send']))
+                    record['status'] = "too_soon"
+                    record['result'] = "Not enough time elapsed"
+                    state.update(sweep_address,
+                                 balance=balance,
+                                 decision=record['result'],
+                                 next_change=opens)
+                    return
+            most_recent = snapshot.newest_send
+            if verbose:
+                print "Most recent send time: {0}".format(most_recent)
+            if most_recent == datetime.utcfromtimestamp(0):
+                if verbose:
+                    print "no sends from this address yet"
+                # we haven't sent from this address yet
+                a, m, errors = self.send_transaction(sweep_address,
+                                                     balance,
+                                                     fetcher,
+                                                     verbose,
+                                                     record,
+                                                     engine,
+                                                     checkpoint,
+                                                     snapshot.spendable())
+                if m:
+                    record['status'] = "sent"
+                    record['tx_hash'] = m
+                    record['result'] = m
+                    _journal_send(state, sweep_address, balance, m)
+                else:
+                    _record_errors(record, errors)
+            else:
+                if verbose:
+                    print "Checking most recent send"
+                # we need to check the most recent send
+                last_send = calendar.timegm(most_recent.utctimetuple())
+                opens = _window_opens(sweep_address, last_send)
+                if opens is None:
+                    _record_errors(record, _no_window(sweep_address))
+                    return
+                if verbose:
+                    print "next send allowed at {0}".format(
+                        datetime.utcfromtimestamp(opens))
+                if time.time() >= opens:
                     a, m, errors = self.send_transaction(sweep_address,
-                                                 balance,
-                                                 fetcher,
-                                                 verbose)
+                                                         balance,
+                                                         fetcher,
+                                                         verbose,
+                                                         record,
+                                                         engine,
+                                                         checkpoint,
+                                                         snapshot.spendable())
                     if m:
-                        r[a] = m
+                        record['status'] = "sent"
+                        record['tx_hash'] = m
+                        record['result'] = "Success, Tx={0}".format(m)
+                        _journal_send(state, sweep_address, balance,
+                                      record['result'])
                     else:
-                        r[a] = errors
+                        _record_errors(record, errors)
                 else:
-                    if verbose:
-                        print "Checking most recent send"
-                    # we need to check the most recent send
-                    # add a margin of error (say 5 minutes)
-                    elapsed_time = datetime.utcnow() - most_recent
-                    elapsed_time = elapsed_time + timedelta(minutes=5)
-                    if verbose:
-                        print "elapsed time(+ margin)={0}".format(elapsed_time)
-                    # elapsed_time should be a datetime.timedelta object
-                    if sweep_address.time_threshold.waited_enough(elapsed_time,
-                                                                  verbose):
-                        a, m, errors = self.send_transaction(sweep_address,
-                                                     balance,
-                                                     fetcher,
-                                                     verbose)
-                        if m:
-                            r[a] = "Success, Tx={0}".format(m)
-                        else:
-                            r[a] = errors
-                    else:
-                        r[sweep_address.address] = "Not enough time elapsed"
-            else:
-                r[sweep_address.address] = "Balance not large enough"
+                    record['status'] = "too_soon"
+                    record['result'] = "Not enough time elapsed"
+                    if state is not None:
+                        state.update(sweep_address,
+                                     balance=balance,
+                                     last_send=last_send,
+                                     decision=record['result'],
+                                     next_change=opens)
+        else:
+            record['status'] = "below_threshold"
+            record['result'] = "Balance not large enough"
+            if state is not None:
+                # a deposit could change this at any time
+                state.update(sweep_address,
+                             balance=balance,
+                             decision=record['result'],
+                             next_change=None)
+
+    def process_transactions(self, verbose=False, addresses=None, state=None,
+                             provider=None, engine=None, checkpoint=None,
+                             concurrency=1):
+        """
+        For each of the addresses in the watch list, send
+        their transactions.
+
+        This is iter_transactions collected into a dictionary.
+
+        Returns a dictionary of the results.
+
+        """
+        r = {}
+        for record in self.iter_transactions(verbose, addresses, state,
+                                             provider, engine, checkpoint,
+                                             concurrency):
+            r[record['address']] = record['result']
         return r
@@ -0,0 +1,222 @@
+"""
+sweepcheckpoint - defines RunCheckpoint class
+
+RunCheckpoint is a write-ahead log of the progress of one sweep run, so
+a run that dies halfway (network drop, out of memory, Ctrl-C) can be
+resumed instead of started over.
+
+It is a file of JSON lines, appended to as the run goes:
+- {"event": "start", ...} when a run (or a resumed run) starts
+- {"event": "sending", "address": ...} just before a send goes out
+  (with its tx_hash if that is known beforehand, as it is for locally
+  signed sends)
+- {"event": "sent", "address": ..., "tx_hash": ...} once it has
+- {"event": "done", "address": ..., "status": ..., "result": ...}
+  when an address is finished with
+
+The sending and sent lines are forced to disk (fsync) straight away,
+the log must know about a send before it can happen. Done lines are
+forced to disk in batches, losing a few of them only means a few
+addresses get looked at again.
+
+A send that was started but whose address isn't done is "in flight":
+it may or may not have gone out. reconcile() looks for it before the
+address is allowed to send again. Sending again after a locally signed
+send that never went out is harmless: with the same unspent outputs
+the signed transaction comes out the same.
+
+A run that isn't resumed starts the log afresh, but the in-flight
+sends of the log it replaces are carried over into the new one, so they
+are still reconciled before their addresses send again.
+
+The log holds no private keys. It is removed when a run completes.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import os
+import json
+import time
+import threading
+
+__all__ = ["RunCheckpoint", "reconcile"]
+
+# seconds of clock difference allowed between us and the API
+CLOCK_MARGIN = 300
+
+
+class RunCheckpoint(object):
+    """
+    The checkpoint log of a run.
+
+    ``self.completed`` is a dictionary of address => done record of
+    the addresses finished by earlier attempts at this run, and
+    ``self.in_flight`` is a dictionary of address => {'time': when the
+    send started, 'tx_hash': its hash if known, 'sent': True if it is
+    known to have gone out} of sends that were started but whose
+    address wasn't finished.
+
+    """
+
+    def __init__(self, file_, resume=False, sync_every=50, sync_interval=1.0):
+        """
+        Constructor
+        ``file_`` is the log file. With ``resume`` the log of the earlier
+        attempt is read and appended to, otherwise it is started afresh
+        (keeping its in-flight sends, see the module docstring).
+        Done lines are forced to disk after ``sync_every`` of them or
+        ``sync_interval`` seconds, whichever comes first.
+
+        """
+        self.file_ = file_
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.completed = {}
+        self.in_flight = {}
+        # sends can be logged from several threads at once
+        self.lock = threading.Lock()
+        if os.path.exists(file_):
+            self._read()
+            if not resume:
+                self.completed = {}
+                self._restart()
+        self.f = open(file_, 'a')
+        self.unsynced = 0
+        self.synced_at = time.time()
+        self._write({'event': "start",
+                     'resumed': bool(resume),
+                     'completed': len(self.completed),
+                     'in_flight': len(self.in_flight)}, sync=True)
+
+    def _read(self):
+        with open(self.file_) as f:
+            for text in f:
+                try:
+                    entry = json.loads(text)
+                except ValueError:
+                    # the last line of a log that died mid-write
+                    continue
+                event = entry.get('event')
+                address = entry.get('address')
+                if event == "sending":
+                    self.in_flight[address] = {'time': entry['time'],
+                                               'tx_hash': entry['tx_hash'],
+                                               'sent': False}
+                elif event == "sent":
+                    self.in_flight.setdefault(address,
+                                              {'time': entry['time']})
+                    self.in_flight[address]['tx_hash'] = entry['tx_hash']
+                    self.in_flight[address]['sent'] = True
+                elif event == "done":
+                    self.completed[address] = entry
+                    self.in_flight.pop(address, None)
+
+    def _restart(self):
+        """
+        Replace the log with one holding only its in-flight sends. The
+        new log is written aside and renamed over the old one, so a
+        crash meanwhile leaves one or the other.
+
+        """
+        temp = self.file_ + ".new"
+        with open(temp, 'w') as f:
+            for address, flight in sorted(self.in_flight.iteritems()):
+                f.write(json.dumps({'event': "sending",
+                                    'address': address,
+                                    'tx_hash': flight.get('tx_hash', ""),
+                                    'time': flight['time']}) + "\n")
+                if flight.get('sent'):
+                    f.write(json.dumps({'event': "sent",
+                                        'address': address,
+                                        'tx_hash': flight['tx_hash'],
+                                        'time': flight['time']}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, self.file_)
+
+    def _write(self, entry, sync=False):
+        entry.setdefault('time', time.time())
+        with self.lock:
+            self.f.write(json.dumps(entry, default=str) + "\n")
+            self.unsynced += 1
+            if sync or self.unsynced >= self.sync_every or \
+                    time.time() - self.synced_at >= self.sync_interval:
+                self.sync()
+
+    def sync(self):
+        """Force everything written so far to disk."""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def sending(self, address, tx_hash=""):
+        """Log that a send from ``address`` is about to go out."""
+        self._write({'event': "sending",
+                     'address': address,
+                     'tx_hash': tx_hash}, sync=True)
+
+    def sent(self, address, tx_hash):
+        """Log that the send from ``address`` went out as ``tx_hash``."""
+        self._write({'event': "sent",
+                     'address': address,
+                     'tx_hash': tx_hash}, sync=True)
+
+    def done(self, record):
+        """Log that the address of result ``record`` is finished with."""
+        self._write({'event': "done",
+                     'address': record['address'],
+                     'status': record['status'],
+                     'result': record['result'],
+                     'tx_hash': record['tx_hash']})
+        with self.lock:
+            self.in_flight.pop(record['address'], None)
+
+    def close(self, complete=False):
+        """
+        Force the log to disk and close it. A ``complete`` run has no
+        use for it any more, so then it is removed.
+
+        """
+        if self.f.closed:
+            return
+        self.sync()
+        self.f.close()
+        if complete:
+            os.remove(self.file_)
+
+
+def reconcile(checkpoint, sweep_address, address_data, verbose=False):
+    """
+    Find out what became of the in-flight send from ``sweep_address``
+    (a SweepAddressInfo), using ``address_data`` (an AddressDataBC).
+
+    A send logged as sent went out. Otherwise the address's history is
+    searched for the send's transaction (if its hash is known) or any
+    transaction spending from the address since the send started.
+
+    The return is a tuple: (tx_hash, errors), where
+    tx_hash is the hash of the send, or "" if it didn't go out
+    errors is a dictionary; with errors it isn't safe to send again.
+
+    """
+    flight = checkpoint.in_flight[sweep_address.address]
+    if flight.get('sent'):
+        return (flight['tx_hash'], {})
+    txs, errors = address_data.fetch_transactions(sweep_address.address,
+                                                  verbose)
+    if errors:
+        return ("", errors)
+    for tx in txs or []:
+        if flight['tx_hash'] and tx.get('hash') == flight['tx_hash']:
+            return (tx['hash'], {})
+        if tx.get('time', 0) < flight['time'] - CLOCK_MARGIN:
+            continue
+        for tx_input in tx.get('inputs', []):
+            if tx_input.get('prev_out', {}).get('addr') == \
+                    sweep_address.address:
+                if verbose:
+                    print "In-flight send found: {0}".format(tx['hash'])
+                return (tx['hash'], {})
+    return ("", {})
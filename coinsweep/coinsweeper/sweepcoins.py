@@ -16,11 +16,32 @@ import sys
 import os
 import getpass
 import pickle
+import json
+import time
+import atexit
+import calendar
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
 from cryptconfig import CryptConfig
-from sweepblockchain import TxnServiceBlockChain, AddressDataBC
+from sweepblockchain import TxnServiceBlockChain, AddressDataBC, \
+                            set_confirmations
 from sweepaddress import SweepAddressInfo
+from sweepshard import run_sharded
+from sweepmonitor import AddressMonitor, BLOCKCHAIN_WS_URL
+from sweepstate import RunState
+import sweepnet
+from sweepproviders import ProviderRouter, make_provider
+from sweeptx import LocalTxEngine
+from sweepimport import import_watches
+from sweepcheckpoint import RunCheckpoint
+from sweeplist import list_watches
+from sweepmulti import WatchFile, find_watch_files, iter_watch_files
+from sweepfees import FeeEngine, DEFAULT_FEE_URL, set_fee_engine
+from sweeptrack import ConfirmationTracker
+from sweepreload import WatchFileReloader, dumps_sorted
+from sweepledger import SweepLedger, REPORTS
+from sweepindex import DestinationIndex
+import sweeptrace
 
 __all__ = []
 __version__ = 0.5
@@ -47,10 +68,181 @@ class CLIError(Exception):
 
 def _save_data(data, cfg, file_):
     """Quick helper function, encrypts then saves cfg to file_"""
-    s = pickle.dumps(data)
+    s = dumps_sorted(data)
     cfg.write_encrypted_file(file_, s)
 
 
+def _write_record(record):
+    """Write one result record as a line of JSON, straight away."""
+    sys.stdout.write(json.dumps(record, default=str) + "\n")
+    sys.stdout.flush()
+
+
+def _sweep_files(args, passphrase, provider, engine, ledger=None):
+    """
+    Sweep the watch files of --files, reporting the results per file
+    (and adding them to the ``ledger``, if given).
+
+    """
+    watch_files = [WatchFile(f, args.config, passphrase)
+                   for f in find_watch_files(args.files)]
+    loaded = [w for w in watch_files if w.load()]
+    for watch_file in loaded:
+        watch_file.open(not args.no_state,
+                        args.max_interval,
+                        args.sample_rate,
+                        args.resume)
+    if ledger is not None:
+        ledger.start_run(" ".join(w.data_file for w in loaded))
+    try:
+        with sweeptrace.span("run", root=True,
+                             files=[w.data_file for w in loaded],
+                             concurrency=args.concurrency) as run_span:
+            for record in iter_watch_files(loaded,
+                                           args.concurrency,
+                                           provider=provider,
+                                           engine=engine,
+                                           verbose=args.verbose):
+                run_span.add(record['status'])
+                if ledger is not None:
+                    ledger.add(record)
+                if args.output == "jsonl":
+                    _write_record(record)
+                else:
+                    print "{0}: send from {1} results in {2}".format(
+                                                    record['file'],
+                                                    record['address'],
+                                                    record['result'])
+                    _write_fee(record)
+                    sys.stdout.flush()
+    finally:
+        for watch_file in loaded:
+            watch_file.close()
+        if ledger is not None:
+            ledger.close()
+    for watch_file in watch_files:
+        summary = watch_file.summary()
+        if args.output == "jsonl":
+            _write_record(summary)
+        elif summary['errors']:
+            for error in summary['errors'].itervalues():
+                print "{0}: skipped, {1}".format(summary['file'], error)
+        else:
+            print "{file}: {addresses} addresses, {sent} sent, " \
+                  "{failed} failed, {deferred} deferred".format(**summary)
+    return 1 if len(loaded) < len(watch_files) else 0
+
+
+def _write_fee(record):
+    """Print how the fees of a send were chosen (with --fee-target)."""
+    quote = record.get('fee_quote')
+    if record['status'] != "sent" or not quote:
+        return
+    if quote['fees'] is None:
+        print "  fee {0} satoshis (fixed, no fee estimates)".format(
+                                                            record['fees'])
+    else:
+        print "  fee {fees} satoshis: {size} bytes at {rate} sat/vB to " \
+              "confirm within {target} blocks".format(**quote)
+
+
+def _write_tracking_report(tracker, output):
+    """Report the sends the tracker saw confirm, drop or get stuck."""
+    now = time.time()
+    for status, sends in sorted(tracker.report().iteritems()):
+        for tx_hash, send in sends:
+            if output == "jsonl":
+                send['tx_hash'] = tx_hash
+                _write_record(send)
+            elif status == "confirmed":
+                print "Confirmed: {0} from {1} in block {2}, after {3:.0f} " \
+                      "minutes".format(tx_hash, send['address'],
+                                       send['block_height'],
+                                       (send['confirmed'] - send['sent']) / 60)
+            elif status == "dropped":
+                print "Dropped: {0} from {1}, the address will be checked " \
+                      "again".format(tx_hash, send['address'])
+            elif status == "stuck":
+                print "Stuck: {0} from {1}, unconfirmed for {2:.1f} " \
+                      "hours".format(tx_hash, send['address'],
+                                     (now - send['sent']) / 3600)
+            else:
+                print "Unconfirmed: {0} from {1}".format(tx_hash,
+                                                        send['address'])
+
+
+def _parse_date(text):
+    """A YYYY-MM-DD date (UTC) as seconds since the epoch."""
+    return calendar.timegm(time.strptime(text, "%Y-%m-%d"))
+
+
+def _write_ledger_report(args):
+    """Print the --report asked for from the ledger."""
+    ledger = SweepLedger(args.ledger_file or args.data_file + ".ledger")
+    try:
+        rows = ledger.report(args.report,
+                             since=args.since and _parse_date(args.since),
+                             until=args.until and _parse_date(args.until),
+                             destination=args.to_address,
+                             limit=args.limit or 20)
+    finally:
+        ledger.close()
+    day = lambda t: time.strftime("%Y-%m-%d %H:%M", time.gmtime(t)) \
+                    if t else "-"
+    for row in rows:
+        if args.output == "jsonl":
+            _write_record(row)
+        elif args.report == "destinations":
+            print "{0}: {1:.8f} BTC in {2} payouts, {3} to {4}".format(
+                                        row['destination'],
+                                        row['amount'] / 1e8,
+                                        row['payouts'],
+                                        day(row['first']),
+                                        day(row['last']))
+        elif args.report == "failures":
+            print "{0}: {1} failures, last {2}".format(row['address'],
+                                                       row['failures'],
+                                                       day(row['last']))
+        else:
+            print "Run {id} of {data_file} at {0}: {addresses} addresses, " \
+                  "{sent} sent, {failed} failed, {1:.8f} BTC swept, " \
+                  "{fees} satoshis fees".format(day(row['started']),
+                                                row['swept'] / 1e8,
+                                                **row)
+    if not rows and args.output == "text":
+        print "Nothing to report"
+
+
+def _write_projection(service_list, args):
+    """Print the --project estimate of the next run's payouts."""
+    state = RunState(args.state_file or args.data_file + ".state")
+    index = DestinationIndex(service_list)
+    rate = None
+    if index.needs_rate():
+        # a rate fetched in the last minute is reused
+        rate, errors = AddressDataBC().fetch_exchange_rate("USD")
+        if errors:
+            rate = None
+            print "No exchange rate, dollar amounts left out: {0}".format(
+                                                                    errors)
+    projection = index.project(state, rate, destination=args.to_address)
+    rows = sorted(projection.iteritems(),
+                  key=lambda item: (-item[1]['amount'], item[0]))
+    for destination, row in rows[:args.limit or 20]:
+        if args.output == "jsonl":
+            row['destination'] = destination
+            _write_record(row)
+        else:
+            print "{0}: {1:.8f} BTC from {2} of {3} watches ({4} " \
+                  "unknown)".format(destination,
+                                    row['amount'] / 1e8,
+                                    row['sending'],
+                                    row['watches'],
+                                    row['unknown'])
+    if not rows and args.output == "text":
+        print "Nothing to report"
+
+
 def _query_add_service(service_list):
     """Interactively have the user select a service type and input its data"""
     #TODO: when we have more services (such as bitcoind)
@@ -136,6 +328,76 @@ def _query_add_send(watch_info):
     watch_info.destinations[send_address] = send_amount
 
 
+def _write_latency_report(address_times, run_time, deadline):
+    """Print the latencies seen by the network layer and per address."""
+    for endpoint, stats in sorted(sweepnet.latency_report().iteritems()):
+        print "Endpoint {0}: {1} requests, p50 {2:.3f}s, p95 {3:.3f}s, "\
+              "p99 {4:.3f}s, max {5:.3f}s, hedged {6} (won {7})".format(
+                                        endpoint,
+                                        stats['requests'],
+                                        stats['p50'],
+                                        stats['p95'],
+                                        stats['p99'],
+                                        stats['max'],
+                                        stats.get('hedged', 0),
+                                        stats.get('hedge_won', 0))
+    address_times = sorted(address_times)
+    if address_times:
+        print "Per address: {0} addresses, p50 {1:.3f}s, p99 {2:.3f}s, "\
+              "max {3:.3f}s".format(len(address_times),
+                                    sweepnet.percentile(address_times, 50),
+                                    sweepnet.percentile(address_times, 99),
+                                    address_times[-1])
+    if deadline:
+        print "Run took {0:.3f}s (deadline {1:.3f}s)".format(run_time,
+                                                            deadline)
+    else:
+        print "Run took {0:.3f}s".format(run_time)
+
+
+def _simulate(service_list, history_file, candidates_file, output):
+    """Backtest candidate configurations and print a report on each."""
+    # only simulations need NumPy, so only import it for them
+    import sweepsim
+    configs = []
+    if candidates_file:
+        with open(candidates_file) as cf:
+            for c in json.loads(cf.read()):
+                configs.append(sweepsim.SimConfig(
+                                    c['name'],
+                                    long(round(float(c['threshold']) * 1e8)),
+                                    c['duration'],
+                                    c['destinations'],
+                                    c.get('schedule')))
+    else:
+        seen = set()
+        for service in service_list.itervalues():
+            for watch in service.watch_list.itervalues():
+                key = (watch.balance_threshold,
+                       watch.time_threshold.duration,
+                       getattr(watch.time_threshold, 'schedule', None),
+                       tuple(sorted(watch.destinations.items())))
+                if key not in seen:
+                    seen.add(key)
+                    configs.append(sweepsim.SimConfig.from_watch(
+                                                    watch.address, watch))
+    history = sweepsim.load_history(history_file)
+    for config in configs:
+        report = sweepsim.simulate(config, **history)
+        if output == "jsonl":
+            _write_record(report)
+            continue
+        print "Configuration {0}:".format(report['name'])
+        print "  sweeps: {0} ({1} refused)".format(report['sweeps'],
+                                                   report['failed'])
+        print "  fees (in satoshis): {0}".format(report['fees'])
+        for send_address, amount in sorted(report['amounts'].iteritems()):
+            print "  # {0} gets {1} satoshis".format(send_address, amount)
+        print "  dust (in satoshis): {0}".format(report['dust'])
+        print "  left in addresses (in satoshis): {0}".format(report['left'])
+        print "  simulated in {0:.2f} seconds".format(report['seconds'])
+
+
 def main(argv=None):  # IGNORE:C0111
     """Command line options."""
 
@@ -201,11 +463,227 @@ and the minimum time between sweeps.
     program_destination_help = '''Flag indicating that the program is to
 interactively ask the user for information about an address to add
 to an existing watched address as a destination for the swept bitcoins.
+'''
+    program_import_help = '''Add the watches in a CSV (with a header row)
+or JSONL file, without any prompting. Each row has address, key,
+threshold (in bitcoins), duration (ISO 8601, default P1D), an optional
+schedule (a cron expression, UTC, that replaces the duration) and
+destinations ("ADDRESS=AMOUNT;ADDRESS=AMOUNT" in CSV, that or an object
+in JSONL). Bad rows are reported and skipped, the rest are saved at
+once. Exits with 1 if there were bad rows.
 '''
     program_list_help = '''Print out the data file, showing which
 addresses are being watched and where they are configured to send,
-along with the criteria of each.
+along with the criteria of each. Private keys are hidden unless
+--show-keys is given.
+'''
+    program_format_help = '''How --list writes the watches: "table", "json"
+or "csv" (the columns --import reads). (default: %(default)s)
+'''
+    program_show_keys_help = '''Include the private keys in the --list
+output.
 Warning: This will expose the private key of the watched addresses.
+'''
+    program_prefix_help = '''Only list watched addresses starting with
+PREFIX.
+'''
+    program_to_help = '''Only list watches sending to ADDRESS (with
+--report destinations or --project, only report ADDRESS).
+'''
+    program_min_threshold_help = '''Only list watches whose balance
+threshold (in bitcoins) is at least this.
+'''
+    program_max_threshold_help = '''Only list watches whose balance
+threshold (in bitcoins) is at most this.
+'''
+    program_due_help = '''Only list the watches the next sweep run would
+check, according to the run-state journal.
+'''
+    program_offset_help = '''Skip this many watches of the --list output.
+'''
+    program_limit_help = '''List at most this many watches (or report rows,
+20 by default).
+'''
+    program_project_help = '''Estimate what each destination (only --to,
+if given) will receive from the next run, from the balances the
+run-state journal expects, each watch's thresholds and amounts, and the
+exchange rate. Watches the journal knows nothing about are counted as
+unknown. Prints the --limit largest (20 by default).
+'''
+    program_monitor_help = '''Keep running, subscribing to notifications
+for every watched address instead of polling them. An address is only
+checked for sweeping when it receives funds (and again on each new block
+until it has been swept).
+'''
+    program_monitor_url_help = '''Websocket URL to get the address
+notifications from. (default: %(default)s)
+'''
+    program_reload_help = '''With --monitor, check the data file for changes
+every this many seconds and take them up without restarting: new
+watches are subscribed to, removed ones unsubscribed from and edited
+ones replaced.
+'''
+    program_state_help = '''Run-state journal file. It remembers each
+address' last balance, last send and last decision between runs, so
+addresses that can't have changed are skipped without asking the API.
+(default: the data file name with ".state" appended)
+'''
+    program_no_state_help = '''Don't read or write the run-state journal,
+check every address from scratch.
+'''
+    program_confirmations_help = '''Confirmations a deposit needs before it
+counts toward the balance and can be swept. (default: %(default)s)
+'''
+    program_max_interval_help = '''Longest time (in seconds) an address's
+balance goes unchecked. Below that, each address is checked about when
+its past inflow says it could reach its threshold.
+(default: %(default)s)
+'''
+    program_sample_rate_help = '''Share of the balance checks skipped that
+way which are done anyway, to catch unexpected deposits.
+(default: %(default)s)
+'''
+    program_checkpoint_help = '''Checkpoint log of the run's progress and
+of the sends it made, kept until every address has been dealt with
+without errors. (default: the data file name with ".checkpoint"
+appended)
+'''
+    program_resume_help = '''Continue the run that left the checkpoint log
+behind: addresses it finished are skipped, and an address whose send
+was cut short is checked for that send before it can send again.
+'''
+    program_output_help = '''How to report the result of each address as it
+completes: "text" prints a line per address, "jsonl" prints one JSON
+object per line (status, tx hash, amounts, fees, timings and errors)
+for feeding into log pipelines. (default: %(default)s)
+'''
+    program_simulate_help = '''Backtest sweep configurations against a
+recorded history (a NumPy .npz file of deposits and prices, see
+sweepsim.load_history) instead of sweeping. Needs NumPy.
+'''
+    program_candidates_help = '''JSON file with the list of configurations
+to simulate, each an object with "name", "threshold" (in bitcoins),
+"duration" (ISO 8601), optionally "schedule" (a cron expression, UTC) and
+"destinations" (address: amount). Default: the distinct configurations
+in the data file.
+'''
+    program_timeout_help = '''Seconds a request may take before it is
+abandoned, either for every endpoint (SECONDS) or for one of them
+(ENDPOINT=SECONDS, e.g. rawaddr=30). Can be given more than once.
+Defaults: addressbalance 10, unspent 15, rawaddr 20, ticker 10,
+merchant (sends) 60, others 30.
+'''
+    program_deadline_help = '''Seconds the whole run may take. No request
+is started after the deadline and none may run past it. The addresses
+not done by then are reported as deferred (see --max-calls).
+'''
+    program_max_calls_help = '''Most API requests the whole run may make.
+Like with --deadline, addresses are worked on in the order of the value
+they are expected to sweep (according to the run-state journal), and
+the ones left when the budget is used up are reported as deferred.
+'''
+    program_no_hedge_help = '''Don't hedge slow read requests (by sending
+a duplicate once a request is slower than 95%% of its kind).
+'''
+    program_latency_report_help = '''Print the request latencies of each
+endpoint and the time taken per address at the end of the run.
+'''
+    program_provider_help = '''Where to read address data (balances,
+unspent outputs, histories, exchange rates) from: "blockchain.info",
+"blockstream", "mempool" or NAME=URL for any other Esplora API. Give it
+more than once to route each request to the fastest healthy provider,
+failing over to the others. Sends go through blockchain.info, or with
+--sign-locally to --pushtx-url. (default: blockchain.info)
+'''
+    program_sign_locally_help = '''Build and sign sweep transactions on this
+machine and broadcast only the signed transaction, instead of handing
+the private key to the blockchain.info wallet API.
+'''
+    program_pushtx_url_help = '''URL the signed transactions are POSTed to
+with --sign-locally (default: %(default)s)
+'''
+    program_record_help = '''Record every API request of the run and its
+response to the cassette file CASSETTE (gzipped JSON lines). Private
+keys and passwords in the requests are scrubbed.
+'''
+    program_replay_help = '''Answer the API requests of the run from the
+cassette file CASSETTE (see --record) instead of the network, to
+reproduce a recorded run offline. Nothing is sent.
+'''
+    program_replay_speed_help = '''How many times faster than recorded the
+replayed responses arrive, 0 for no waiting. (default: %(default)s)
+'''
+    program_concurrency_help = '''Number of addresses to work on at once.
+(default: %(default)s)
+'''
+    program_files_help = '''Sweep these watch files (or the files ending in
+".dat" in these directories) in one run instead of --file. Give it more
+than once for more files. Each file is read with the config next to it
+(its name with ".config" appended) if there is one, otherwise with
+--config. Their addresses share one work queue (see --concurrency),
+one pool of kept-alive connections and one exchange rate cache, and
+their results are reported per file.
+'''
+    program_rate_limit_help = '''Most API requests per second, for the
+whole run.
+'''
+    program_fee_target_help = '''Work out sweep fees from the exact size of
+each transaction and the fee rate currently needed to be confirmed
+within this many blocks (for watches without a target of their own),
+instead of paying 10000 satoshis per started kB.
+'''
+    program_fee_url_help = '''Where --fee-target gets its fee estimates: an
+Esplora style /fee-estimates API. (default: %(default)s)
+'''
+    program_track_help = '''Follow every sweep sent until it confirms, in the
+background: sends are looked up in batches (more and more rarely while
+unconfirmed), their addresses aren't checked again until they confirm,
+a dropped send is forgotten so its address is swept again, and stuck
+sends are reported. Unconfirmed sends are kept in the data file name
+with ".tracker" appended, and followed up by the next run with --track.
+'''
+    program_stuck_after_help = '''Seconds after which an unconfirmed send is
+reported as stuck. (default: %(default)s)
+'''
+    program_ledger_help = '''SQLite ledger to add the outcome of every
+address to: decisions, amounts per destination, fees, tx hashes, timings
+and errors. --report reads it. (default for --report: the data file
+name with ".ledger" appended)
+'''
+    program_report_help = '''Report from the ledger instead of sweeping:
+"destinations" is what each destination received, "failures" the
+addresses that failed most often, "runs" the latest runs.
+'''
+    program_trace_help = '''Write trace spans of the run to this file, as
+JSON lines: a span for the run, one per address, and in those one per
+HTTP call, JSON decode, allocation and send, with their timings and
+attributes (endpoint, bytes, cache hits, the decision reached...).
+'''
+    program_trace_sample_help = '''The share (0 to 1) of the addresses to
+trace with --trace. (default: %(default)s)
+'''
+    program_since_help = '''Only report sweeps from this date (YYYY-MM-DD,
+UTC) on.
+'''
+    program_until_help = '''Only report sweeps before this date
+(YYYY-MM-DD, UTC).
+'''
+    program_shards_help = '''Split the watch list into this many shards
+by address and sweep them in parallel worker processes. Each shard is
+protected by a lease file, so overlapping runs (or other hosts sharing
+the lease directory) never sweep the same address twice.
+'''
+    program_shard_index_help = '''Comma separated list of the shard
+numbers this host should work on, for splitting a sharded run across
+hosts (default: all shards).
+'''
+    program_lease_dir_help = '''Directory holding the shard lease files.
+Hosts sharing the work on a data file need to share this directory.
+(default: the data file name with ".leases" appended)
+'''
+    program_lease_time_help = '''Number of seconds a shard lease is good
+for without being renewed. A crashed worker's shard can be taken over
+after this long. (default: %(default)s)
 '''
 
     try:
@@ -253,16 +731,295 @@ Warning: This will expose the private key of the watched addresses.
                             dest="add_destination",
                             action='store_true',
                             help=program_destination_help)
+        add_group.add_argument('-i',
+                            '--import',
+                            dest="import_file",
+                            metavar="FILE",
+                            help=program_import_help)
         parser.add_argument('-l',
                             '--list',
                             dest="list_addresses",
                             action='store_true',
                             help=program_list_help)
+        parser.add_argument('--format',
+                            dest="list_format",
+                            choices=["table", "json", "csv"],
+                            default="table",
+                            help=program_format_help)
+        parser.add_argument('--show-keys',
+                            dest="show_keys",
+                            action='store_true',
+                            help=program_show_keys_help)
+        parser.add_argument('--prefix',
+                            dest="prefix",
+                            help=program_prefix_help)
+        parser.add_argument('--to',
+                            dest="to_address",
+                            metavar="ADDRESS",
+                            help=program_to_help)
+        parser.add_argument('--min-threshold',
+                            dest="min_threshold",
+                            type=float,
+                            help=program_min_threshold_help)
+        parser.add_argument('--max-threshold',
+                            dest="max_threshold",
+                            type=float,
+                            help=program_max_threshold_help)
+        parser.add_argument('--due',
+                            dest="due",
+                            action='store_true',
+                            help=program_due_help)
+        parser.add_argument('--offset',
+                            dest="offset",
+                            type=int,
+                            default=0,
+                            help=program_offset_help)
+        parser.add_argument('--limit',
+                            dest="limit",
+                            type=int,
+                            help=program_limit_help)
+        parser.add_argument('--project',
+                            dest="project",
+                            action='store_true',
+                            help=program_project_help)
+        parser.add_argument('-m',
+                            '--monitor',
+                            dest="monitor",
+                            action='store_true',
+                            help=program_monitor_help)
+        parser.add_argument('--monitor-url',
+                            dest="monitor_url",
+                            default=BLOCKCHAIN_WS_URL,
+                            help=program_monitor_url_help)
+        parser.add_argument('--reload',
+                            dest="reload",
+                            type=float,
+                            metavar="SECONDS",
+                            help=program_reload_help)
+        parser.add_argument('-o',
+                            '--output',
+                            dest="output",
+                            choices=["text", "jsonl"],
+                            default="text",
+                            help=program_output_help)
+        parser.add_argument('--state',
+                            dest="state_file",
+                            help=program_state_help)
+        parser.add_argument('--no-state',
+                            dest="no_state",
+                            action='store_true',
+                            help=program_no_state_help)
+        parser.add_argument('--confirmations',
+                            dest="confirmations",
+                            type=int,
+                            default=6,
+                            help=program_confirmations_help)
+        parser.add_argument('--max-interval',
+                            dest="max_interval",
+                            type=float,
+                            default=24 * 3600,
+                            help=program_max_interval_help)
+        parser.add_argument('--sample-rate',
+                            dest="sample_rate",
+                            type=float,
+                            default=0.02,
+                            help=program_sample_rate_help)
+        parser.add_argument('--checkpoint',
+                            dest="checkpoint_file",
+                            help=program_checkpoint_help)
+        parser.add_argument('--resume',
+                            dest="resume",
+                            action='store_true',
+                            help=program_resume_help)
+        parser.add_argument('--simulate',
+                            dest="simulate",
+                            metavar="HISTORY",
+                            help=program_simulate_help)
+        parser.add_argument('--candidates',
+                            dest="candidates",
+                            help=program_candidates_help)
+        parser.add_argument('--timeout',
+                            dest="timeouts",
+                            action='append',
+                            metavar="[ENDPOINT=]SECONDS",
+                            help=program_timeout_help)
+        parser.add_argument('--deadline',
+                            dest="deadline",
+                            type=float,
+                            help=program_deadline_help)
+        parser.add_argument('--max-calls',
+                            dest="max_calls",
+                            type=int,
+                            help=program_max_calls_help)
+        parser.add_argument('--no-hedge',
+                            dest="no_hedge",
+                            action='store_true',
+                            help=program_no_hedge_help)
+        parser.add_argument('--latency-report',
+                            dest="latency_report",
+                            action='store_true',
+                            help=program_latency_report_help)
+        parser.add_argument('--provider',
+                            dest="providers",
+                            action='append',
+                            help=program_provider_help)
+        parser.add_argument('--sign-locally',
+                            dest="sign_locally",
+                            action='store_true',
+                            help=program_sign_locally_help)
+        parser.add_argument('--pushtx-url',
+                            dest="pushtx_url",
+                            default="https://blockchain.info/pushtx",
+                            help=program_pushtx_url_help)
+        parser.add_argument('--record',
+                            dest="record",
+                            metavar="CASSETTE",
+                            help=program_record_help)
+        parser.add_argument('--replay',
+                            dest="replay",
+                            metavar="CASSETTE",
+                            help=program_replay_help)
+        parser.add_argument('--replay-speed',
+                            dest="replay_speed",
+                            type=float,
+                            default=1.0,
+                            help=program_replay_speed_help)
+        parser.add_argument('--concurrency',
+                            dest="concurrency",
+                            type=int,
+                            default=1,
+                            help=program_concurrency_help)
+        parser.add_argument('--files',
+                            dest="files",
+                            action='append',
+                            metavar="PATH",
+                            help=program_files_help)
+        parser.add_argument('--rate-limit',
+                            dest="rate_limit",
+                            type=float,
+                            help=program_rate_limit_help)
+        parser.add_argument('--fee-target',
+                            dest="fee_target",
+                            type=int,
+                            metavar="BLOCKS",
+                            help=program_fee_target_help)
+        parser.add_argument('--fee-url',
+                            dest="fee_url",
+                            default=DEFAULT_FEE_URL,
+                            help=program_fee_url_help)
+        parser.add_argument('--track',
+                            dest="track",
+                            action='store_true',
+                            help=program_track_help)
+        parser.add_argument('--stuck-after',
+                            dest="stuck_after",
+                            type=float,
+                            default=3 * 3600,
+                            help=program_stuck_after_help)
+        parser.add_argument('--ledger',
+                            dest="ledger_file",
+                            metavar="FILE",
+                            help=program_ledger_help)
+        parser.add_argument('--report',
+                            dest="report",
+                            choices=REPORTS,
+                            help=program_report_help)
+        parser.add_argument('--trace',
+                            dest="trace_file",
+                            metavar="FILE",
+                            help=program_trace_help)
+        parser.add_argument('--trace-sample',
+                            dest="trace_sample",
+                            type=float,
+                            default=1.0,
+                            metavar="RATE",
+                            help=program_trace_sample_help)
+        parser.add_argument('--since',
+                            dest="since",
+                            metavar="DATE",
+                            help=program_since_help)
+        parser.add_argument('--until',
+                            dest="until",
+                            metavar="DATE",
+                            help=program_until_help)
+        parser.add_argument('--shards',
+                            dest="shards",
+                            type=int,
+                            default=0,
+                            help=program_shards_help)
+        parser.add_argument('--shard-index',
+                            dest="shard_index",
+                            help=program_shard_index_help)
+        parser.add_argument('--lease-dir',
+                            dest="lease_dir",
+                            help=program_lease_dir_help)
+        parser.add_argument('--lease-time',
+                            dest="lease_time",
+                            type=int,
+                            default=600,
+                            help=program_lease_time_help)
 
         # Process arguments
         args = parser.parse_args()
+        if args.record and args.replay:
+            parser.error("--record and --replay can't be used together")
+        if args.record and args.shards > 0:
+            # the worker processes can't share the cassette file
+            parser.error("--record can't be used with --shards")
+        if args.files and (args.shards > 0 or args.monitor):
+            parser.error("--files can't be used with --shards or --monitor")
+        if args.track and (args.files or args.shards > 0):
+            parser.error("--track can't be used with --files or --shards")
+        if args.reload and not args.monitor:
+            parser.error("--reload can only be used with --monitor")
+        if args.ledger_file and args.shards > 0:
+            # the worker processes only report their results as text
+            parser.error("--ledger can't be used with --shards")
+        if args.trace_file and args.shards > 0:
+            # the worker processes would write over each other's spans
+            parser.error("--trace can't be used with --shards")
+        if args.shard_index:
+            if args.shards < 1:
+                parser.error("--shard-index needs --shards")
+            try:
+                shard_index = [int(i) for i in args.shard_index.split(",")]
+            except ValueError:
+                parser.error("--shard-index is a list of shard numbers")
+            if [i for i in shard_index if not 0 <= i < args.shards]:
+                parser.error("--shard-index shards go from 0 to {0}".format(
+                                                            args.shards - 1))
 
         verbose = args.verbose
+        run_started = time.time()
+
+        for timeout in args.timeouts or []:
+            endpoint, _, seconds = timeout.rpartition("=")
+            sweepnet.set_timeout(float(seconds), endpoint or None)
+        if args.deadline:
+            sweepnet.set_run_deadline(args.deadline)
+        if args.max_calls is not None:
+            sweepnet.set_call_budget(args.max_calls)
+        if args.no_hedge:
+            sweepnet.set_hedging(False)
+        if args.rate_limit:
+            sweepnet.set_rate_limit(args.rate_limit)
+        set_confirmations(args.confirmations)
+        if args.fee_target:
+            set_fee_engine(FeeEngine(args.fee_target, args.fee_url))
+        if args.record:
+            sweepnet.start_recording(args.record)
+            # the cassette is only readable once it is closed
+            atexit.register(sweepnet.stop_cassette)
+        elif args.replay:
+            sweepnet.start_replay(args.replay, args.replay_speed)
+        if args.trace_file:
+            sweeptrace.start_tracing(args.trace_file, args.trace_sample)
+            atexit.register(sweeptrace.stop_tracing)
+
+        if args.report:
+            # the ledger isn't encrypted, no need for the pass phrase
+            _write_ledger_report(args)
+            return 0
 
         if verbose > 0:
             print "Verbose mode on"
@@ -306,6 +1063,22 @@ Warning: This will expose the private key of the watched addresses.
             _save_data(service_list, cfg, args.data_file)
             return 0
 
+        if args.import_file:
+            service = service_list.get(TxnServiceBlockChain().service_name)
+            if service is None:
+                service = TxnServiceBlockChain()
+                service_list[service.service_name] = service
+            imported, errors = import_watches(args.import_file,
+                                              service,
+                                              verbose=args.verbose)
+            if imported:
+                _save_data(service_list, cfg, args.data_file)
+            for line, error in sorted(errors.iteritems()):
+                print "Line {0}: {1}".format(line, error)
+            print "Imported {0} watches, {1} bad rows".format(imported,
+                                                             len(errors))
+            return 1 if errors else 0
+
         if args.add_destination:
             service = {}
             if not service_list:
@@ -323,15 +1096,211 @@ Warning: This will expose the private key of the watched addresses.
             return 0
 
         if args.list_addresses:
-            for service in service_list.itervalues():
-                service.write_info("", verbose)
+            state = None
+            if args.due and not args.no_state:
+                state = RunState(args.state_file or
+                                 args.data_file + ".state")
+            satoshis = lambda btc: None if btc is None \
+                                   else long(round(btc * 1e8))
+            list_watches(service_list,
+                         sys.stdout,
+                         args.list_format,
+                         show_keys=args.show_keys,
+                         offset=args.offset,
+                         limit=args.limit,
+                         prefix=args.prefix,
+                         destination=args.to_address,
+                         min_threshold=satoshis(args.min_threshold),
+                         max_threshold=satoshis(args.max_threshold),
+                         due=args.due,
+                         state=state)
+            return 0
+
+        if args.project:
+            _write_projection(service_list, args)
+            return 0
+
+        if args.simulate:
+            _simulate(service_list, args.simulate, args.candidates,
+                      args.output)
+            return 0
+
+        state = None
+        if not args.no_state:
+            state = RunState(args.state_file or args.data_file + ".state",
+                             args.max_interval,
+                             args.sample_rate)
+
+        provider = None
+        if args.providers:
+            providers = [make_provider(p) for p in args.providers]
+            if len(providers) > 1:
+                provider = ProviderRouter(providers)
+            else:
+                provider = providers[0]
+
+        engine = None
+        if args.sign_locally:
+            engine = LocalTxEngine(args.pushtx_url)
+
+        tracker = None
+        if args.track:
+            tracker = ConfirmationTracker(args.data_file + ".tracker",
+                                          state,
+                                          args.stuck_after)
+            tracker.start(args.verbose)
+
+        ledger = None
+        if args.ledger_file:
+            ledger = SweepLedger(args.ledger_file)
+
+        if args.files:
+            return _sweep_files(args, passphrase, provider, engine, ledger)
+
+        if args.monitor:
+            # runs until interrupted
+            on_result = None
+            if args.output == "jsonl":
+                on_result = _write_record
+            monitor = AddressMonitor(service_list,
+                                     args.monitor_url,
+                                     on_result=on_result,
+                                     state=state,
+                                     provider=provider,
+                                     engine=engine,
+                                     verbose=args.verbose,
+                                     tracker=tracker,
+                                     ledger=ledger)
+            if ledger is not None:
+                ledger.start_run(args.data_file)
+            reloader = None
+            if args.reload:
+                index = DestinationIndex(service_list)
+
+                def on_change(added, removed, changed):
+                    # a changed watch may be due a sweep now
+                    monitor.watches_changed([a for s, a in added + changed],
+                                            [a for s, a in removed])
+                    touched = index.apply(added, removed, changed)
+                    if args.verbose:
+                        for destination in sorted(touched):
+                            paying = index.watches(destination)
+                            print "Destination {0}: paid by {1} " \
+                                  "watches".format(destination, len(paying))
+                reloader = WatchFileReloader(service_list,
+                                             args.data_file,
+                                             cfg,
+                                             on_change)
+                reloader.start(args.reload, args.verbose)
+            try:
+                monitor.run()
+            finally:
+                if reloader is not None:
+                    reloader.stop()
+                if tracker is not None:
+                    tracker.stop()
+                if ledger is not None:
+                    ledger.close()
+            return 0
+
+        if args.shards > 0:
+            # process the data file in parallel, one shard per worker
+            lease_dir = args.lease_dir or args.data_file + ".leases"
+            shards = None
+            if args.shard_index:
+                shards = [int(i) for i in args.shard_index.split(",")]
+            results, errors = run_sharded(service_list,
+                                          args.shards,
+                                          lease_dir,
+                                          shards=shards,
+                                          lease_time=args.lease_time,
+                                          state=state,
+                                          provider=provider,
+                                          engine=engine,
+                                          verbose=args.verbose)
+            if state is not None:
+                state.save()
+            for service_name, r in results.iteritems():
+                for address, record in sorted(r.iteritems()):
+                    if args.output == "jsonl":
+                        _write_record(record)
+                    else:
+                        print "Send from {0} results in {1}".format(
+                                                    address, record['result'])
+            for shard, error in sorted(errors.iteritems()):
+                if args.output == "jsonl":
+                    _write_record({'shard': shard,
+                                   'status': "skipped",
+                                   'result': error})
+                else:
+                    print "Shard {0} skipped: {1}".format(shard, error)
             return 0
 
         # process the data file
-        for service in service_list.itervalues():
-            r = service.process_transactions(args.verbose)
-            for address, result in r.iteritems():
-                print "Send from {0} results in {1}".format(address, result)
+        checkpoint = RunCheckpoint(args.checkpoint_file or
+                                   args.data_file + ".checkpoint",
+                                   args.resume)
+        if checkpoint.completed and args.output == "text":
+            print "Resuming: {0} addresses already done".format(
+                                                    len(checkpoint.completed))
+        address_times = []
+        complete = False
+        if ledger is not None:
+            ledger.start_run(args.data_file)
+        run_span = sweeptrace.span("run", root=True,
+                                   data_file=args.data_file,
+                                   concurrency=args.concurrency)
+        deferred = []
+        try:
+            failed = 0
+            with run_span:
+                for service in service_list.itervalues():
+                    records = service.iter_transactions(args.verbose,
+                                                        state=state,
+                                                        provider=provider,
+                                                        engine=engine,
+                                                        checkpoint=checkpoint,
+                                                        concurrency=
+                                                        args.concurrency)
+                    for record in records:
+                        address_times.append(record['elapsed'])
+                        run_span.add(record['status'])
+                        if record['status'] == "error":
+                            failed += 1
+                        elif record['status'] == "deferred":
+                            deferred.append(record['address'])
+                        if record['status'] == "sent" and tracker is not None:
+                            tracker.add(record['address'], record['tx_hash'])
+                        if ledger is not None:
+                            ledger.add(record)
+                        if args.output == "jsonl":
+                            _write_record(record)
+                        else:
+                            print "Send from {0} results in {1}".format(
+                                                    record['address'],
+                                                    record['result'])
+                            _write_fee(record)
+                            sys.stdout.flush()
+            # keep the log while there are addresses to retry
+            complete = not (failed or deferred)
+        finally:
+            if tracker is not None:
+                # it feeds the journal, so it stops first
+                tracker.stop()
+            checkpoint.close(complete)
+            if state is not None:
+                state.save()
+            if ledger is not None:
+                ledger.close()
+        if deferred and args.output == "text":
+            print "{0} addresses deferred to the next run, the run's " \
+                  "budget was used up".format(len(deferred))
+        if tracker is not None:
+            _write_tracking_report(tracker, args.output)
+        if args.latency_report:
+            _write_latency_report(address_times,
+                                  time.time() - run_started,
+                                  args.deadline)
 
         return 0
     except KeyboardInterrupt:
@@ -0,0 +1,249 @@
+"""
+sweepfees - works out sweep fees from the size of the transaction and
+the fee rate the network currently asks for
+
+estimate_fee() in sweepblockchain guesses 180 bytes an input and pays
+10000 satoshis a started kB, whatever the network is doing. A FeeEngine
+instead
+- works out the size of the sweep exactly from its script types: a
+  P2PKH input is 148 bytes with a compressed public key and 180 with
+  an uncompressed one (counting the largest low-S signature), and an
+  output is 31 to 43 bytes depending on the destination's address type
+- asks an Esplora style /fee-estimates API (confirmation target in
+  blocks => satoshis per vbyte) what rate gets a transaction confirmed
+  within the target, keeping the answer for ``ttl`` seconds for all
+  the sends of the run
+
+Each watch can have its own target (SweepAddressInfo's
+confirmation_target), the engine's target is used for the rest.
+
+If the estimates can't be fetched the quote has no fees, and the old
+estimate_fee() is used instead, so a sweep is never held up by the fee
+API.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import json
+import math
+import time
+import threading
+
+from sweepkeys import decode_wif, decode_address, P2SH_VERSION
+import sweepnet
+import sweeptrace
+
+__all__ = ["FeeEngine", "transaction_size", "set_fee_engine", "fee_engine"]
+
+DEFAULT_FEE_URL = "https://blockstream.info/api/fee-estimates"
+# the lowest rate nodes relay, in satoshis per vbyte
+MINIMUM_RATE = 1.0
+
+# outpoint (36) + script length (1) + sequence (4), and the script: a
+# push of the signature (1 + 71 + sighash 1) and of the public key
+_INPUT_BASE = 36 + 1 + 4 + 1 + 71 + 1
+COMPRESSED_INPUT_SIZE = _INPUT_BASE + 1 + 33
+UNCOMPRESSED_INPUT_SIZE = _INPUT_BASE + 1 + 65
+# value (8) + script length (1) + script
+P2PKH_OUTPUT_SIZE = 8 + 1 + 25
+P2SH_OUTPUT_SIZE = 8 + 1 + 23
+P2WPKH_OUTPUT_SIZE = 8 + 1 + 22
+P2WSH_OUTPUT_SIZE = 8 + 1 + 34
+# version (4) + lock time (4)
+HEADER_SIZE = 4 + 4
+
+_engine = None
+
+
+def _varint_size(n):
+    if n < 0xFD:
+        return 1
+    if n <= 0xFFFF:
+        return 3
+    return 5
+
+
+def output_size(address):
+    """
+    The size in bytes of an output paying ``address``.
+
+    >>> output_size("1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMH")
+    34
+    >>> output_size("3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy")
+    32
+    >>> output_size("bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4")
+    31
+
+    """
+    address = address.strip()
+    if address.lower().startswith("bc1"):
+        # a 20 byte witness program is a P2WPKH, anything else as big
+        # as a P2WSH (or P2TR) output
+        if len(address) == 42:
+            return P2WPKH_OUTPUT_SIZE
+        return P2WSH_OUTPUT_SIZE
+    try:
+        version, h = decode_address(address)
+    except ValueError:
+        # don't know, so pay for the largest
+        return P2WSH_OUTPUT_SIZE
+    if version == P2SH_VERSION:
+        return P2SH_OUTPUT_SIZE
+    return P2PKH_OUTPUT_SIZE
+
+
+def transaction_size(input_count, destinations, compressed=True):
+    """
+    The size in bytes of a sweep spending ``input_count`` P2PKH
+    outputs to the addresses ``destinations``, signed with a
+    ``compressed`` (or not) key.
+
+    >>> transaction_size(1, ["3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy"])
+    190
+    >>> transaction_size(2, ["1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMH"], False)
+    404
+
+    """
+    input_size = COMPRESSED_INPUT_SIZE if compressed \
+                 else UNCOMPRESSED_INPUT_SIZE
+    return HEADER_SIZE + \
+           _varint_size(input_count) + input_count * input_size + \
+           _varint_size(len(destinations)) + \
+           sum(output_size(d) for d in destinations)
+
+
+def _compressed(private_key):
+    """
+    Does ``private_key`` sign with a compressed public key? Hex keys
+    don't say, so they count as uncompressed (the larger).
+
+    """
+    try:
+        return decode_wif(private_key)[1]
+    except ValueError:
+        return False
+
+
+class FeeEngine(object):
+    """
+    Works out the fees of sweeps, see the module docstring.
+
+    """
+
+    def __init__(self, target=6, url=DEFAULT_FEE_URL, ttl=60,
+                 minimum_rate=MINIMUM_RATE):
+        """
+        Constructor
+        ``target`` is the number of blocks a sweep should be confirmed
+        within (unless its watch has its own), ``url`` the fee estimate
+        API, whose answer is reused for ``ttl`` seconds. No rate below
+        ``minimum_rate`` (satoshis per vbyte) is used.
+
+        """
+        self.target = target
+        self.url = url
+        self.ttl = ttl
+        self.minimum_rate = minimum_rate
+        self.lock = threading.Lock()
+        self._estimates = None
+        self._fetched = 0
+
+    def estimates(self, verbose=False):
+        """
+        The fee estimates, as a dictionary of target (in blocks) =>
+        satoshis per vbyte, reused for ``self.ttl`` seconds.
+
+        The return is a tuple: (estimates, errors)
+
+        """
+        with self.lock:
+            if self._estimates is not None and \
+                    time.time() - self._fetched < self.ttl:
+                sweeptrace.current().add('cache_hits')
+                return (self._estimates, {})
+        sweeptrace.current().add('cache_misses')
+        if verbose:
+            print "Fetching URL={0}".format(self.url)
+        content, errors = sweepnet.fetch(self.url)
+        if errors:
+            return (None, errors)
+        try:
+            estimates = dict((int(k), float(v))
+                             for k, v in json.loads(content).iteritems())
+        except (ValueError, AttributeError) as e:
+            return (None, {self.url: "Bad fee estimates - {0}".format(e)})
+        if not estimates:
+            return (None, {self.url: "No fee estimates"})
+        with self.lock:
+            self._estimates = estimates
+            self._fetched = time.time()
+        return (estimates, {})
+
+    def rate_for(self, target, verbose=False):
+        """
+        The fee rate (satoshis per vbyte) to be confirmed within
+        ``target`` blocks: the estimate for the nearest target at or
+        below it (or the shortest there is).
+
+        The return is a tuple: (rate, errors)
+
+        """
+        estimates, errors = self.estimates(verbose)
+        if errors:
+            return (None, errors)
+        shorter = [t for t in estimates if t <= target]
+        key = max(shorter) if shorter else min(estimates)
+        return (max(estimates[key], self.minimum_rate), {})
+
+    def quote(self, address_info, input_count, verbose=False):
+        """
+        Work out the fees for sweeping ``input_count`` outputs of
+        ``address_info`` (a SweepAddressInfo) to its destinations.
+
+        Returns a dictionary of
+        - fees: in satoshis, None if the fee estimates couldn't be
+          fetched
+        - rate: satoshis per vbyte (None without estimates)
+        - target: the confirmation target, in blocks
+        - size: the transaction size, in bytes
+        - errors: why there are no fees
+
+        """
+        target = getattr(address_info, 'confirmation_target', None) or \
+                 self.target
+        size = transaction_size(input_count,
+                                address_info.destinations.keys(),
+                                _compressed(address_info.private_key))
+        rate, errors = self.rate_for(target, verbose)
+        if errors:
+            return {'fees': None,
+                    'rate': None,
+                    'target': target,
+                    'size': size,
+                    'errors': errors}
+        fees = long(math.ceil(size * rate))
+        if verbose:
+            print "Fee {0} satoshis: {1} bytes at {2} sat/vB to confirm " \
+                  "within {3} blocks".format(fees, size, rate, target)
+        return {'fees': fees,
+                'rate': rate,
+                'target': target,
+                'size': size,
+                'errors': {}}
+
+
+def set_fee_engine(engine):
+    """Use the FeeEngine ``engine`` for every sweep (None for the old fees)."""
+    global _engine
+    _engine = engine
+
+
+def fee_engine():
+    """The FeeEngine in use, or None."""
+    return _engine
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
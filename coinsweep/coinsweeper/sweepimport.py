@@ -0,0 +1,244 @@
+"""
+sweepimport - bulk, non-interactive import of watched addresses
+
+Reads watches from a CSV file (with a header row) or a JSONL file (one
+JSON object per line), each with the fields
+- address: the address to watch
+- key: its private key (WIF, or hex)
+- threshold: minimum balance to sweep, in bitcoins
+- duration: ISO 8601 duration between sweeps (default P1D)
+- schedule: a cron schedule of the sweeps, instead of the duration
+  (optional, see sweepschedule)
+- destinations: in CSV "ADDRESS=AMOUNT;ADDRESS=AMOUNT", in JSONL either
+  that string or an object of address => amount, where the amounts are
+  the send_amount strings of SweepAddressInfo
+- target: blocks its sweeps should be confirmed within (optional)
+
+Rows are read as a stream and checked in batches. Addresses are
+checked with base58check, remembering the outcome since the same few
+destinations tend to appear on every row. Keys are decoded and their
+public keys derived a batch at a time (see sweepsign.public_keys) to
+make sure each key belongs to its address. Bad rows are reported and
+left out, the rest are added to the service's watch list; saving it
+(once) is up to the caller.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import csv
+import json
+
+from sweepaddress import SweepAddressInfo, parse_send_amount
+from sweepkeys import decode_address, decode_wif, address_from_pubkey, \
+                      script_for_address
+from sweepsign import public_keys
+from sweepschedule import compile_schedule
+
+__all__ = ["import_watches"]
+
+BATCH_SIZE = 1000
+
+
+def _rows(file_, errors):
+    """
+    Yield (line number, row dictionary) for each row of ``file_``,
+    putting rows that can't be read in ``errors``.
+
+    """
+    with open(file_) as f:
+        if file_.endswith((".jsonl", ".json")):
+            for line, text in enumerate(f, 1):
+                if not text.strip():
+                    continue
+                try:
+                    row = json.loads(text)
+                except ValueError as e:
+                    errors[line] = "Not JSON: {0}".format(e)
+                    continue
+                if not isinstance(row, dict):
+                    errors[line] = "Not a JSON object"
+                    continue
+                yield (line, row)
+        else:
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield (reader.line_num, row)
+
+
+def _check_address(address, cache, destination=False):
+    """
+    Return why ``address`` is bad (None if it is good), cached. A
+    ``destination`` may also be a segwit address.
+
+    """
+    key = (address, destination)
+    if key not in cache:
+        try:
+            if destination:
+                script_for_address(address)
+            else:
+                decode_address(address)
+            cache[key] = None
+        except ValueError as e:
+            cache[key] = str(e)
+    return cache[key]
+
+
+def _destinations(value):
+    """The destinations field as a dictionary of address => amount."""
+    if isinstance(value, dict):
+        return dict((k.strip(), unicode(v).strip())
+                    for k, v in value.iteritems())
+    destinations = {}
+    for part in (value or "").split(";"):
+        if part.strip():
+            address, _, amount = part.partition("=")
+            destinations[address.strip()] = amount.strip()
+    return destinations
+
+
+def _parse_row(row, cache):
+    """
+    Check a row and make its SweepAddressInfo.
+
+    The return is a tuple: (watch, secret, compressed, hex_key)
+    Raises ValueError with the reason for a bad row.
+
+    """
+    address = str(row.get('address') or "").strip()
+    key = str(row.get('key') or "").strip()
+    if not address:
+        raise ValueError("No address")
+    reason = _check_address(address, cache)
+    if reason:
+        raise ValueError("Bad address: {0}".format(reason))
+    if not key:
+        raise ValueError("No private key")
+    try:
+        secret, compressed = decode_wif(key)
+    except ValueError as e:
+        raise ValueError("Bad private key: {0}".format(e))
+
+    watch = SweepAddressInfo()
+    watch.address = address
+    watch.private_key = key
+    try:
+        watch.balance_threshold = long(round(float(row.get('threshold'))
+                                             * 1e8))
+    except (TypeError, ValueError):
+        raise ValueError("Bad threshold {0!r}".format(row.get('threshold')))
+    duration = str(row.get('duration') or "").strip()
+    if duration:
+        watch.time_threshold.duration = duration
+    # read the way a run reads it (see TimeThreshold.next_allowed)
+    try:
+        compile_schedule(watch.time_threshold.duration)
+    except ValueError:
+        raise ValueError("Bad duration {0!r}".format(duration))
+    schedule = str(row.get('schedule') or "").strip()
+    if schedule:
+        try:
+            compile_schedule(schedule)
+        except ValueError as e:
+            raise ValueError("Bad schedule {0!r}: {1}".format(schedule, e))
+        watch.time_threshold.schedule = schedule
+
+    target = str(row.get('target') or "").strip()
+    if target:
+        try:
+            watch.confirmation_target = int(target)
+            if watch.confirmation_target < 1:
+                raise ValueError
+        except ValueError:
+            raise ValueError("Bad target {0!r}".format(target))
+
+    destinations = _destinations(row.get('destinations'))
+    if not destinations:
+        raise ValueError("No destinations")
+    for send_address, amount in destinations.iteritems():
+        reason = _check_address(send_address, cache, destination=True)
+        if reason:
+            raise ValueError("Bad destination {0}: {1}".format(send_address,
+                                                               reason))
+        try:
+            parse_send_amount(str(amount))
+        except (ValueError, IndexError):
+            raise ValueError("Bad amount {0!r} for {1}".format(amount,
+                                                               send_address))
+        watch.destinations[str(send_address)] = str(amount)
+    return (watch, secret, compressed, len(key) == 64)
+
+
+def _import_batch(batch, service, cache, errors):
+    """Check a batch of rows and add the good ones to ``service``."""
+    candidates = []
+    for line, row in batch:
+        try:
+            watch, secret, compressed, hex_key = _parse_row(row, cache)
+        except ValueError as e:
+            errors[line] = str(e)
+            continue
+        if watch.address in service.watch_list:
+            errors[line] = "{0} is already watched".format(watch.address)
+            continue
+        candidates.append((line, watch, secret, compressed, hex_key))
+
+    def add(line, watch):
+        # the same address can come up twice in a batch
+        if watch.address in service.watch_list:
+            errors[line] = "{0} is already watched".format(watch.address)
+            return 0
+        service.watch_list[watch.address] = watch
+        return 1
+
+    imported = 0
+    retry = []
+    keys = public_keys([c[2] for c in candidates], [c[3] for c in candidates])
+    for (line, watch, secret, compressed, hex_key), pubkey in zip(candidates,
+                                                                  keys):
+        if address_from_pubkey(pubkey) == watch.address:
+            imported += add(line, watch)
+        elif hex_key:
+            # a hex key doesn't say which form its address uses
+            retry.append((line, watch, secret, not compressed))
+        else:
+            errors[line] = "Private key is not the key of {0}".format(
+                                                                watch.address)
+    keys = public_keys([r[2] for r in retry], [r[3] for r in retry])
+    for (line, watch, secret, compressed), pubkey in zip(retry, keys):
+        if address_from_pubkey(pubkey) == watch.address:
+            imported += add(line, watch)
+        else:
+            errors[line] = "Private key is not the key of {0}".format(
+                                                                watch.address)
+    return imported
+
+
+def import_watches(file_, service, batch_size=BATCH_SIZE, verbose=False):
+    """
+    Add the watches in ``file_`` (see the module docstring) to the
+    watch list of ``service`` (a TxnServiceBlockChain).
+
+    Rows for addresses that are already watched count as bad rows, as
+    does a second row for the same address.
+
+    The return is a tuple: (imported, errors), where
+    imported is the number of watches added
+    errors is a dictionary of line number => why the row was left out.
+
+    """
+    imported = 0
+    errors = {}
+    cache = {}
+    batch = []
+    for line, row in _rows(file_, errors):
+        batch.append((line, row))
+        if len(batch) >= batch_size:
+            imported += _import_batch(batch, service, cache, errors)
+            batch = []
+            if verbose:
+                print "Imported {0} watches so far".format(imported)
+    if batch:
+        imported += _import_batch(batch, service, cache, errors)
+    return (imported, errors)
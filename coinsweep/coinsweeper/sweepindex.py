@@ -0,0 +1,269 @@
+"""
+sweepindex - defines DestinationIndex class
+
+A watch knows where it sends (SweepAddressInfo.destinations), but not
+the other way round: which watches pay into a cold wallet, and what it
+will get from them, took reading every watch and its send_amount
+strings. DestinationIndex turns the watch list around, once:
+destination => the watches paying it, each with its rule, the
+send_amounts already read by parse_send_amount.
+
+The index keeps up with the watch list a watch at a time: apply()
+takes the changes a WatchFileReloader reports (it can be the reloader's
+on_change), and only the watches named are read again.
+
+project() estimates what each destination gets from the next run, from
+what the run-state journal knows of each watch (the balance it expects,
+the last send, a send still unconfirmed) and an exchange rate for the
+dollar amounts. A watch the journal knows nothing about can't be
+estimated, and is counted as unknown. Fees are estimated for one
+unspent output, so the amounts are a little high for addresses with
+many.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import time
+
+from sweepaddress import parse_send_amount
+from sweepblockchain import estimate_fee
+
+__all__ = ["DestinationIndex"]
+
+
+# send_amount => (kind, value), most watches use the same few
+_amounts = {}
+
+
+def _compile(watch):
+    """
+    The rule of ``watch``: a list of (destination, kind, value), see
+    parse_send_amount, or None if a send_amount can't be read (the
+    sweep would fail).
+
+    """
+    rules = []
+    for destination, amount in watch.destinations.iteritems():
+        parsed = _amounts.get(amount)
+        if parsed is None:
+            try:
+                parsed = _amounts[amount] = parse_send_amount(amount)
+            except (ValueError, IndexError):
+                return None
+        rules.append((destination,) + parsed)
+    return rules
+
+
+def _payouts(rules, balance, rate):
+    """
+    What each destination of ``rules`` gets of ``balance`` (satoshis,
+    after fees), the way TxnServiceBlockChain.build_transaction splits
+    it, at ``rate`` dollars to the bitcoin. Returns None if the split
+    can't be made (the rule asks for more than there is, there is
+    nowhere for the rest to go, or it needs a rate that isn't known).
+
+    >>> _payouts([("a", "percent", 50.0), ("b", "balance", 0)], 1000, None)
+    {'a': 500L, 'b': 500L}
+    >>> _payouts([("a", "dollars", 10.0), ("b", "balance", 0)], 10 ** 8,
+    ...          20.0)
+    {'a': 50000000L, 'b': 50000000L}
+    >>> _payouts([("a", "satoshis", 2000L)], 1000, None) is None
+    True
+
+    """
+    data = {}
+    left = balance
+    rest = []
+    for destination, kind, value in rules:
+        if kind == "percent":
+            amount = long((balance * value) / 100)
+        elif kind == "dollars":
+            if not rate:
+                return None
+            amount = long(value / rate * 1e8)
+        elif kind == "balance":
+            rest.append(destination)
+            continue
+        else:
+            amount = value
+        data[destination] = amount
+        left -= amount
+    if left < 0:
+        return None
+    if rest:
+        for destination in rest:
+            data[destination] = left / len(rest)
+    elif left > 0:
+        return None
+    return data
+
+
+class DestinationIndex(object):
+    """
+    The watches of a service list by destination, see the module
+    docstring.
+
+    ``self.sources`` is a dictionary of destination =>
+    {(service name, address): rule}, and ``self.rules`` one of
+    (service name, address) => (watch, rule), where a rule is as
+    _compile() gives it.
+
+    """
+
+    def __init__(self, service_list):
+        """
+        Constructor
+        Indexes ``service_list`` (service name => service), which apply()
+        reads the changed watches from.
+
+        """
+        self.service_list = service_list
+        self.sources = {}
+        self.rules = {}
+        for name, service in service_list.iteritems():
+            for address, watch in service.watch_list.iteritems():
+                self._add((name, address), watch)
+
+    def _add(self, key, watch):
+        rule = _compile(watch)
+        self.rules[key] = (watch, rule)
+        for destination in watch.destinations:
+            self.sources.setdefault(destination, {})[key] = rule
+
+    def _remove(self, key):
+        watch, rule = self.rules.pop(key, (None, None))
+        if watch is None:
+            return
+        for destination in watch.destinations:
+            sources = self.sources.get(destination, {})
+            sources.pop(key, None)
+            if not sources:
+                self.sources.pop(destination, None)
+
+    def apply(self, added=(), removed=(), changed=()):
+        """
+        Take up changes to the service list, each a list of (service
+        name, address) as WatchFileReloader's on_change gets them.
+        Returns the destinations whose watches changed.
+
+        >>> from sweepaddress import SweepAddressInfo
+        >>> from sweepblockchain import TxnServiceBlockChain
+        >>> def watch(address, destinations):
+        ...     w = SweepAddressInfo()
+        ...     w.address = address
+        ...     w.destinations = destinations
+        ...     return w
+        >>> service = TxnServiceBlockChain()
+        >>> service.watch_list = {"1A": watch("1A", {"1Cold": "0"}),
+        ...                       "1B": watch("1B", {"1Cold": "0"})}
+        >>> index = DestinationIndex({"test": service})
+        >>> index.watches("1Cold")
+        [('test', '1A'), ('test', '1B')]
+        >>> service.watch_list["1C"] = watch("1C", {"1Cold": "50%",
+        ...                                         "1Hot": "0"})
+        >>> del service.watch_list["1A"]
+        >>> service.watch_list["1B"] = watch("1B", {"1Vault": "0"})
+        >>> sorted(index.apply(added=[("test", "1C")],
+        ...                    removed=[("test", "1A")],
+        ...                    changed=[("test", "1B")]))
+        ['1Cold', '1Hot', '1Vault']
+        >>> index.watches("1Cold"), index.watches("1Hot")
+        ([('test', '1C')], [('test', '1C')])
+        >>> index.watches("1Vault")
+        [('test', '1B')]
+        >>> index.project(None)["1Cold"]['unknown']
+        1
+
+        """
+        touched = set()
+        for key in list(removed) + list(changed):
+            watch = self.rules.get(key, (None, None))[0]
+            if watch is not None:
+                touched.update(watch.destinations)
+        for key in list(removed) + list(changed):
+            self._remove(key)
+        for name, address in list(added) + list(changed):
+            service = self.service_list.get(name)
+            watch = service and service.watch_list.get(address)
+            if watch is not None:
+                self._add((name, address), watch)
+                touched.update(watch.destinations)
+        return touched
+
+    def watches(self, destination):
+        """The (service name, address) of the watches paying ``destination``."""
+        return sorted(self.sources.get(destination, {}))
+
+    def _project_watch(self, watch, rule, state, rate, now):
+        """
+        What the watch pays each destination in a run at ``now``: a
+        dictionary (empty if it won't send), or None if that can't be
+        told.
+
+        """
+        entry = state.get(watch) if state is not None else None
+        if entry is None or rule is None:
+            return None
+        if entry.get('next_change') is not None and now < entry['next_change']:
+            return {}
+        if entry.get('pending_tx') and now < entry.get('pending_until', 0):
+            return {}
+        balance = long(state.expected_balance(entry, now))
+        if balance <= watch.balance_threshold:
+            return {}
+        if entry.get('last_send') is not None:
+            opens = watch.time_threshold.next_allowed(entry['last_send'])
+            if opens is None or now < opens:
+                return {}
+        fees = estimate_fee(1, len(rule))
+        return _payouts(rule, balance - fees, rate)
+
+    def project(self, state, rate=None, destination=None, now=None):
+        """
+        Estimate what each destination (only ``destination``, if given)
+        gets from a run at ``now`` (seconds since the epoch, default
+        now), see the module docstring. ``state`` is the RunState
+        journal and ``rate`` the dollars to the bitcoin (None if it
+        isn't known, and then watches sending dollar amounts are
+        unknown).
+
+        The return is a dictionary of destination => {'amount':
+        satoshis, 'watches': watches paying it, 'sending': of those,
+        how many are expected to send, 'unknown': how many can't be
+        estimated}.
+
+        """
+        now = now or time.time()
+        if destination is not None:
+            keys = self.sources.get(destination, {})
+            destinations = [destination] if keys else []
+        else:
+            keys = self.rules
+            destinations = self.sources
+        amounts, sending, unknown = {}, {}, {}
+        for key in keys:
+            watch, rule = self.rules[key]
+            payouts = self._project_watch(watch, rule, state, rate, now)
+            if payouts is None:
+                for paid in watch.destinations:
+                    unknown[paid] = unknown.get(paid, 0) + 1
+            elif payouts:
+                for paid, amount in payouts.iteritems():
+                    amounts[paid] = amounts.get(paid, 0L) + amount
+                    sending[paid] = sending.get(paid, 0) + 1
+        return dict((paid, {'amount': amounts.get(paid, 0L),
+                            'watches': len(self.sources[paid]),
+                            'sending': sending.get(paid, 0),
+                            'unknown': unknown.get(paid, 0)})
+                    for paid in destinations)
+
+    def needs_rate(self):
+        """Whether any watch sends a dollar amount."""
+        return any(rule and any(kind == "dollars" for _, kind, _ in rule)
+                   for _, rule in self.rules.itervalues())
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
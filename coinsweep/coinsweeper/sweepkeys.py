@@ -0,0 +1,391 @@
+"""
+sweepkeys - bitcoin address and key encodings
+
+Base58check, wallet import format (WIF) private keys, the standard
+(P2PKH and P2SH) addresses and segwit (bech32 and bech32m, BIP 173 and
+350) addresses, enough to check what a user typed in and to build and
+sign sweep transactions locally. Coins are only swept from P2PKH
+addresses, but can be sent to any of them.
+
+The examples in the docstrings are known test vectors; run this file
+to check them.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import struct
+import hashlib
+import binascii
+
+__all__ = ["b58encode", "b58decode", "b58check_encode", "b58check_decode",
+           "decode_wif", "encode_wif", "hash160", "decode_address",
+           "decode_segwit_address", "address_from_pubkey",
+           "script_for_address"]
+
+B58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+_B58_INDEX = dict((c, i) for i, c in enumerate(B58_ALPHABET))
+
+# address versions
+P2PKH_VERSION = 0
+P2SH_VERSION = 5
+WIF_VERSION = 128
+
+BECH32_ALPHABET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+_BECH32_INDEX = dict((c, i) for i, c in enumerate(BECH32_ALPHABET))
+# the checksum constants of bech32 (witness version 0) and bech32m
+_BECH32_CONST = 1
+_BECH32M_CONST = 0x2bc830a3
+SEGWIT_HRP = "bc"
+
+
+def _sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def b58encode(data):
+    """
+    Encode the string of bytes ``data`` as base58.
+
+    >>> b58encode("hello world")
+    'StV1DL6CwTryKyV'
+    >>> b58encode("\\x00\\x00\\x01")
+    '112'
+
+    """
+    n = long(binascii.hexlify(data), 16) if data else 0
+    chars = []
+    while n > 0:
+        n, r = divmod(n, 58)
+        chars.append(B58_ALPHABET[r])
+    pad = len(data) - len(data.lstrip("\x00"))
+    return "1" * pad + "".join(reversed(chars))
+
+
+def b58decode(s):
+    """
+    Decode base58 ``s`` into a string of bytes.
+    Raises ValueError on characters that aren't base58.
+
+    >>> b58decode("StV1DL6CwTryKyV")
+    'hello world'
+
+    """
+    n = 0
+    try:
+        for c in s:
+            n = n * 58 + _B58_INDEX[c]
+    except KeyError:
+        raise ValueError("Invalid base58 character {0!r}".format(c))
+    h = "{0:x}".format(n) if n else ""
+    if len(h) % 2:
+        h = "0" + h
+    pad = len(s) - len(s.lstrip("1"))
+    return "\x00" * pad + binascii.unhexlify(h)
+
+
+def b58check_encode(payload):
+    """Base58 encode ``payload`` with its 4 byte checksum appended."""
+    return b58encode(payload + _sha256d(payload)[:4])
+
+
+def b58check_decode(s):
+    """
+    Decode base58check ``s``, returning the payload (without checksum).
+    Raises ValueError if it isn't valid base58 or the checksum is wrong.
+
+    >>> binascii.hexlify(b58check_decode("1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMH"))
+    '00751e76e8199196d454941c45d1b3a323f1433bd6'
+    >>> b58check_decode("1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMh")
+    Traceback (most recent call last):
+    ...
+    ValueError: Bad base58check checksum
+
+    """
+    data = b58decode(s)
+    if len(data) < 5:
+        raise ValueError("Too short for base58check")
+    payload, checksum = data[:-4], data[-4:]
+    if _sha256d(payload)[:4] != checksum:
+        raise ValueError("Bad base58check checksum")
+    return payload
+
+
+def decode_wif(wif):
+    """
+    Decode a private key in wallet import format.
+
+    Plain 64 character hex keys are accepted too (as uncompressed keys).
+
+    The return is a tuple: (secret, compressed), where
+    secret is the private key as a long
+    compressed is True if the key's public key is used compressed.
+    Raises ValueError if it isn't a valid key.
+
+    >>> decode_wif("5HpHagT65TZzG1PH3CSu63k8DbpvD8s5ip4nEB3kEsreAnchuDf")
+    (1L, False)
+    >>> decode_wif("KwDiBf89QgGbjEhKnhXJuH7LrciVrZi3qYjgd9M7rFU73sVHnoWn")
+    (1L, True)
+
+    """
+    wif = wif.strip()
+    if len(wif) == 64:
+        try:
+            secret = long(wif, 16)
+        except ValueError:
+            pass
+        else:
+            return (_check_secret(secret), False)
+    payload = b58check_decode(wif)
+    if payload[0] != chr(WIF_VERSION):
+        raise ValueError("Not a mainnet private key")
+    if len(payload) == 34 and payload[-1] == "\x01":
+        compressed = True
+    elif len(payload) == 33:
+        compressed = False
+    else:
+        raise ValueError("Bad private key length")
+    secret = long(binascii.hexlify(payload[1:33]), 16)
+    return (_check_secret(secret), compressed)
+
+
+def _check_secret(secret):
+    # the order of the secp256k1 group
+    n = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+    if not 0 < secret < n:
+        raise ValueError("Private key out of range")
+    return secret
+
+
+def encode_wif(secret, compressed=True):
+    """
+    Encode the long ``secret`` in wallet import format.
+
+    >>> encode_wif(1)
+    'KwDiBf89QgGbjEhKnhXJuH7LrciVrZi3qYjgd9M7rFU73sVHnoWn'
+
+    """
+    payload = chr(WIF_VERSION) + binascii.unhexlify("{0:064x}".format(secret))
+    if compressed:
+        payload += "\x01"
+    return b58check_encode(payload)
+
+
+def hash160(data):
+    """RIPEMD160 of the SHA256 of ``data``."""
+    return _ripemd160(hashlib.sha256(data).digest())
+
+
+def _ripemd160(data):
+    try:
+        return hashlib.new('ripemd160', data).digest()
+    except ValueError:
+        # OpenSSL 3 leaves it out unless the legacy provider is loaded
+        return _ripemd160_py(data)
+
+
+# RIPEMD-160 message word order, rotations and constants, left and
+# right lines
+_RL = [range(16),
+       [7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14, 11, 8],
+       [3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12],
+       [1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15, 14, 5, 6, 2],
+       [4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13]]
+_RR = [[5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12],
+       [6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9, 1, 2],
+       [15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13],
+       [8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9, 7, 10, 14],
+       [12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11]]
+_SL = [[11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8],
+       [7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7, 13, 12],
+       [11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5],
+       [11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5, 6, 8, 6, 5, 12],
+       [9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6]]
+_SR = [[8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6],
+       [9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15, 13, 11],
+       [9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5],
+       [15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8],
+       [8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11]]
+_KL = [0x00000000, 0x5A827999, 0x6ED9EBA1, 0x8F1BBCDC, 0xA953FD4E]
+_KR = [0x50A28BE6, 0x5C4DD124, 0x6D703EF3, 0x7A6D76E9, 0x00000000]
+
+
+def _rmd_f(j, x, y, z):
+    if j == 0:
+        return x ^ y ^ z
+    if j == 1:
+        return (x & y) | (~x & z)
+    if j == 2:
+        return (x | ~y) ^ z
+    if j == 3:
+        return (x & z) | (y & ~z)
+    return x ^ (y | ~z)
+
+
+def _rol(x, n):
+    return ((x << n) | (x >> (32 - n))) & 0xFFFFFFFF
+
+
+def _ripemd160_py(data):
+    """
+    Plain Python RIPEMD-160, for when hashlib doesn't have it.
+
+    >>> binascii.hexlify(_ripemd160_py("abc"))
+    '8eb208f7e05d987a9b044a8e98c6b087f15a0bfc'
+
+    """
+    h = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476, 0xC3D2E1F0]
+    length = len(data)
+    data += "\x80" + "\x00" * ((55 - length) % 64) + \
+            struct.pack("<Q", length * 8)
+    for block in xrange(0, len(data), 64):
+        x = struct.unpack("<16L", data[block:block + 64])
+        al, bl, cl, dl, el = h
+        ar, br, cr, dr, er = h
+        for j in xrange(5):
+            for i in xrange(16):
+                t = _rol((al + _rmd_f(j, bl, cl, dl) + x[_RL[j][i]] +
+                          _KL[j]) & 0xFFFFFFFF, _SL[j][i])
+                t = (t + el) & 0xFFFFFFFF
+                al, el, dl, cl, bl = el, dl, _rol(cl, 10), bl, t
+                t = _rol((ar + _rmd_f(4 - j, br, cr, dr) + x[_RR[j][i]] +
+                          _KR[j]) & 0xFFFFFFFF, _SR[j][i])
+                t = (t + er) & 0xFFFFFFFF
+                ar, er, dr, cr, br = er, dr, _rol(cr, 10), br, t
+        t = (h[1] + cl + dr) & 0xFFFFFFFF
+        h[1] = (h[2] + dl + er) & 0xFFFFFFFF
+        h[2] = (h[3] + el + ar) & 0xFFFFFFFF
+        h[3] = (h[4] + al + br) & 0xFFFFFFFF
+        h[4] = (h[0] + bl + cr) & 0xFFFFFFFF
+        h[0] = t
+    return struct.pack("<5L", *h)
+
+
+def decode_address(address):
+    """
+    Decode a base58 address.
+
+    The return is a tuple: (version, hash), where
+    version is P2PKH_VERSION or P2SH_VERSION
+    hash is the 20 byte hash the address stands for.
+    Raises ValueError for anything else (segwit addresses are decoded
+    by decode_segwit_address).
+
+    >>> decode_address("3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy")[0]
+    5
+
+    """
+    payload = b58check_decode(address)
+    if len(payload) != 21:
+        raise ValueError("Bad address length")
+    version = ord(payload[0])
+    if version not in (P2PKH_VERSION, P2SH_VERSION):
+        raise ValueError("Unsupported address version {0}".format(version))
+    return (version, payload[1:])
+
+
+def _bech32_polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for v in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ v
+        for i in range(5):
+            if (top >> i) & 1:
+                chk ^= generator[i]
+    return chk
+
+
+def decode_segwit_address(address):
+    """
+    Decode a segwit (bech32 or bech32m) mainnet address.
+
+    The return is a tuple: (version, program), where
+    version is the witness version (0 to 16)
+    program is the witness program (the hash or key it pays).
+    Raises ValueError if it isn't a valid segwit address.
+
+    >>> v, p = decode_segwit_address(
+    ...     "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4")
+    >>> v, binascii.hexlify(p)
+    (0, '751e76e8199196d454941c45d1b3a323f1433bd6')
+
+    """
+    if address.lower() != address and address.upper() != address:
+        raise ValueError("Mixed case bech32 address")
+    address = address.lower()
+    hrp, _, data = address.rpartition("1")
+    if hrp != SEGWIT_HRP or len(data) < 7 or len(address) > 90:
+        raise ValueError("Not a bech32 address")
+    try:
+        values = [_BECH32_INDEX[c] for c in data]
+    except KeyError:
+        raise ValueError("Bad bech32 character")
+    expanded = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+    const = _bech32_polymod(expanded + values)
+    version = values[0]
+    if version > 16 or \
+            const != (_BECH32_CONST if version == 0 else _BECH32M_CONST):
+        raise ValueError("Bad bech32 checksum")
+    # regroup the 5 bit values (less the version and checksum) into bytes
+    acc = bits = 0
+    program = []
+    for v in values[1:-6]:
+        acc = (acc << 5) | v
+        bits += 5
+        if bits >= 8:
+            bits -= 8
+            program.append(chr((acc >> bits) & 0xff))
+    if bits >= 5 or (acc << (8 - bits)) & 0xff:
+        raise ValueError("Bad bech32 padding")
+    program = "".join(program)
+    if not 2 <= len(program) <= 40 or \
+            (version == 0 and len(program) not in (20, 32)):
+        raise ValueError("Bad witness program length")
+    return (version, program)
+
+
+def address_from_pubkey(pubkey):
+    """
+    Return the P2PKH address of the serialized public key ``pubkey``.
+
+    >>> g = binascii.unhexlify("0279be667ef9dcbbac55a06295ce870b07029bfcdb"
+    ...                        "2dce28d959f2815b16f81798")
+    >>> address_from_pubkey(g)
+    '1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMH'
+
+    """
+    return b58check_encode(chr(P2PKH_VERSION) + hash160(pubkey))
+
+
+def script_for_address(address):
+    """
+    Return the output script (scriptPubKey) paying to ``address``.
+
+    >>> binascii.hexlify(script_for_address(
+    ...     "1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMH"))
+    '76a914751e76e8199196d454941c45d1b3a323f1433bd688ac'
+    >>> binascii.hexlify(script_for_address("bc1qrp33g0q5c5txsp9arysrx4k6"
+    ...                                     "zdkfs4nce4xj0gdcccefvpysxf3qccfmv3"))
+    '00201863143c14c5166804bd19203356da136c985678cd4d27a1b8c6329604903262'
+    >>> binascii.hexlify(script_for_address("bc1p0xlxvlhemja6c4dqv22uapctqup"
+    ...                                     "fhlxm9h8z3k2e72q4k9hcz7vqzk5jj0"))
+    '512079be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798'
+
+    """
+    if address.lower().startswith(SEGWIT_HRP + "1"):
+        version, program = decode_segwit_address(address)
+        # OP_0 or OP_1..OP_16, then the program
+        return chr(0x50 + version if version else 0) + \
+            chr(len(program)) + program
+    version, h = decode_address(address)
+    if version == P2PKH_VERSION:
+        # OP_DUP OP_HASH160 <hash> OP_EQUALVERIFY OP_CHECKSIG
+        return "\x76\xa9\x14" + h + "\x88\xac"
+    # OP_HASH160 <hash> OP_EQUAL
+    return "\xa9\x14" + h + "\x87"
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
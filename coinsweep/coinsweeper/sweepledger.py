@@ -0,0 +1,305 @@
+"""
+sweepledger - defines SweepLedger class
+
+SweepLedger keeps the outcome of every address of every run in a local
+SQLite database, so questions like "how much did destination D receive
+last quarter" or "which addresses fail most often" are a query instead
+of a search through old output.
+
+The ledger has three tables:
+- runs: one row per run, with its counts and totals
+- sweeps: one row per address per run (the result records of
+  TxnServiceBlockChain.iter_transactions)
+- payouts: one row per destination paid by a send
+
+Rows are written a batch at a time, each batch in one transaction, so a
+run of 100k addresses makes a few hundred commits instead of 100k. The
+indexes are the ones the reports need, and each report reads an index
+range instead of the whole table:
+- payouts by destination and time, with the amount (the destinations
+  report never reads the table itself)
+- sweeps by status and address (the failures report)
+- sweeps by address and time, and by time
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import json
+import time
+import sqlite3
+import threading
+
+from sweepnet import scrub
+
+__all__ = ["SweepLedger", "REPORTS"]
+
+# rows written per transaction
+BATCH_SIZE = 500
+# the reports report() can make
+REPORTS = ["destinations", "failures", "runs"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    data_file TEXT,
+    started REAL,
+    finished REAL,
+    addresses INTEGER DEFAULT 0,
+    sent INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    swept INTEGER DEFAULT 0,
+    fees INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sweeps (
+    run_id INTEGER,
+    service TEXT,
+    address TEXT,
+    status TEXT,
+    result TEXT,
+    tx_hash TEXT,
+    balance INTEGER,
+    amount INTEGER,
+    fees INTEGER,
+    started REAL,
+    elapsed REAL,
+    errors TEXT
+);
+CREATE TABLE IF NOT EXISTS payouts (
+    run_id INTEGER,
+    address TEXT,
+    destination TEXT,
+    amount INTEGER,
+    tx_hash TEXT,
+    started REAL
+);
+CREATE INDEX IF NOT EXISTS payouts_by_destination
+    ON payouts (destination, started, amount);
+CREATE INDEX IF NOT EXISTS sweeps_by_status
+    ON sweeps (status, address, started);
+CREATE INDEX IF NOT EXISTS sweeps_by_address
+    ON sweeps (address, started);
+CREATE INDEX IF NOT EXISTS sweeps_by_started
+    ON sweeps (started);
+"""
+
+
+def _scrubbed(errors):
+    """
+    ``errors`` (a dictionary) as the JSON stored, with the secrets in
+    its keys and values (URLs, POST data) replaced, see scrub().
+
+    >>> _scrubbed({"https://blockchain.info/merchant/5Kb8/payment": "500"})
+    '{"https://blockchain.info/merchant/SCRUBBED/payment": "500"}'
+
+    """
+    return json.dumps(dict((scrub(unicode(k)), scrub(unicode(v)))
+                           for k, v in errors.iteritems()), sort_keys=True)
+
+
+def _between(column, since, until):
+    """The SQL condition (and its parameters) for a time range."""
+    conditions, parameters = [], []
+    if since is not None:
+        conditions.append("{0} >= ?".format(column))
+        parameters.append(since)
+    if until is not None:
+        conditions.append("{0} < ?".format(column))
+        parameters.append(until)
+    return (conditions, parameters)
+
+
+class SweepLedger(object):
+    """
+    The ledger database, see the module docstring.
+
+    Records can be added from several threads (with --concurrency, or
+    by a monitor's worker), they share one connection.
+
+    """
+
+    def __init__(self, file_, batch_size=BATCH_SIZE):
+        """
+        Constructor
+        ``file_`` is the SQLite database, created if it doesn't exist.
+        Rows are written ``batch_size`` at a time.
+
+        """
+        self.file_ = file_
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(file_, check_same_thread=False)
+        # readers (a report) don't wait for a run that is writing
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+        self.lock = threading.Lock()
+        self.run_id = None
+        self._sweeps = []
+        self._payouts = []
+        self._totals = None
+
+    def start_run(self, data_file):
+        """Start the run of ``data_file``, whose records come next."""
+        with self.lock:
+            with self.db:
+                cursor = self.db.execute("INSERT INTO runs (data_file, "
+                                         "started) VALUES (?, ?)",
+                                         (data_file, time.time()))
+            self.run_id = cursor.lastrowid
+            self._totals = {'addresses': 0, 'sent': 0, 'failed': 0,
+                            'swept': 0, 'fees': 0}
+        return self.run_id
+
+    def add(self, record):
+        """
+        Add a result record (see iter_transactions) to the run.
+
+        >>> ledger = SweepLedger(":memory:", batch_size=1)
+        >>> run = ledger.start_run("watch.dat")
+        >>> ledger.add({'address': "1Source", 'status': "error",
+        ...             'result': {"pushtx": "password=secret"},
+        ...             'errors': {"pushtx": "password=secret"}})
+        >>> for row in ledger.db.execute("SELECT result, errors FROM sweeps"):
+        ...     print row[0], row[1]
+        {"pushtx": "password=SCRUBBED"} {"pushtx": "password=SCRUBBED"}
+        >>> ledger.report("failures")[0]['address']
+        u'1Source'
+        >>> ledger.close()
+
+        """
+        amounts = record.get('amounts') or {}
+        amount = sum(amounts.itervalues()) if record['status'] == "sent" \
+                 else None
+        errors = _scrubbed(record['errors']) if record.get('errors') \
+                 else None
+        result = record.get('result')
+        if isinstance(result, dict):
+            result = _scrubbed(result)
+        elif result is not None:
+            result = scrub(unicode(result))
+        with self.lock:
+            self._sweeps.append((self.run_id,
+                                 record.get('service'),
+                                 record['address'],
+                                 record['status'],
+                                 result,
+                                 record.get('tx_hash') or None,
+                                 record.get('balance'),
+                                 amount,
+                                 record.get('fees'),
+                                 record.get('started'),
+                                 record.get('elapsed'),
+                                 errors))
+            if record['status'] == "sent":
+                self._payouts.extend((self.run_id,
+                                      record['address'],
+                                      destination,
+                                      value,
+                                      record.get('tx_hash'),
+                                      record.get('started'))
+                                     for destination, value
+                                     in amounts.iteritems())
+            if self._totals is not None:
+                self._totals['addresses'] += 1
+                if record['status'] == "sent":
+                    self._totals['sent'] += 1
+                    self._totals['swept'] += amount or 0
+                    self._totals['fees'] += record.get('fees') or 0
+                elif record['status'] == "error":
+                    self._totals['failed'] += 1
+            if len(self._sweeps) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        """Write the rows waiting, in one transaction (lock held)."""
+        if not self._sweeps and not self._payouts:
+            return
+        with self.db:
+            self.db.executemany("INSERT INTO sweeps VALUES "
+                                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                self._sweeps)
+            self.db.executemany("INSERT INTO payouts VALUES "
+                                "(?, ?, ?, ?, ?, ?)",
+                                self._payouts)
+        self._sweeps = []
+        self._payouts = []
+
+    def flush(self):
+        """Write the rows waiting."""
+        with self.lock:
+            self._flush()
+
+    def finish_run(self):
+        """Write the rows waiting and the totals of the run."""
+        with self.lock:
+            self._flush()
+            if self.run_id is None:
+                return
+            with self.db:
+                self.db.execute("UPDATE runs SET finished = ?, "
+                                "addresses = ?, sent = ?, failed = ?, "
+                                "swept = ?, fees = ? WHERE id = ?",
+                                (time.time(),
+                                 self._totals['addresses'],
+                                 self._totals['sent'],
+                                 self._totals['failed'],
+                                 self._totals['swept'],
+                                 self._totals['fees'],
+                                 self.run_id))
+            self.run_id = None
+            self._totals = None
+
+    def close(self):
+        """Finish the run (if there is one) and close the database."""
+        self.finish_run()
+        self.db.close()
+
+    def report(self, name, since=None, until=None, destination=None,
+               limit=20):
+        """
+        Make the report ``name`` (one of REPORTS) over the sweeps from
+        ``since`` up to ``until`` (seconds since the epoch, None for no
+        limit), as a list of dictionaries, at most ``limit`` of them.
+        - destinations: what each destination received (only
+          ``destination``, if given), most first
+        - failures: the addresses with the most errors
+        - runs: the latest runs, with their totals
+
+        Raises ValueError for an unknown report.
+
+        """
+        if name == "destinations":
+            conditions, parameters = _between("started", since, until)
+            if destination:
+                conditions.append("destination = ?")
+                parameters.append(destination)
+            sql = "SELECT destination, COUNT(*) AS payouts, " \
+                  "SUM(amount) AS amount, MIN(started) AS first, " \
+                  "MAX(started) AS last FROM payouts {0} " \
+                  "GROUP BY destination ORDER BY amount DESC LIMIT ?"
+        elif name == "failures":
+            conditions, parameters = _between("started", since, until)
+            conditions.insert(0, "status = ?")
+            parameters.insert(0, "error")
+            sql = "SELECT address, COUNT(*) AS failures, " \
+                  "MAX(started) AS last FROM sweeps {0} " \
+                  "GROUP BY address ORDER BY failures DESC, address LIMIT ?"
+        elif name == "runs":
+            conditions, parameters = _between("started", since, until)
+            sql = "SELECT id, data_file, started, finished, addresses, " \
+                  "sent, failed, swept, fees FROM runs {0} " \
+                  "ORDER BY id DESC LIMIT ?"
+        else:
+            raise ValueError("No such report: {0}".format(name))
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        with self.lock:
+            self._flush()
+            cursor = self.db.execute(sql.format(where),
+                                     parameters + [limit or -1])
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
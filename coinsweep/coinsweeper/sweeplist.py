@@ -0,0 +1,169 @@
+"""
+sweeplist - lists the watched addresses
+
+list_watches() writes the watches of a service list, filtered and a
+page at a time, as
+- table: one line per watch, fixed width columns
+- json: a JSON array of objects, one per watch
+- csv: the columns sweepimport reads, so a listing (with the keys
+  shown) can be imported again
+
+Private keys are redacted unless asked for.
+
+All the output goes through one buffered writer: a watch list of
+100k addresses is written in a few large writes instead of a million
+small ones.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import csv
+import json
+import time
+
+__all__ = ["list_watches", "select_watches"]
+
+REDACTED = "(hidden)"
+# bytes written at a time
+BUFFER_SIZE = 1 << 16
+FIELDS = ["address", "key", "threshold", "duration", "destinations",
+          "target", "schedule"]
+
+
+class _Writer(object):
+    """Collects the output and writes it in large pieces."""
+
+    def __init__(self, out, size=BUFFER_SIZE):
+        self.out = out
+        self.size = size
+        self.parts = []
+        self.length = 0
+
+    def write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        self.parts.append(text)
+        self.length += len(text)
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.out.write("".join(self.parts))
+            self.parts = []
+            self.length = 0
+        self.out.flush()
+
+
+def _due(watch, state, now):
+    """
+    Would the next sweep run look at ``watch``? According to the
+    run-state journal ``state`` (a RunState, or None for no journal).
+    An address waiting for a send to confirm (see sweeptrack) isn't.
+
+    """
+    if state is None:
+        return True
+    entry = state.get(watch)
+    if entry is None:
+        return True
+    for key in ('next_change', 'pending_until', 'next_check'):
+        if entry.get(key) is not None and entry[key] > now:
+            return False
+    return True
+
+
+def select_watches(service_list, prefix=None, destination=None,
+                   min_threshold=None, max_threshold=None, due=False,
+                   state=None):
+    """
+    The watches of ``service_list`` (service name => service) that
+    pass the filters, as a list of (service name, SweepAddressInfo)
+    sorted by service and address, so pages are stable.
+
+    ``prefix`` is the start of the watched address, ``destination`` an
+    address it must send to, ``min_threshold`` and ``max_threshold``
+    bound its balance threshold (in satoshis) and ``due`` keeps only
+    the watches the next run would check (see ``state``, a RunState).
+
+    """
+    now = time.time()
+    selected = []
+    for service_name in sorted(service_list):
+        for address, watch in service_list[service_name].watch_list.iteritems():
+            if prefix and not address.startswith(prefix):
+                continue
+            if destination and destination not in watch.destinations:
+                continue
+            if min_threshold is not None and \
+                    watch.balance_threshold < min_threshold:
+                continue
+            if max_threshold is not None and \
+                    watch.balance_threshold > max_threshold:
+                continue
+            if due and not _due(watch, state, now):
+                continue
+            selected.append((service_name, address, watch))
+    selected.sort()
+    return [(service_name, watch) for service_name, address, watch
+            in selected]
+
+
+def _row(watch, show_keys):
+    """The fields of a watch, as sweepimport reads them."""
+    return {'address': watch.address,
+            'key': watch.private_key if show_keys else REDACTED,
+            'threshold': "{0:.8f}".format(watch.balance_threshold / 1e8),
+            'duration': watch.time_threshold.duration,
+            'destinations': ";".join("{0}={1}".format(d, a) for d, a
+                                     in sorted(watch.destinations.iteritems())),
+            'target': getattr(watch, 'confirmation_target', None) or "",
+            'schedule': getattr(watch.time_threshold, 'schedule', None) or ""}
+
+
+def list_watches(service_list, out, format_="table", show_keys=False,
+                 offset=0, limit=None, **filters):
+    """
+    Write the watches of ``service_list`` to the file ``out``.
+
+    ``format_`` is "table", "json" or "csv" (see the module docstring).
+    ``offset`` watches are skipped and at most ``limit`` written; the
+    other keyword arguments are the filters of select_watches().
+
+    Returns the number of watches that passed the filters.
+
+    """
+    selected = select_watches(service_list, **filters)
+    end = None if limit is None else offset + limit
+    page = selected[offset:end]
+    writer = _Writer(out)
+    if format_ == "json":
+        writer.write("[")
+        for i, (service_name, watch) in enumerate(page):
+            row = _row(watch, show_keys)
+            row['service'] = service_name
+            row['threshold'] = watch.balance_threshold
+            row['destinations'] = watch.destinations
+            row['target'] = row['target'] or None
+            row['schedule'] = row['schedule'] or None
+            writer.write(("," if i else "") + "\n" +
+                         json.dumps(row, sort_keys=True))
+        writer.write("\n]\n")
+    elif format_ == "csv":
+        rows = csv.DictWriter(writer, FIELDS, lineterminator="\n")
+        rows.writeheader()
+        for service_name, watch in page:
+            rows.writerow(_row(watch, show_keys))
+    else:
+        line = "{address:<35} {threshold:>17} {duration:<12} {destinations}\n"
+        writer.write(line.format(address="ADDRESS", threshold="THRESHOLD",
+                                 duration="DURATION",
+                                 destinations="DESTINATIONS"))
+        for service_name, watch in page:
+            writer.write(line.format(**_row(watch, show_keys)))
+            if show_keys:
+                writer.write("  key: {0}\n".format(watch.private_key))
+        writer.write("{0} of {1} watches\n".format(len(page), len(selected)))
+    writer.flush()
+    return len(selected)
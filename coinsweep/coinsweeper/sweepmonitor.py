@@ -0,0 +1,537 @@
+"""
+sweepmonitor - push based monitoring of watched addresses
+
+Instead of polling the balance of every watched address on a schedule,
+this subscribes to address notifications over blockchain.info's
+websocket API (the ``addr_sub`` operation) and only evaluates an address
+for sweeping when it has actually received funds. Idle addresses cost
+no API calls at all.
+
+Python 2.7 has no websocket client, so a minimal one (RFC 6455, text
+frames only) is included here. The endpoint is a plain URL, so a local
+stand-in server (``ws://localhost:...``) can be used for testing.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import os
+import ssl
+import json
+import time
+import base64
+import socket
+import struct
+import hashlib
+import urlparse
+import threading
+import Queue
+
+import sweepblockchain
+
+__all__ = ["WebSocket", "AddressMonitor"]
+
+BLOCKCHAIN_WS_URL = "wss://ws.blockchain.info/inv"
+
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+_OP_CONTINUATION = 0x0
+_OP_TEXT = 0x1
+_OP_BINARY = 0x2
+_OP_CLOSE = 0x8
+_OP_PING = 0x9
+_OP_PONG = 0xA
+
+
+class WebSocketError(Exception):
+    """The connection failed or the server broke the protocol."""
+
+
+class WebSocket(object):
+    """
+    Just enough of a websocket client to talk JSON to a server.
+
+    """
+
+    def __init__(self, url, timeout=30):
+        """
+        Constructor - connects and does the opening handshake.
+        ``timeout`` is the socket timeout in seconds, recv() will
+        raise socket.timeout if nothing arrives in that long.
+
+        """
+        self.url = url
+        parts = urlparse.urlparse(url)
+        secure = parts.scheme == "wss"
+        host = parts.hostname
+        port = parts.port or (443 if secure else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        sock = socket.create_connection((host, port), timeout)
+        if secure:
+            sock = ssl.wrap_socket(sock)
+        self.sock = sock
+        self._buffer = ""
+
+        key = base64.b64encode(os.urandom(16))
+        request = "\r\n".join(["GET {0} HTTP/1.1".format(path),
+                               "Host: {0}:{1}".format(host, port),
+                               "Upgrade: websocket",
+                               "Connection: Upgrade",
+                               "Sec-WebSocket-Key: {0}".format(key),
+                               "Sec-WebSocket-Version: 13",
+                               "", ""])
+        self.sock.sendall(request)
+
+        while "\r\n\r\n" not in self._buffer:
+            self._fill()
+        header, _, self._buffer = self._buffer.partition("\r\n\r\n")
+        lines = header.split("\r\n")
+        if " 101 " not in lines[0] + " ":
+            raise WebSocketError("Handshake refused: {0}".format(lines[0]))
+        expected = base64.b64encode(hashlib.sha1(key + _WS_GUID).digest())
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "sec-websocket-accept":
+                if value.strip() != expected:
+                    raise WebSocketError("Handshake accept key mismatch")
+                break
+        else:
+            raise WebSocketError("Handshake missing accept key")
+
+    def _fill(self):
+        data = self.sock.recv(4096)
+        if not data:
+            raise WebSocketError("Connection closed")
+        self._buffer += data
+
+    def _parse_frame(self):
+        """
+        Take one whole frame off the front of the buffer, as a tuple
+        (fin, opcode, payload), or return None if it isn't all here yet.
+        Nothing is consumed until the whole frame has arrived, so a
+        socket timeout part way through a frame loses nothing.
+
+        """
+        buf = self._buffer
+        if len(buf) < 2:
+            return None
+        b1, b2 = ord(buf[0]), ord(buf[1])
+        length = b2 & 0x7F
+        pos = 2
+        if length == 126:
+            if len(buf) < 4:
+                return None
+            length = struct.unpack(">H", buf[2:4])[0]
+            pos = 4
+        elif length == 127:
+            if len(buf) < 10:
+                return None
+            length = struct.unpack(">Q", buf[2:10])[0]
+            pos = 10
+        mask = None
+        if b2 & 0x80:
+            if len(buf) < pos + 4:
+                return None
+            mask = buf[pos:pos + 4]
+            pos += 4
+        if len(buf) < pos + length:
+            return None
+        payload = buf[pos:pos + length]
+        self._buffer = buf[pos + length:]
+        if mask:
+            payload = "".join(chr(ord(c) ^ ord(mask[i % 4]))
+                              for i, c in enumerate(payload))
+        return (b1 & 0x80, b1 & 0x0F, payload)
+
+    def _send_frame(self, opcode, payload):
+        # clients must always mask what they send
+        header = chr(0x80 | opcode)
+        length = len(payload)
+        if length < 126:
+            header += chr(0x80 | length)
+        elif length < 0x10000:
+            header += chr(0x80 | 126) + struct.pack(">H", length)
+        else:
+            header += chr(0x80 | 127) + struct.pack(">Q", length)
+        mask = os.urandom(4)
+        masked = "".join(chr(ord(c) ^ ord(mask[i % 4]))
+                         for i, c in enumerate(payload))
+        self.sock.sendall(header + mask + masked)
+
+    def send(self, text):
+        """Send ``text`` as one text frame."""
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        self._send_frame(_OP_TEXT, text)
+
+    def recv(self):
+        """
+        Return the next complete text (or binary) message.
+
+        Pings are answered along the way. Raises WebSocketError when the
+        server closes the connection.
+
+        """
+        message = ""
+        while True:
+            frame = self._parse_frame()
+            if frame is None:
+                self._fill()
+                continue
+            fin, opcode, payload = frame
+            if opcode == _OP_PING:
+                self._send_frame(_OP_PONG, payload)
+            elif opcode == _OP_PONG:
+                pass
+            elif opcode == _OP_CLOSE:
+                raise WebSocketError("Connection closed by server")
+            elif opcode in (_OP_TEXT, _OP_BINARY, _OP_CONTINUATION):
+                message += payload
+                if fin:
+                    return message
+
+    def close(self):
+        """Say goodbye (if we still can) and close the socket."""
+        try:
+            self._send_frame(_OP_CLOSE, struct.pack(">H", 1000))
+        except Exception:
+            pass
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+
+class AddressMonitor(object):
+    """
+    Watches every address in a service list for incoming funds.
+
+    ``self.balances`` is the live view of address => satoshis, built
+    from the unconfirmed transactions seen since monitoring started
+    (plus any ``initial`` balances passed in). An address that receives
+    funds is queued, and a worker thread runs the normal threshold and
+    time evaluation (process_transactions) for just that address.
+
+    Funds normally arrive unconfirmed, so an address whose evaluation
+    didn't result in a send stays pending and is evaluated again each
+    time a new block arrives, until one of
+    - it is still below its threshold once its last deposit has had the
+      confirmations a sweep needs: it is dropped until funds next arrive
+    - it is too soon to send again: it waits for the time its journal
+      says that could change (without a journal, the next block)
+
+    ``self.pending`` is a dictionary of address => blocks seen since its
+    last deposit, ``self.held`` one of address => the time (seconds
+    since the epoch) before which it isn't evaluated again.
+
+    Canned messages can stand in for the server:
+
+    >>> class Service(object):
+    ...     watch_list = {"1Watched": None}
+    ...     def iter_transactions(self, verbose, addresses, **kwargs):
+    ...         for address in addresses:
+    ...             yield {'address': address,
+    ...                    'status': "below_threshold",
+    ...                    'result': "Balance not large enough"}
+    >>> results = []
+    >>> monitor = AddressMonitor({"test": Service()},
+    ...                          on_result=lambda r: results.append(
+    ...                                                     r['result']))
+    >>> monitor.handle_message(json.dumps({"op": "utx", "x": {"out": [
+    ...     {"addr": "1Watched", "value": 5000},
+    ...     {"addr": "1Other", "value": 7}]}}))
+    >>> monitor.balances == {"1Watched": 5000}
+    True
+    >>> monitor.evaluate(monitor.queue.get_nowait())
+    >>> results, monitor.pending == {"1Watched": 0}
+    (['Balance not large enough'], True)
+    >>> for _ in range(sweepblockchain.DEFAULT_CONFIRMATIONS):
+    ...     monitor.handle_message('{"op": "block"}')
+    ...     monitor.evaluate(monitor.queue.get_nowait())
+    >>> monitor.pending, monitor.queue.empty()
+    ({}, True)
+
+    An evaluation that fails is reported and the address stays pending:
+
+    >>> def broken(*args, **kwargs):
+    ...     raise IOError("no route")
+    >>> Service.iter_transactions = broken
+    >>> monitor.handle_message(json.dumps({"op": "utx", "x": {"out": [
+    ...     {"addr": "1Watched", "value": 1}]}}))
+    >>> monitor.evaluate(monitor.queue.get_nowait())
+    >>> results[-1], monitor.pending == {"1Watched": 0}
+    ("Error: IOError('no route',)", True)
+
+    """
+
+    # seconds between keep-alive pings, and the longest reconnect delay
+    ping_interval = 30
+    max_backoff = 60
+
+    def __init__(self,
+                 service_list,
+                 url=BLOCKCHAIN_WS_URL,
+                 initial=None,
+                 on_result=None,
+                 state=None,
+                 provider=None,
+                 engine=None,
+                 verbose=False,
+                 tracker=None,
+                 ledger=None):
+        """
+        Constructor
+        ``on_result`` is called as on_result(record) with the result
+        record (see iter_transactions) of every evaluation, the default
+        prints the same line main() does.
+        ``state`` is an optional RunState journal, saved after each
+        evaluation. ``provider`` is the optional read-side provider and
+        ``engine`` the optional local signing engine. Sends are added
+        to the ``tracker`` (a ConfirmationTracker), if given, and every
+        evaluation to the ``ledger`` (a SweepLedger).
+
+        """
+        self.service_list = service_list
+        self.url = url
+        self.verbose = verbose
+        self.on_result = on_result or _print_result
+        self.state = state
+        self.provider = provider
+        self.engine = engine
+        self.tracker = tracker
+        self.ledger = ledger
+        self.balances = dict(initial or {})
+        self.pending = {}
+        self.held = {}
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.subscribed = set()
+        self.watched = self._services_by_address()
+        self.ws = None
+        self._stop = threading.Event()
+        self._resubscribe = threading.Event()
+        self._worker = None
+
+    def _services_by_address(self):
+        d = {}
+        for service in self.service_list.itervalues():
+            for address in service.watch_list:
+                d[address] = service
+        return d
+
+    def subscribe_all(self):
+        """
+        (Re)subscribe to every watched address and to new blocks.
+        Call this after changing the watch lists of a running monitor.
+
+        """
+        self.watched = self._services_by_address()
+        addresses = set(self.watched)
+        ws = self.ws
+        if ws is None:
+            return
+        if not self.subscribed:
+            ws.send(json.dumps({"op": "blocks_sub"}))
+        for address in sorted(addresses - self.subscribed):
+            ws.send(json.dumps({"op": "addr_sub", "addr": address}))
+        for address in sorted(self.subscribed - addresses):
+            ws.send(json.dumps({"op": "addr_unsub", "addr": address}))
+        self.subscribed = addresses
+
+    def watches_changed(self, added=(), removed=()):
+        """
+        Take up watch list changes made by another thread (such as a
+        WatchFileReloader). Messages are matched against the new lists
+        at once, the ``added`` addresses are evaluated in case they hold
+        funds already, the ``removed`` ones forgotten, and run() brings
+        the subscriptions up to date (only its thread writes to the
+        connection).
+
+        """
+        self.watched = self._services_by_address()
+        with self.lock:
+            for address in removed:
+                self.pending.pop(address, None)
+                self.held.pop(address, None)
+                self.balances.pop(address, None)
+        for address in added:
+            self.queue.put(address)
+        self._resubscribe.set()
+
+    def handle_message(self, message):
+        """
+        Update the live balances from one message from the server and
+        queue the addresses that need evaluating.
+
+        """
+        try:
+            m = json.loads(message)
+        except ValueError:
+            return
+        op = m.get("op")
+        if op == "utx":
+            watched = self.watched
+            tx = m.get("x", {})
+            received = set()
+            with self.lock:
+                for out in tx.get("out", []):
+                    addr = out.get("addr")
+                    if addr in watched:
+                        self.balances[addr] = self.balances.get(addr, 0) + \
+                                              long(out.get("value", 0))
+                        received.add(addr)
+                for inp in tx.get("inputs", []):
+                    prev_out = inp.get("prev_out") or {}
+                    addr = prev_out.get("addr")
+                    if addr in watched:
+                        self.balances[addr] = self.balances.get(addr, 0) - \
+                                              long(prev_out.get("value", 0))
+                for addr in received:
+                    self.pending[addr] = 0
+                    self.held.pop(addr, None)
+            for addr in received:
+                if self.verbose:
+                    print "Funds received by {0}".format(addr)
+                self.queue.put(addr)
+        elif op == "block":
+            now = time.time()
+            pending = []
+            with self.lock:
+                for addr in self.pending:
+                    self.pending[addr] += 1
+                    if self.held.get(addr, 0) <= now:
+                        pending.append(addr)
+            for addr in pending:
+                self.queue.put(addr)
+
+    def _settle(self, record):
+        """Decide whether the address of ``record`` stays pending."""
+        addr, status = record['address'], record['status']
+        with self.lock:
+            if addr not in self.pending:
+                return
+            if status == "below_threshold" and self.pending[addr] >= \
+                    sweepblockchain.DEFAULT_CONFIRMATIONS:
+                # the deposits have all confirmed and it's still too little
+                del self.pending[addr]
+                self.held.pop(addr, None)
+            elif status == "too_soon":
+                entry = self.state.entries.get(addr) \
+                        if self.state is not None else None
+                if entry and entry.get('next_change'):
+                    self.held[addr] = entry['next_change']
+            elif status != "below_threshold":
+                del self.pending[addr]
+                self.held.pop(addr, None)
+
+    def evaluate(self, address):
+        """
+        Evaluate ``address`` for sweeping. Errors are reported through
+        on_result, and leave the address pending.
+
+        """
+        service = self.watched.get(address)
+        if service is None:
+            return
+        try:
+            if self.state is not None:
+                # funds arrived, whatever the journal predicted
+                self.state.deposit_seen(address)
+            records = list(service.iter_transactions(self.verbose,
+                                                     addresses=[address],
+                                                     state=self.state,
+                                                     provider=self.provider,
+                                                     engine=self.engine))
+            for record in records:
+                if record['status'] == "sent" and self.tracker is not None:
+                    self.tracker.add(record['address'], record['tx_hash'])
+                if self.ledger is not None:
+                    self.ledger.add(record)
+            if self.state is not None:
+                self.state.save()
+            if self.ledger is not None:
+                # evaluations trickle in, so don't wait for a full batch
+                self.ledger.flush()
+        except Exception as e:
+            # one address going wrong mustn't stop the monitor
+            result = "Error: {0!r}".format(e)
+            self.on_result({'address': address,
+                            'status': "error",
+                            'result': result,
+                            'errors': {address: result}})
+            return
+        for record in records:
+            self._settle(record)
+            self.on_result(record)
+
+    def _evaluate(self):
+        """Worker thread: evaluate queued addresses one at a time."""
+        while not self._stop.is_set():
+            try:
+                address = self.queue.get(True, 1)
+            except Queue.Empty:
+                continue
+            self.evaluate(address)
+
+    def run(self):
+        """
+        Monitor until stop() is called (or KeyboardInterrupt),
+        reconnecting and resubscribing whenever the connection drops.
+
+        """
+        self._worker = threading.Thread(target=self._evaluate)
+        self._worker.daemon = True
+        self._worker.start()
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                self.ws = WebSocket(self.url, self.ping_interval)
+                self.subscribed = set()
+                self.subscribe_all()
+                backoff = 1
+                idle = 0
+                while not self._stop.is_set():
+                    if self._resubscribe.is_set():
+                        self._resubscribe.clear()
+                        self.subscribe_all()
+                    try:
+                        message = self.ws.recv()
+                    except socket.timeout:
+                        idle += 1
+                        if idle > 1:
+                            raise WebSocketError("Connection went quiet")
+                        self.ws.send(json.dumps({"op": "ping"}))
+                        continue
+                    idle = 0
+                    self.handle_message(message)
+            except (socket.error, WebSocketError) as e:
+                if self.verbose:
+                    print "Monitor connection lost ({0}), reconnecting in "\
+                          "{1} seconds".format(e, backoff)
+            finally:
+                if self.ws:
+                    self.ws.close()
+                    self.ws = None
+            if not self._stop.is_set():
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def stop(self):
+        """Make run() return."""
+        self._stop.set()
+        ws = self.ws
+        if ws:
+            ws.close()
+
+
+def _print_result(record):
+    print "Send from {0} results in {1}".format(record['address'],
+                                                record['result'])
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,214 @@
+"""
+sweepmulti - sweeps several watch files in one run
+
+Each watch file is read with its own config: the file next to it with
+".config" appended to its name if there is one, otherwise the config
+given on the command line. Each keeps its own run-state journal and
+checkpoint log (the usual ".state" and ".checkpoint" files next to it).
+
+Everything else is shared by the whole run: the pool of keep-alive
+connections and the rate limit of sweepnet, the exchange rate cache
+of sweepblockchain, the address data provider and the local signer.
+The addresses of all the files go into one work queue, taking turns
+between the files so a big file doesn't hold up the small ones, and
+are worked on by a common set of threads.
+
+The addresses of each file are taken in the order of the value they
+are expected to sweep, by its journal (see RunState.priority).
+
+Results are reported per file.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import os
+import time
+import pickle
+import threading
+from multiprocessing.pool import ThreadPool
+
+from cryptconfig import CryptConfig
+from sweepstate import RunState
+from sweepcheckpoint import RunCheckpoint
+import sweepnet
+
+__all__ = ["WatchFile", "find_watch_files", "iter_watch_files"]
+
+CONFIG_SUFFIX = ".config"
+# the watch files picked out of a directory
+DATA_SUFFIX = ".dat"
+
+
+def find_watch_files(paths):
+    """
+    The watch files named by ``paths``, a list of files and
+    directories. A directory stands for the files in it ending in
+    DATA_SUFFIX.
+
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name)
+                         for name in sorted(os.listdir(path))
+                         if name.endswith(DATA_SUFFIX))
+        else:
+            files.append(path)
+    return files
+
+
+class WatchFile(object):
+    """
+    One watch file of a multi-file run, with its results.
+
+    ``self.records`` are the result records of its addresses (see
+    TxnServiceBlockChain.iter_transactions), ``self.errors`` is a
+    dictionary of the problems with the file itself (it couldn't be
+    read, say).
+
+    """
+
+    def __init__(self, data_file, default_config, passphrase=""):
+        """
+        Constructor
+        ``data_file`` is the watch file, ``default_config`` the config
+        to read it with if it has none of its own, and a ``passphrase``
+        overrides the ones in the configs.
+
+        """
+        self.data_file = data_file
+        self.config_file = data_file + CONFIG_SUFFIX
+        if not os.path.exists(self.config_file):
+            self.config_file = default_config
+        self.passphrase = passphrase
+        self.service_list = {}
+        self.state = None
+        self.checkpoint = None
+        self.records = []
+        self.failed = 0
+        self.deferred = 0
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Read and decrypt the watch file. Returns True if it could be."""
+        try:
+            cfg = CryptConfig(self.config_file, self.passphrase)
+            sweep_data = cfg.read_encrypted_file(self.data_file)
+            if not sweep_data:
+                self.errors[self.data_file] = "No such watch file"
+                return False
+            self.service_list = pickle.loads(sweep_data)
+        except Exception as e:
+            # most likely the wrong config or pass phrase
+            self.errors[self.data_file] = "Can't read the watch file " \
+                                          "- {0!r}".format(e)
+            return False
+        return True
+
+    def open(self, use_state=True, max_interval=24 * 3600, sample_rate=0.02,
+             resume=False):
+        """Open the journal and the checkpoint log of the file."""
+        if use_state:
+            self.state = RunState(self.data_file + ".state",
+                                  max_interval,
+                                  sample_rate)
+        self.checkpoint = RunCheckpoint(self.data_file + ".checkpoint",
+                                        resume)
+
+    def close(self):
+        """
+        Save the journal and close the checkpoint log, which is removed
+        if every address was dealt with without errors.
+
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.close(complete=not (self.failed or
+                                                self.deferred))
+        if self.state is not None:
+            self.state.save()
+
+    def jobs(self):
+        """
+        The (watch file, service, address) of each watched address, the
+        most valuable first.
+
+        """
+        jobs = [(self, service, address)
+                for service in self.service_list.itervalues()
+                for address in sorted(service.watch_list)]
+        if self.state is not None:
+            now = time.time()
+            jobs.sort(key=lambda job: self.state.priority(
+                                            job[1].watch_list[job[2]], now),
+                      reverse=True)
+        return jobs
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+            if record['status'] == "error":
+                self.failed += 1
+            elif record['status'] == "deferred":
+                self.deferred += 1
+
+    def summary(self):
+        """A dictionary of how the file's addresses fared."""
+        counts = {}
+        for record in self.records:
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+        return {'file': self.data_file,
+                'addresses': len(self.records),
+                'sent': counts.get("sent", 0),
+                'failed': self.failed,
+                'deferred': self.deferred,
+                'errors': self.errors}
+
+
+def _interleave(lists):
+    """The items of ``lists``, taking one from each list in turn."""
+    items = []
+    for i in range(max([len(l) for l in lists] or [0])):
+        items.extend(l[i] for l in lists if i < len(l))
+    return items
+
+
+def iter_watch_files(watch_files, concurrency=4, provider=None, engine=None,
+                     verbose=False):
+    """
+    Sweep the addresses of the opened WatchFile instances
+    ``watch_files`` with ``concurrency`` threads, yielding the result
+    record of each address (with the 'file' it is from added) as soon
+    as it is done. Every record is also added to its WatchFile.
+
+    Keep-alive connections are turned on for the run.
+
+    """
+    sweepnet.set_keep_alive(True)
+
+    def sweep(job):
+        watch_file, service, address = job
+        for record in service.iter_transactions(verbose,
+                                                [address],
+                                                state=watch_file.state,
+                                                provider=provider,
+                                                engine=engine,
+                                                checkpoint=
+                                                watch_file.checkpoint):
+            record['file'] = watch_file.data_file
+            watch_file.add(record)
+            return record
+        # finished by an earlier attempt at the run
+        return None
+
+    jobs = _interleave([w.jobs() for w in watch_files])
+    if not jobs:
+        return
+    pool = ThreadPool(max(1, min(concurrency, len(jobs))))
+    try:
+        for record in pool.imap_unordered(sweep, jobs):
+            if record is not None:
+                yield record
+    finally:
+        pool.terminate()
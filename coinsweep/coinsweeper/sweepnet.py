@@ -0,0 +1,787 @@
+"""
+sweepnet - the network layer under _read_url
+
+Every request gets a timeout that depends on the endpoint it goes to,
+and none may run past the deadline of the whole run (if one is set),
+so one stalled connection can no longer hang a sweep run. The timeout
+is for the whole request, however slowly the response trickles in. A
+send (a POST, or a blockchain.info merchant request) is never cut short
+by the deadline, since whether it went out would then be unknown: it
+isn't started unless its whole timeout is left.
+
+Requests to endpoints that only read data (balances, unspent outputs,
+address histories and the ticker) are hedged: if the response hasn't
+arrived by the time 95% of responses from that endpoint usually have,
+a duplicate request is sent and whichever answers first is used. Sends
+are never hedged, a duplicate send could be a duplicate payment.
+
+The latencies seen are kept per endpoint for choosing the hedge delays
+and for latency_report().
+
+With keep-alive on (set_keep_alive) requests reuse open connections
+from a pool shared by the whole process instead of making a new
+connection (and TLS handshake) each, and a token bucket
+(set_rate_limit) can cap the requests per second of the process.
+
+A run can be recorded to a cassette (start_recording) and the cassette
+replayed later without a network (start_replay), to reproduce a
+production run or load test a new version against real responses.
+A cassette is a gzipped file of JSON lines, one per request, holding
+the request, its response, its latency and when it was made. The
+private keys in blockchain.info merchant (send) URLs and any password
+parameters are replaced by "SCRUBBED" before they are written.
+
+With tracing on (see sweeptrace) every request is an "http" span.
+
+A run can also be given a budget of requests (set_call_budget), for
+an API quota: like the deadline, requests past it aren't made, and
+budget_spent() tells the run to stop starting new work.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import re
+import gzip
+import json
+import time
+import base64
+import socket
+import httplib
+import urllib
+import urllib2
+import urlparse
+import threading
+import Queue
+from collections import deque
+
+import sweeptrace
+
+__all__ = ["endpoint_of", "fetch", "set_timeout", "set_run_deadline",
+           "run_time_left", "set_hedging", "latency_report",
+           "scrub", "start_recording", "start_replay", "stop_cassette",
+           "set_keep_alive", "set_rate_limit", "set_call_budget",
+           "calls_left", "budget_spent", "BUDGET_ERRORS"]
+
+# seconds each endpoint gets before a request to it is abandoned
+ENDPOINT_TIMEOUTS = {'addressbalance': 10,
+                     'unspent': 15,
+                     'rawaddr': 20,
+                     'ticker': 10,
+                     'merchant': 60,
+                     'getblockcount': 10,
+                     'multiaddr': 20,
+                     # Esplora APIs
+                     'address': 20,
+                     'blocks': 10}
+DEFAULT_TIMEOUT = 30
+
+# endpoints that send coins (as do all POSTs)
+SEND_ENDPOINTS = set(['merchant', 'pushtx'])
+
+# endpoints it is safe to send the same request to twice
+HEDGED_ENDPOINTS = set(['addressbalance', 'unspent', 'rawaddr', 'ticker',
+                        'getblockcount', 'multiaddr', 'address', 'blocks'])
+
+# hedge delay to use until an endpoint has enough latency samples
+DEFAULT_HEDGE_DELAY = 2.0
+MINIMUM_SAMPLES = 20
+
+# the errors of requests refused for the run's budget
+DEADLINE_PASSED = "Run deadline passed"
+CALLS_USED_UP = "API call budget used up"
+BUDGET_ERRORS = (DEADLINE_PASSED, CALLS_USED_UP)
+
+_hedging = True
+_deadline = None
+# the _CallBudget of the run, if any
+_call_budget = None
+# the Recorder or Player in use, if any
+_cassette = None
+# the TokenBucket requests wait for, if any
+_rate_limiter = None
+_keep_alive = False
+# idle connections kept per host
+MAX_IDLE = 8
+
+SCRUBBED = "SCRUBBED"
+_SECRETS = [re.compile(r"(/merchant/)[^/?]+"),
+            re.compile(r"((?:^|[?&])(?:second_)?password=)[^&]*")]
+
+
+def endpoint_of(url):
+    """
+    Return the name of the API endpoint ``url`` goes to, e.g.
+    "addressbalance" for https://blockchain.info/q/addressbalance/1abc
+
+    """
+    parts = [p for p in urlparse.urlparse(url).path.split("/") if p]
+    if parts and parts[0] in ("q", "api"):
+        parts = parts[1:]
+    if parts:
+        return parts[0]
+    return ""
+
+
+def _is_send(url, data):
+    """
+    Whether the request is a send: a POST, or a blockchain.info merchant
+    request (a GET that pays). A send is never repeated.
+
+    """
+    return data is not None or endpoint_of(url) in SEND_ENDPOINTS
+
+
+def set_timeout(seconds, endpoint=None):
+    """Set the timeout of ``endpoint`` (of every endpoint if None)."""
+    global DEFAULT_TIMEOUT
+    if endpoint is None:
+        DEFAULT_TIMEOUT = seconds
+        for name in ENDPOINT_TIMEOUTS:
+            ENDPOINT_TIMEOUTS[name] = seconds
+    else:
+        ENDPOINT_TIMEOUTS[endpoint] = seconds
+
+
+def set_run_deadline(seconds):
+    """
+    No request may run longer than ``seconds`` from now, and none are
+    started after that. None removes the deadline.
+
+    """
+    global _deadline
+    if seconds is None:
+        _deadline = None
+    else:
+        _deadline = time.time() + seconds
+
+
+def run_time_left():
+    """Seconds left before the run deadline (None if there isn't one)."""
+    if _deadline is None:
+        return None
+    return _deadline - time.time()
+
+
+class _CallBudget(object):
+    """The number of requests the run may still make."""
+
+    def __init__(self, calls):
+        self.left = calls
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Use up a call. Returns False if there are none left."""
+        with self.lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+def set_call_budget(calls):
+    """
+    Let the rest of the run make at most ``calls`` requests (hedges
+    count). None removes the limit.
+
+    """
+    global _call_budget
+    _call_budget = None if calls is None else _CallBudget(calls)
+
+
+def calls_left():
+    """Requests the run may still make (None if there is no limit)."""
+    budget = _call_budget
+    if budget is None:
+        return None
+    return budget.left
+
+
+def budget_spent(calls=1):
+    """
+    True if the run can't do ``calls`` more requests: the deadline has
+    passed or the call budget has fewer left.
+
+    """
+    left = run_time_left()
+    if left is not None and left <= 0:
+        return True
+    budget = calls_left()
+    return budget is not None and budget < calls
+
+
+def set_hedging(enabled):
+    """Turn hedged requests on or off."""
+    global _hedging
+    _hedging = enabled
+
+
+class _Latencies(object):
+    """
+    The latencies of the most recent requests to each endpoint,
+    plus counts of the hedges sent and how many of them won.
+
+    """
+
+    window = 500
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.counts = {}
+
+    def add(self, endpoint, seconds):
+        with self.lock:
+            if endpoint not in self.samples:
+                self.samples[endpoint] = deque(maxlen=self.window)
+            self.samples[endpoint].append(seconds)
+
+    def count(self, endpoint, what):
+        with self.lock:
+            d = self.counts.setdefault(endpoint, {})
+            d[what] = d.get(what, 0) + 1
+
+    def percentile(self, endpoint, p):
+        """Return the ``p`` percentile latency, None if too few samples."""
+        with self.lock:
+            s = sorted(self.samples.get(endpoint, ()))
+        if len(s) < MINIMUM_SAMPLES:
+            return None
+        return percentile(s, p)
+
+    def report(self):
+        with self.lock:
+            samples = dict((e, sorted(s)) for e, s in self.samples.items())
+            counts = dict((e, dict(c)) for e, c in self.counts.items())
+        r = {}
+        for endpoint, s in samples.iteritems():
+            r[endpoint] = {'requests': len(s),
+                           'p50': percentile(s, 50),
+                           'p95': percentile(s, 95),
+                           'p99': percentile(s, 99),
+                           'max': s[-1] if s else None}
+            r[endpoint].update(counts.get(endpoint, {}))
+        return r
+
+
+_latencies = _Latencies()
+
+
+def percentile(values, p):
+    """Return the ``p`` percentile of the sorted list ``values``."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def latency_report():
+    """
+    Return a dictionary of endpoint => statistics of the latencies of
+    the requests made so far (in seconds): requests, p50, p95, p99 and
+    max, plus 'hedged' and 'hedge_won' counts for hedged endpoints.
+
+    """
+    return _latencies.report()
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` requests per second on average, in bursts of up to
+    ``burst`` requests.
+
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout):
+        """
+        Take a token, waiting for one if needed. Returns False if none
+        would be available within ``timeout`` seconds.
+
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = (1 - self.tokens) / self.rate
+            if wait > timeout:
+                return False
+            # take it now, a waiting request holds its place in line
+            self.tokens -= 1
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+
+def set_rate_limit(rate, burst=None):
+    """
+    Limit the process to ``rate`` requests per second (in bursts of up
+    to ``burst``). None removes the limit.
+
+    """
+    global _rate_limiter
+    if rate:
+        _rate_limiter = TokenBucket(rate, burst)
+    else:
+        _rate_limiter = None
+
+
+class _ConnectionPool(object):
+    """Idle keep-alive connections, by scheme and host."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, key, timeout):
+        """
+        The return is a tuple: (connection, reused)
+
+        """
+        with self.lock:
+            idle = self.idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            conn.sock.settimeout(timeout)
+            return (conn, True)
+        scheme, host = key
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=timeout)
+        return (conn, False)
+
+    def put(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < MAX_IDLE and conn.sock is not None:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+
+_pool = _ConnectionPool()
+_proxies = {}
+
+
+def set_keep_alive(enabled):
+    """
+    Turn the sharing of keep-alive connections on or off. Requests
+    that go through a proxy (see urllib.getproxies) never use them.
+
+    """
+    global _keep_alive, _proxies
+    _keep_alive = enabled
+    _proxies = urllib.getproxies()
+    if not enabled:
+        _pool.clear()
+
+
+def _pooled_attempt(url, data, headers, timeout, span=sweeptrace.NO_SPAN):
+    """
+    Make one request over a pooled connection, noting in ``span`` (the
+    "http" span of the request) whether the connection was reused.
+
+    The return is a tuple: (contents, errors), where
+    errors is a dictionary.
+
+    A read that fails on a kept-alive connection (which the server may
+    have closed) is tried once more on another, a send never is:
+
+    >>> class Stub(object):
+    ...     # a kept-alive connection the server has closed
+    ...     def __init__(self, calls, status=None):
+    ...         self.calls, self.status, self.sock = calls, status, self
+    ...     def settimeout(self, timeout):
+    ...         pass
+    ...     def close(self):
+    ...         pass
+    ...     def request(self, method, path, data, headers):
+    ...         self.calls.append((method, path))
+    ...         if self.status is None:
+    ...             raise socket.error("Connection reset by peer")
+    ...     def getresponse(self):
+    ...         return self
+    ...     def read(self):
+    ...         return ""
+    ...     will_close = True
+    ...     def getheader(self, name, default=None):
+    ...         return "https://example.com/elsewhere"
+    >>> key = ("https", "blockchain.info")
+    >>> calls = []
+    >>> _pool.idle[key] = [Stub(calls), Stub(calls)]
+    >>> _pooled_attempt("https://blockchain.info/merchant/KEY/sendmany?to=x",
+    ...                 None, None, 10)[1].values()
+    ['Connection reset by peer']
+    >>> calls
+    [('GET', '/merchant/KEY/sendmany?to=x')]
+    >>> calls = []
+    >>> _pool.idle[key] = [Stub(calls), Stub(calls)]
+    >>> _pooled_attempt("https://blockchain.info/unspent?active=1a",
+    ...                 None, None, 10)[1].values()
+    ['Connection reset by peer']
+    >>> len(calls)
+    2
+    >>> _pool.idle[key] = [Stub(calls, status=302)]
+    >>> _pooled_attempt("https://blockchain.info/merchant/KEY/payment?to=x",
+    ...                 None, None, 10)[1].values()
+    ['HTTP redirect (302) of a send: https://example.com/elsewhere']
+    >>> _pool.clear()
+
+    """
+    send = _is_send(url, data)
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    path = urlparse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+    headers = dict(headers or {})
+    if data:
+        headers['Content-Type'] = "application/x-www-form-urlencoded"
+    for retry in range(2):
+        conn, reused = _pool.get(key, timeout)
+        span.set(reused_connection=reused)
+        try:
+            conn.request("POST" if data else "GET", path, data, headers)
+            response = conn.getresponse()
+            contents = response.read()
+            break
+        except socket.timeout:
+            conn.close()
+            return ("", {url: "Timed out after {0} seconds".format(timeout)})
+        except (socket.error, httplib.HTTPException) as e:
+            conn.close()
+            error = str(e) or e.__class__.__name__
+            # the server may have closed a kept-alive connection; a
+            # send may have arrived anyway, so only reads are retried
+            if reused and not send and not retry:
+                continue
+            return ("", {url: error})
+    else:
+        return ("", {url: error})
+    if response.will_close:
+        conn.close()
+    else:
+        _pool.put(key, conn)
+    if 300 <= response.status < 400:
+        if send:
+            # the send may have been taken already, don't repeat it
+            return ("", {url: "HTTP redirect ({0}) of a send: {1}".format(
+                                    response.status,
+                                    response.getheader("location", ""))})
+        # let urllib2 follow the redirect
+        return _attempt(url, data, headers, timeout, keep_alive=False)
+    if response.status >= 400:
+        return ("", {url: "HTTP error ({0}): {1}".format(response.status,
+                                                        response.reason)})
+    return (contents, {})
+
+
+def _attempt(url, data, headers, timeout, keep_alive=True,
+             span=sweeptrace.NO_SPAN):
+    """
+    Make one request, see _pooled_attempt for ``span``.
+
+    The return is a tuple: (contents, errors), where
+    errors is a dictionary.
+
+    """
+    scheme = url.partition(":")[0]
+    if keep_alive and _keep_alive and scheme in ("http", "https") and \
+            scheme not in _proxies:
+        return _pooled_attempt(url, data, headers, timeout, span)
+    contents = ""
+    errors = {}
+    try:
+        request = urllib2.Request(url, data, headers or {})
+        response = urllib2.urlopen(request, timeout=timeout)
+        contents = response.read()
+        response.close()
+    except urllib2.HTTPError as he:
+        errors[url] = "HTTP error ({0}): {1}".format(he.code, he.reason)
+    except urllib2.URLError as e:
+        errors[url] = e.reason
+    except socket.timeout:
+        errors[url] = "Timed out after {0} seconds".format(timeout)
+    except (socket.error, httplib.HTTPException, ValueError) as e:
+        errors[url] = str(e)
+    return (contents, errors)
+
+
+def _timed_attempt(which, url, data, headers, timeout, endpoint, results,
+                   span):
+    """Thread target: one attempt, recording its latency."""
+    started = time.time()
+    contents, errors = _attempt(url, data, headers, timeout, span=span)
+    if not errors:
+        _latencies.add(endpoint, time.time() - started)
+    results.put((which, contents, errors))
+
+
+def scrub(text):
+    """
+    ``text`` (a URL or POST data) with the secrets in it replaced.
+
+    >>> scrub("https://blockchain.info/merchant/5Kb8kLf9/sendmany?to=1a")
+    'https://blockchain.info/merchant/SCRUBBED/sendmany?to=1a'
+    >>> scrub("main_password=x&password=secret&note=hi")
+    'main_password=x&password=SCRUBBED&note=hi'
+
+    """
+    if not text:
+        return text
+    for secret in _SECRETS:
+        text = secret.sub(r"\g<1>" + SCRUBBED, text)
+    return text
+
+
+class Recorder(object):
+    """Writes each request made, and its outcome, to a cassette."""
+
+    def __init__(self, file_):
+        self.file_ = file_
+        self.f = gzip.open(file_, "wb")
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.count = 0
+        self._write({'cassette': 1, 'recorded': self.started})
+
+    def _write(self, entry):
+        with self.lock:
+            self.f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    def add(self, url, data, contents, errors, started, latency):
+        entry = {'url': scrub(url),
+                 'data': scrub(data),
+                 'at': round(started - self.started, 6),
+                 'latency': round(latency, 6),
+                 'errors': dict((scrub(k), scrub(unicode(v)))
+                                for k, v in errors.iteritems())}
+        try:
+            entry['contents'] = contents.decode("utf-8")
+        except UnicodeDecodeError:
+            entry['contents_b64'] = base64.b64encode(contents)
+        self._write(entry)
+        self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+class Player(object):
+    """
+    Answers requests from a cassette.
+
+    Requests are matched on their (scrubbed) URL and POST data. The
+    same request made several times gets the recorded responses in
+    the order they were recorded, then the last one again.
+
+    Each response takes its recorded latency divided by ``speed``
+    (0 for no waiting at all).
+
+    """
+
+    def __init__(self, file_, speed=1.0):
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.misses = 0
+        with gzip.open(file_, "rb") as f:
+            try:
+                for text in f:
+                    entry = json.loads(text)
+                    if 'url' not in entry:
+                        continue
+                    key = (entry['url'], entry.get('data'))
+                    self.responses.setdefault(key, deque()).append(entry)
+            except (IOError, EOFError, ValueError):
+                # the end of a cassette whose recording was cut short
+                pass
+
+    def answer(self, url, data):
+        key = (scrub(url), scrub(data))
+        with self.lock:
+            recorded = self.responses.get(key)
+            if not recorded:
+                self.misses += 1
+                return (0, "", {url: "Not in the cassette"})
+            entry = recorded[0]
+            if len(recorded) > 1:
+                recorded.popleft()
+        if 'contents_b64' in entry:
+            contents = base64.b64decode(entry['contents_b64'])
+        else:
+            contents = entry['contents'].encode("utf-8")
+        # errors were recorded under the scrubbed URL
+        errors = dict((url if k == key[0] else k, v)
+                      for k, v in entry['errors'].iteritems())
+        return (entry['latency'], contents, errors)
+
+
+def start_recording(file_):
+    """Record every request from now on to the cassette ``file_``."""
+    global _cassette
+    stop_cassette()
+    _cassette = Recorder(file_)
+    return _cassette
+
+
+def start_replay(file_, speed=1.0):
+    """
+    Answer every request from now on from the cassette ``file_``
+    instead of the network, ``speed`` times as fast as recorded.
+
+    """
+    global _cassette
+    stop_cassette()
+    _cassette = Player(file_, speed)
+    return _cassette
+
+
+def stop_cassette():
+    """Stop recording (closing the cassette) or replaying."""
+    global _cassette
+    if isinstance(_cassette, Recorder):
+        _cassette.close()
+    _cassette = None
+
+
+def _replay(player, url, data, endpoint, timeout):
+    latency, contents, errors = player.answer(url, data)
+    if player.speed:
+        wait = latency / player.speed
+        if wait > timeout:
+            time.sleep(timeout)
+            return ("", {url: "Timed out after {0} seconds".format(timeout)})
+        time.sleep(wait)
+    if not errors:
+        _latencies.add(endpoint, latency / (player.speed or 1))
+    return (contents, errors)
+
+
+def fetch(url, data=None, headers=None):
+    """
+    Request ``url`` (POSTing ``data`` if given) within the timeout of
+    its endpoint and the run deadline, hedging it if it is a read.
+
+    The return is a tuple: (contents, errors), where
+    errors is a dictionary.
+
+    """
+    endpoint = endpoint_of(url)
+    with sweeptrace.span("http", endpoint=endpoint,
+                         method="POST" if data else "GET") as s:
+        contents, errors = _limited_fetch(url, data, headers, endpoint)
+        s.set(status="error" if errors else "ok",
+              bytes=len(contents or ""))
+        if errors:
+            s.set(error=scrub("; ".join(str(e) for e in errors.values())))
+    return (contents, errors)
+
+
+def _limited_fetch(url, data, headers, endpoint):
+    """fetch() within the timeouts, the deadline and the rate limit."""
+    timeout = ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+    send = _is_send(url, data)
+    left = run_time_left()
+    if left is not None:
+        if left <= 0 or (send and left < timeout):
+            # a send cut short could have gone out or not
+            return ("", {url: DEADLINE_PASSED})
+        timeout = min(timeout, left)
+    if _call_budget is not None and not _call_budget.take():
+        return ("", {url: CALLS_USED_UP})
+
+    cassette = _cassette
+    if isinstance(cassette, Player):
+        sweeptrace.current().set(replayed=True)
+        return _replay(cassette, url, data, endpoint, timeout)
+    if _rate_limiter is not None:
+        waited = time.time()
+        if not _rate_limiter.acquire(timeout):
+            return ("", {url: "Rate limit: no request possible within "
+                              "{0} seconds".format(timeout)})
+        sweeptrace.current().set(rate_limit_wait=time.time() - waited)
+        if not send:
+            timeout = max(timeout - (time.time() - waited), 0.001)
+    if isinstance(cassette, Recorder):
+        started = time.time()
+        contents, errors = _fetch(url, data, headers, endpoint, timeout)
+        cassette.add(url, data, contents, errors, started,
+                     time.time() - started)
+        return (contents, errors)
+    return _fetch(url, data, headers, endpoint, timeout)
+
+
+def _fetch(url, data, headers, endpoint, timeout):
+    results = Queue.Queue()
+    if not _hedging or endpoint not in HEDGED_ENDPOINTS or data:
+        # the socket timeout is per read, a response trickling in could
+        # take far longer, so the attempt is waited for at most timeout
+        _start_attempt(1, url, data, headers, timeout, endpoint, results)
+        try:
+            which, contents, errors = results.get(True, timeout)
+        except Queue.Empty:
+            return ("", {url: "Timed out after {0} seconds".format(timeout)})
+        return (contents, errors)
+
+    delay = _latencies.percentile(endpoint, 95) or DEFAULT_HEDGE_DELAY
+    delay = min(delay, timeout)
+    started = time.time()
+    _start_attempt(1, url, data, headers, timeout, endpoint, results)
+    try:
+        which, contents, errors = results.get(True, delay)
+        return (contents, errors)
+    except Queue.Empty:
+        pass
+
+    # the first request is slower than usual, race it with a second one
+    # (if the rate limit allows one right now)
+    outcome = ("", {url: "Timed out after {0} seconds".format(timeout)})
+    attempts = 1
+    if (_rate_limiter is None or _rate_limiter.acquire(0)) and \
+            (_call_budget is None or _call_budget.take()):
+        _latencies.count(endpoint, 'hedged')
+        sweeptrace.current().set(hedged=True)
+        _start_attempt(2, url, data, headers, timeout - delay, endpoint,
+                       results)
+        attempts = 2
+    for pending in range(attempts):
+        wait = timeout - (time.time() - started)
+        try:
+            which, contents, errors = results.get(True, max(wait, 0.001))
+        except Queue.Empty:
+            break
+        outcome = (contents, errors)
+        if not errors:
+            if which == 2:
+                _latencies.count(endpoint, 'hedge_won')
+                sweeptrace.current().set(hedge_won=True)
+            break
+    return outcome
+
+
+def _start_attempt(which, url, data, headers, timeout, endpoint, results):
+    # the attempt's thread has no span open, it is given the "http" one
+    t = threading.Thread(target=_timed_attempt,
+                         args=(which, url, data, headers, max(timeout, 0.001),
+                               endpoint, results, sweeptrace.current()))
+    t.daemon = True
+    t.start()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,319 @@
+"""
+sweepproviders - read-side address data providers and a router for them
+
+A provider answers the read-only questions a sweep asks about an
+address: its balance, its unspent outputs, its transaction history and
+the exchange rate. All of them return the same tuples (and the same
+blockchain.info shaped data) as the AddressDataBC methods, so the rest
+of the code doesn't care which one answered.
+
+ProviderRouter spreads the calls over several providers. It keeps an
+exponentially weighted moving average of the latency and the error
+rate of each, sends every call to the fastest healthy one and fails
+over to the next one when a call fails.
+
+Sends still always go through TxnServiceBlockChain.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import json
+import time
+import random
+import binascii
+import threading
+
+import sweepblockchain
+from sweepblockchain import AddressDataBC, _read_url
+
+__all__ = ["BlockchainInfoProvider", "EsploraProvider", "ProviderRouter",
+           "make_provider"]
+
+
+class BlockchainInfoProvider(object):
+    """
+    The blockchain.info API, as used by AddressDataBC.
+
+    """
+
+    def __init__(self, name="blockchain.info"):
+        self.name = name
+
+    def balance(self, address, verbose=False):
+        return AddressDataBC().fetch_balance(address, verbose)
+
+    def unspent(self, address, verbose=False):
+        return AddressDataBC().fetch_unspent_outputs(address, verbose)
+
+    def transactions(self, address, verbose=False):
+        return AddressDataBC().fetch_transactions(address, verbose)
+
+    def exchange_rate(self, currency, verbose=False):
+        return AddressDataBC().fetch_exchange_rate(currency, verbose)
+
+
+class EsploraProvider(object):
+    """
+    An Esplora API (as run by blockstream.info and mempool.space).
+
+    The answers are converted to the shapes the blockchain.info API
+    uses. The exchange rate comes from mempool.space's /v1/prices,
+    providers without it fail those calls (and the router moves on).
+
+    """
+
+    # seconds the chain tip height is reused for
+    tip_ttl = 30
+
+    def __init__(self, base_url="https://blockstream.info/api",
+                 name="blockstream", confirmations=None):
+        """
+        Constructor
+        ``confirmations`` is how many a transaction needs before its
+        outputs count toward the balance (like fetch_balance, whose
+        setting is used if it is None).
+
+        """
+        self.base_url = base_url.rstrip("/")
+        self.name = name
+        self.confirmations = confirmations
+        self._tip = None
+        self._tip_time = 0
+
+    def _get_json(self, path, verbose):
+        url = self.base_url + path
+        content, errors = _read_url(url, None, verbose)
+        if errors:
+            return (None, errors)
+        try:
+            return (json.loads(content), errors)
+        except ValueError as e:
+            return (None, {url: str(e)})
+
+    def tip_height(self, verbose=False):
+        """
+        Return the height of the newest block, reused for tip_ttl seconds.
+
+        The return is a tuple: (height, errors)
+
+        """
+        if self._tip is not None and time.time() - self._tip_time < self.tip_ttl:
+            return (self._tip, {})
+        height, errors = self._get_json("/blocks/tip/height", verbose)
+        if errors:
+            return (None, errors)
+        self._tip = int(height)
+        self._tip_time = time.time()
+        return (self._tip, errors)
+
+    def unspent(self, address, verbose=False):
+        utxos, errors = self._get_json("/address/{0}/utxo".format(address),
+                                       verbose)
+        if errors:
+            return (None, errors)
+        tip, errors = self.tip_height(verbose)
+        if errors:
+            return (None, errors)
+        unspent = []
+        for u in utxos:
+            status = u.get('status', {})
+            confirmations = 0
+            if status.get('confirmed'):
+                confirmations = tip - status['block_height'] + 1
+            unspent.append({
+                'tx_hash': binascii.hexlify(
+                                binascii.unhexlify(u['txid'])[::-1]),
+                'tx_hash_big_endian': u['txid'],
+                'tx_output_n': u['vout'],
+                'value': long(u['value']),
+                'confirmations': confirmations})
+        # blockchain.info's /unspent has nothing (not an empty list)
+        # when there are no outputs, keep that
+        return (unspent or None, errors)
+
+    def balance(self, address, verbose=False):
+        unspent, errors = self.unspent(address, verbose)
+        if errors:
+            return (0, errors)
+        confirmations = self.confirmations or \
+                        sweepblockchain.DEFAULT_CONFIRMATIONS
+        balance = sum(u['value'] for u in unspent or []
+                      if u['confirmations'] >= confirmations)
+        if verbose:
+            print "Retrieved balance of {0}".format(balance)
+        return (long(balance), errors)
+
+    def transactions(self, address, verbose=False):
+        txs, errors = self._get_json("/address/{0}/txs".format(address),
+                                     verbose)
+        if errors:
+            return (None, errors)
+        converted = []
+        for tx in txs:
+            status = tx.get('status', {})
+            inputs = []
+            for vin in tx.get('vin', []):
+                prevout = vin.get('prevout') or {}
+                inputs.append({'prev_out': {
+                                'addr': prevout.get('scriptpubkey_address'),
+                                'value': long(prevout.get('value', 0)),
+                                'tx_hash': vin.get('txid'),
+                                'n': vin.get('vout')}})
+            outputs = []
+            for n, vout in enumerate(tx.get('vout', [])):
+                outputs.append({'addr': vout.get('scriptpubkey_address'),
+                                'value': long(vout.get('value', 0)),
+                                'script': vout.get('scriptpubkey'),
+                                'n': n})
+            converted.append({
+                'hash': tx['txid'],
+                # unconfirmed transactions count as happening now
+                'time': status.get('block_time') or long(time.time()),
+                'block_height': status.get('block_height'),
+                'inputs': inputs,
+                'out': outputs})
+        return (converted, errors)
+
+    def exchange_rate(self, currency, verbose=False):
+        prices, errors = self._get_json("/v1/prices", verbose)
+        if errors:
+            return (1.0, errors)
+        try:
+            return (float(prices[currency]), errors)
+        except (KeyError, TypeError, ValueError) as e:
+            return (1.0, {currency: str(e)})
+
+
+class ProviderRouter(object):
+    """
+    Sends each call to the currently fastest healthy provider.
+
+    For every provider an exponentially weighted moving average of the
+    latency (successful calls only) and of the error rate (1 for a
+    failed call, 0 for a good one) is kept. A provider is healthy while
+    its error rate is below ``max_error_rate`` and it isn't cooling
+    down after failures. Calls go to healthy providers in order of
+    latency, failing over down the list, and only then to unhealthy
+    ones. A small share of the calls (``explore``) goes to a random
+    healthy provider, so a provider that got faster again is noticed.
+
+    It has the same methods as a provider, so it can be used as one.
+
+    """
+
+    def __init__(self, providers, alpha=0.2, max_error_rate=0.5,
+                 cooldown=30, explore=0.05):
+        self.providers = list(providers)
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.explore = explore
+        self.stats = dict((p.name, {'latency': None,
+                                    'error_rate': 0.0,
+                                    'failures': 0,
+                                    'down_until': 0,
+                                    'calls': 0})
+                          for p in self.providers)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # locks can't be pickled (e.g. to go to a shard worker)
+        d = self.__dict__.copy()
+        del d['lock']
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.lock = threading.Lock()
+
+    def _healthy(self, stats, now):
+        return stats['error_rate'] < self.max_error_rate and \
+               stats['down_until'] <= now
+
+    def ranked(self):
+        """Return the providers in the order the next call tries them."""
+        now = time.time()
+        with self.lock:
+            stats = dict((name, dict(s)) for name, s in self.stats.items())
+
+        def speed(p):
+            # providers we haven't heard from yet go first
+            return stats[p.name]['latency'] or 0.0
+
+        healthy = [p for p in self.providers
+                   if self._healthy(stats[p.name], now)]
+        unhealthy = [p for p in self.providers
+                     if not self._healthy(stats[p.name], now)]
+        healthy.sort(key=speed)
+        unhealthy.sort(key=lambda p: stats[p.name]['down_until'])
+        if len(healthy) > 1 and random.random() < self.explore:
+            healthy.insert(0, healthy.pop(random.randrange(len(healthy))))
+        return healthy + unhealthy
+
+    def _record(self, provider, seconds, failed):
+        a = self.alpha
+        with self.lock:
+            s = self.stats[provider.name]
+            s['calls'] += 1
+            s['error_rate'] = a * (1.0 if failed else 0.0) + \
+                              (1 - a) * s['error_rate']
+            if failed:
+                s['failures'] += 1
+                s['down_until'] = time.time() + \
+                                  self.cooldown * min(s['failures'], 10)
+            else:
+                s['failures'] = 0
+                if s['latency'] is None:
+                    s['latency'] = seconds
+                else:
+                    s['latency'] = a * seconds + (1 - a) * s['latency']
+
+    def call(self, method, *args, **kwargs):
+        """
+        Call ``method`` of the best provider, failing over on errors.
+
+        The return is the provider's tuple: (result, errors), with the
+        errors of the last provider tried if they all failed.
+
+        """
+        result = (None, {"router": "No providers"})
+        for provider in self.ranked():
+            started = time.time()
+            result = getattr(provider, method)(*args, **kwargs)
+            failed = bool(result[1])
+            self._record(provider, time.time() - started, failed)
+            if not failed:
+                break
+        return result
+
+    def balance(self, address, verbose=False):
+        return self.call('balance', address, verbose)
+
+    def unspent(self, address, verbose=False):
+        return self.call('unspent', address, verbose)
+
+    def transactions(self, address, verbose=False):
+        return self.call('transactions', address, verbose)
+
+    def exchange_rate(self, currency, verbose=False):
+        return self.call('exchange_rate', currency, verbose)
+
+
+def make_provider(spec):
+    """
+    Make a provider from a command line ``spec``: one of
+    "blockchain.info", "blockstream" or "mempool", or NAME=URL for an
+    Esplora API at URL (e.g. a local stand-in).
+
+    """
+    name, _, url = spec.partition("=")
+    if url:
+        return EsploraProvider(url, name)
+    if name == "blockchain.info":
+        return BlockchainInfoProvider()
+    if name == "blockstream":
+        return EsploraProvider("https://blockstream.info/api", name)
+    if name == "mempool":
+        return EsploraProvider("https://mempool.space/api", name)
+    raise ValueError("Unknown provider {0}".format(spec))
@@ -0,0 +1,207 @@
+"""
+sweepreload - defines WatchFileReloader class
+
+WatchFileReloader takes up changes to the watch file while the program
+keeps running (see --monitor with --reload), instead of it having to be
+restarted, and with it every connection, cache and subscription.
+
+The file is checked by its modification time and size, so an unchanged
+file costs one stat. A changed one is decrypted only from the first
+encrypted block that differs (see CryptConfig.read_encrypted_changes):
+the watch file is written with its dictionaries in key order (see
+dumps_sorted), so the same watches always give the same bytes and an
+edit only changes the file from the edited watch on. The pickle still
+has to be read whole, but then only the watches that differ are
+touched:
+- a new watch is added to its service's watch list
+- a watch that is gone is removed
+- a watch whose key, thresholds, schedule, destinations or
+  confirmation target changed is replaced
+Every other watch stays the very object it was, with whatever the run
+knows about it.
+
+Each watch list is changed by building the new dictionary aside and
+putting it in place in one step, so a thread going through the watches
+sees them all from before the change or all from after.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import os
+import pickle
+import threading
+from StringIO import StringIO
+
+__all__ = ["WatchFileReloader", "watch_fingerprint", "dumps_sorted"]
+
+
+class _SortedPickler(pickle.Pickler):
+    """A Pickler writing the items of dictionaries in key order."""
+
+    dispatch = dict(pickle.Pickler.dispatch)
+
+    def save_dict(self, obj):
+        if self.bin:
+            self.write(pickle.EMPTY_DICT)
+        else:
+            self.write(pickle.MARK + pickle.DICT)
+        self.memoize(obj)
+        self._batch_setitems(iter(sorted(obj.iteritems())))
+
+    dispatch[dict] = save_dict
+
+
+def dumps_sorted(obj):
+    """
+    pickle.dumps(obj), but with the dictionaries in key order: a watch
+    list read and written again pickles to the same bytes, whatever
+    order its dictionary happened to end up in.
+
+    >>> dumps_sorted({'b': 1, 'a': 2}) == pickle.dumps({'a': 2, 'b': 1})
+    True
+    >>> pickle.loads(dumps_sorted({'b': [1], 'a': {3: 4}}))
+    {'a': {3: 4}, 'b': [1]}
+
+    """
+    f = StringIO()
+    _SortedPickler(f).dump(obj)
+    return f.getvalue()
+
+
+def watch_fingerprint(watch):
+    """
+    What matters to a sweep about ``watch`` (a SweepAddressInfo), to tell
+    if it was changed.
+
+    """
+    return (watch.private_key,
+            watch.balance_threshold,
+            watch.time_threshold.duration,
+            getattr(watch.time_threshold, 'schedule', None),
+            tuple(sorted(watch.destinations.iteritems())),
+            getattr(watch, 'confirmation_target', None))
+
+
+class WatchFileReloader(object):
+    """
+    Keeps a service list (service name => service) up to date with its
+    watch file.
+
+    """
+
+    def __init__(self, service_list, data_file, cfg, on_change=None):
+        """
+        Constructor
+        ``service_list`` is the live service list read from ``data_file``
+        with the CryptConfig ``cfg``. After a change has been applied
+        ``on_change`` is called as on_change(added, removed, changed),
+        each a list of (service name, address).
+
+        """
+        self.service_list = service_list
+        self.data_file = data_file
+        self.cfg = cfg
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.verbose = False
+        self._stamp = self._stat()
+        # what the file was when last read, for the next decrypt
+        self._es, self._s = cfg.read_encrypted_changes(data_file)
+
+    def _stat(self):
+        try:
+            st = os.stat(self.data_file)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def check(self):
+        """
+        Apply the changes to the watch file since the last check.
+
+        The return is a tuple: (changes, errors), where
+        changes is a tuple of the added, removed and changed lists (see
+        the constructor), or None if the file didn't change.
+
+        """
+        with self.lock:
+            stamp = self._stat()
+            if stamp is None or stamp == self._stamp:
+                return (None, {})
+            try:
+                es, s = self.cfg.read_encrypted_changes(self.data_file,
+                                                        self._es,
+                                                        self._s)
+                service_list = pickle.loads(s)
+            except Exception as e:
+                # most likely caught half written, so try again next time
+                return (None, {self.data_file: "Can't read the watch file "
+                                               "- {0!r}".format(e)})
+            self._stamp = stamp
+            self._es, self._s = es, s
+            changes = self._apply(service_list)
+        if any(changes) and self.on_change is not None:
+            self.on_change(*changes)
+        return (changes, {})
+
+    def _apply(self, service_list):
+        """Make the live service list match ``service_list``."""
+        added, removed, changed = [], [], []
+        for name, service in service_list.iteritems():
+            live = self.service_list.get(name)
+            if live is None:
+                self.service_list[name] = service
+                added.extend((name, a) for a in sorted(service.watch_list))
+                continue
+            watch_list = dict(live.watch_list)
+            for address, watch in service.watch_list.iteritems():
+                old = watch_list.get(address)
+                if old is None:
+                    added.append((name, address))
+                elif watch_fingerprint(old) != watch_fingerprint(watch):
+                    changed.append((name, address))
+                else:
+                    continue
+                watch_list[address] = watch
+            for address in [a for a in watch_list
+                            if a not in service.watch_list]:
+                del watch_list[address]
+                removed.append((name, address))
+            live.watch_list = watch_list
+        for name in [n for n in self.service_list if n not in service_list]:
+            removed.extend((name, a)
+                           for a in sorted(self.service_list[name].watch_list))
+            del self.service_list[name]
+        if self.verbose and (added or removed or changed):
+            print "Watch file reloaded: {0} added, {1} removed, {2} " \
+                  "changed".format(len(added), len(removed), len(changed))
+        return (sorted(added), sorted(removed), sorted(changed))
+
+    def start(self, interval=10, verbose=False):
+        """Check the file every ``interval`` seconds in a background thread."""
+        self.verbose = verbose
+        self.thread = threading.Thread(target=self._run, args=(interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self, interval):
+        while not self.stopping.wait(interval):
+            changes, errors = self.check()
+            if errors and self.verbose:
+                for error in errors.itervalues():
+                    print error
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,277 @@
+"""
+sweepschedule - calendar schedules of sweeps
+
+A time threshold says when the next sweep of an address is allowed
+after the last one. Besides a plain ISO 8601 duration ("P1D"), it can
+have a schedule:
+- a cron expression, five fields (minute, hour, day of the month,
+  month, day of the week) as in crontab(5), or one of @yearly,
+  @monthly, @weekly, @daily and @hourly. "0 0 1 * *" sweeps on the
+  1st of each month, "0 0 * * fri" every Friday at midnight.
+- an ISO 8601 duration counted on the calendar: "P1M" after January
+  31st is the end of February, not 30 days later.
+All the times are UTC.
+
+A schedule is compiled once into an object whose next_fire() works out
+the next time it allows a sweep straight from the fields, so a
+scheduler can sleep until then instead of checking again and again.
+compile_schedule() keeps the compiled schedules, so the thousands of
+watches sharing a schedule share one object.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import re
+import bisect
+import calendar
+import threading
+from datetime import datetime, timedelta
+
+__all__ = ["CronSchedule", "CalendarDuration", "compile_schedule"]
+
+_ALIASES = {'@yearly': "0 0 1 1 *",
+            '@annually': "0 0 1 1 *",
+            '@monthly': "0 0 1 * *",
+            '@weekly': "0 0 * * 0",
+            '@daily': "0 0 * * *",
+            '@midnight': "0 0 * * *",
+            '@hourly': "0 * * * *"}
+_MONTHS = ["jan", "feb", "mar", "apr", "may", "jun",
+           "jul", "aug", "sep", "oct", "nov", "dec"]
+_DAYS = ["sun", "mon", "tue", "wed", "thu", "fri", "sat"]
+# a schedule that doesn't fire within this many years never will
+_HORIZON_YEARS = 8
+
+_DURATION = re.compile(r"^P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)W)?(?:(\d+)D)?"
+                       r"(?:(\d+)H)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+
+
+def _field(text, low, high, names=None):
+    """
+    The sorted values of a cron field ``text``, whose values go from
+    ``low`` to ``high``. ``names`` are the names of the values, from
+    ``low`` on.
+
+    >>> _field("*/15", 0, 59)
+    [0, 15, 30, 45]
+    >>> _field("mon-fri", 0, 7, _DAYS)
+    [1, 2, 3, 4, 5]
+    >>> _field("1,15,31", 1, 31)
+    [1, 15, 31]
+
+    """
+    def value(v):
+        v = v.lower()
+        if names and v in names:
+            return names.index(v) + low
+        n = int(v)
+        if not low <= n <= high:
+            raise ValueError("{0} is not from {1} to {2}".format(n, low, high))
+        return n
+
+    values = set()
+    for part in text.split(","):
+        part, _, step = part.partition("/")
+        step = int(step) if step else 1
+        if step < 1:
+            raise ValueError("Bad step {0}".format(step))
+        if part == "*":
+            first, last = low, high
+        elif "-" in part:
+            first, last = [value(v) for v in part.split("-", 1)]
+        else:
+            first = value(part)
+            last = high if step > 1 else first
+        if first > last:
+            raise ValueError("Bad range {0}".format(part))
+        values.update(range(first, last + 1, step))
+    return sorted(values)
+
+
+class CronSchedule(object):
+    """
+    A compiled cron expression, see the module docstring.
+
+    As in cron, if both the day of the month and the day of the week
+    are restricted, a day matching either will do.
+
+    """
+
+    def __init__(self, expression):
+        """
+        Constructor
+        Raises ValueError if ``expression`` isn't a cron expression.
+
+        """
+        self.expression = expression
+        text = _ALIASES.get(expression.strip().lower(), expression)
+        fields = text.split()
+        if len(fields) != 5:
+            raise ValueError("A cron expression has 5 fields: {0!r}".format(
+                                                                expression))
+        self.minutes = _field(fields[0], 0, 59)
+        self.hours = _field(fields[1], 0, 23)
+        self.days = _field(fields[2], 1, 31)
+        self.months = _field(fields[3], 1, 12, _MONTHS)
+        # Sunday is 0 or 7, and Python's Monday is 0
+        self.weekdays = set((d - 1) % 7
+                            for d in _field(fields[4], 0, 7, _DAYS))
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _day_matches(self, d):
+        in_month = d.day in self.days
+        in_week = d.weekday() in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next_fire(self, after):
+        """
+        The first time (seconds since the epoch) the schedule fires
+        after ``after`` (seconds since the epoch), or None if it never
+        does (like "0 0 30 2 *").
+
+        Each step moves to the next matching month, day, hour or minute
+        straight away, so it takes a few steps, whenever the last
+        sweep was.
+
+        >>> s = CronSchedule("0 0 1 * *")
+        >>> t = s.next_fire(calendar.timegm((2024, 1, 31, 12, 0, 0)))
+        >>> datetime.utcfromtimestamp(t)
+        datetime.datetime(2024, 2, 1, 0, 0)
+        >>> s = CronSchedule("30 9 * * fri")
+        >>> datetime.utcfromtimestamp(s.next_fire(t))
+        datetime.datetime(2024, 2, 2, 9, 30)
+        >>> CronSchedule("0 0 30 2 *").next_fire(t) is None
+        True
+
+        """
+        d = datetime.utcfromtimestamp(int(after) // 60 * 60) + \
+            timedelta(minutes=1)
+        last_year = d.year + _HORIZON_YEARS
+        while d.year <= last_year:
+            if d.month not in self.months:
+                i = bisect.bisect_left(self.months, d.month)
+                if i == len(self.months):
+                    d = datetime(d.year + 1, self.months[0], 1)
+                else:
+                    d = datetime(d.year, self.months[i], 1)
+                continue
+            if not self._day_matches(d):
+                i = bisect.bisect_right(self.days, d.day)
+                if self.any_weekday and i < len(self.days) and \
+                        self.days[i] <= calendar.monthrange(d.year,
+                                                            d.month)[1]:
+                    # only the day of the month matters, go straight to it
+                    d = datetime(d.year, d.month, self.days[i])
+                elif self.any_weekday:
+                    d = datetime(d.year, d.month, 1) + timedelta(days=31)
+                    d = d.replace(day=1)
+                else:
+                    d = datetime(d.year, d.month, d.day) + timedelta(days=1)
+                continue
+            if d.hour not in self.hours:
+                i = bisect.bisect_left(self.hours, d.hour)
+                if i == len(self.hours):
+                    d = datetime(d.year, d.month, d.day) + timedelta(days=1)
+                else:
+                    d = datetime(d.year, d.month, d.day, self.hours[i])
+                continue
+            if d.minute not in self.minutes:
+                i = bisect.bisect_left(self.minutes, d.minute)
+                if i == len(self.minutes):
+                    d = datetime(d.year, d.month, d.day, d.hour) + \
+                        timedelta(hours=1)
+                else:
+                    d = datetime(d.year, d.month, d.day, d.hour,
+                                 self.minutes[i])
+                continue
+            return calendar.timegm(d.utctimetuple())
+        return None
+
+
+class CalendarDuration(object):
+    """
+    An ISO 8601 duration, counted on the calendar (see the module
+    docstring). The time threshold's form, "P1Y2M3W4D5H", is accepted
+    as well as the standard "P1Y2M3W4DT5H6M7S".
+
+    """
+
+    def __init__(self, duration):
+        """
+        Constructor
+        Raises ValueError if ``duration`` isn't an ISO 8601 duration.
+
+        """
+        self.duration = duration
+        m = _DURATION.match(duration.strip().upper())
+        if m is None:
+            raise ValueError("Bad ISO 8601 duration {0!r}".format(duration))
+        years, months, weeks, days, hours, t_hours, minutes, seconds = \
+            [int(v or 0) for v in m.groups()]
+        self.months = years * 12 + months
+        self.delta = timedelta(weeks=weeks, days=days,
+                               hours=hours + t_hours,
+                               minutes=minutes, seconds=seconds)
+        self.seconds = self.delta.total_seconds()
+
+    def next_fire(self, after):
+        """
+        ``after`` (seconds since the epoch) plus the duration: the
+        months first, keeping the day of the month where the month is
+        long enough (or taking its last day), then the rest.
+
+        >>> t = calendar.timegm((2024, 1, 31, 12, 0, 0))
+        >>> datetime.utcfromtimestamp(CalendarDuration("P1M").next_fire(t))
+        datetime.datetime(2024, 2, 29, 12, 0)
+        >>> datetime.utcfromtimestamp(
+        ...     CalendarDuration("P1Y0M0W1D2H").next_fire(t))
+        datetime.datetime(2025, 2, 1, 14, 0)
+
+        """
+        if not self.months:
+            # UTC days are all as long, only months need the calendar
+            return after + self.seconds
+        d = datetime.utcfromtimestamp(after)
+        year, month = divmod(d.month - 1 + self.months, 12)
+        year += d.year
+        month += 1
+        day = min(d.day, calendar.monthrange(year, month)[1])
+        d = d.replace(year=year, month=month, day=day)
+        d += self.delta
+        return calendar.timegm(d.utctimetuple()) + d.microsecond / 1e6
+
+
+_compiled = {}
+_lock = threading.Lock()
+
+
+def compile_schedule(text):
+    """
+    The compiled schedule of ``text``, a cron expression or an ISO 8601
+    duration, shared by everything with the same schedule.
+
+    Raises ValueError if ``text`` is neither.
+
+    >>> compile_schedule("0 0 * * 5") is compile_schedule(" 0 0 * * 5")
+    True
+
+    """
+    key = " ".join(text.split())
+    schedule = _compiled.get(key)
+    if schedule is None:
+        if key.upper().startswith("P"):
+            schedule = CalendarDuration(key)
+        else:
+            schedule = CronSchedule(key)
+        with _lock:
+            schedule = _compiled.setdefault(key, schedule)
+    return schedule
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
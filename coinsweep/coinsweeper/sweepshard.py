@@ -0,0 +1,274 @@
+"""
+sweepshard - sharded sweeping across processes and hosts
+
+The watch list is partitioned by a hash of each address, so every
+process (or host) agrees on which shard an address belongs to. Before
+a worker touches a shard it takes a time-limited lease file for it in a
+lease directory. Overlapping runs, such as two cron jobs that ran long,
+or hosts sharing the lease directory over a network file system, can
+then never both sweep the same address. A crashed worker's lease simply
+expires.
+
+Where processes are forked, the coordinator packs the watch list into a
+WatchSnapshot in shared memory before starting the workers, and each
+worker reads just its shard's records from there, instead of every job
+carrying (and every worker unpickling) the whole watch list.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import os
+import time
+import json
+import errno
+import socket
+import hashlib
+import uuid
+import multiprocessing
+
+from sweepsnapshot import WatchSnapshot
+
+__all__ = ["shard_of", "ShardLease", "run_sharded"]
+
+
+def shard_of(address, shard_count):
+    """
+    Return the shard number (0 to ``shard_count`` - 1) of ``address``.
+
+    This has to give the same answer on every host and every Python
+    process, so it can't use the builtin hash().
+
+    """
+    digest = hashlib.sha1(address).hexdigest()
+    return int(digest[:8], 16) % shard_count
+
+
+class ShardLease(object):
+    """
+    A time-limited claim on one shard, held as a file in ``lease_dir``.
+
+    The file holds the owner and the expiry time (seconds since the
+    epoch) as JSON. A lease that has expired may be taken over by
+    anybody. All runs working on a watch file need to use the same
+    shard count, since the count is part of the lease file name.
+
+    """
+
+    # seconds to wait after taking over a stale lease before checking
+    # that nobody else took it over at the same time
+    settle_time = 0.5
+
+    def __init__(self, lease_dir, shard, shard_count, duration=600):
+        """
+        Constructor
+        ``duration`` is the number of seconds the lease is good for
+        after each acquire() or renew().
+
+        """
+        self.path = os.path.join(lease_dir,
+                                 "shard-{0}-of-{1}.lease".format(shard,
+                                                                 shard_count))
+        self.duration = duration
+        self.owner = "{0}:{1}:{2}".format(socket.gethostname(),
+                                          os.getpid(),
+                                          uuid.uuid4().hex)
+
+    def _read(self):
+        """Return the lease file contents as a dictionary (or None)."""
+        try:
+            with open(self.path) as lf:
+                return json.loads(lf.read())
+        except (IOError, ValueError):
+            return None
+
+    def _contents(self):
+        return json.dumps({'owner': self.owner,
+                           'expires': time.time() + self.duration})
+
+    def _write(self):
+        """Atomically replace the lease file with one we own."""
+        temp = "{0}.{1}".format(self.path, self.owner.rsplit(":", 1)[-1])
+        with open(temp, 'w') as lf:
+            lf.write(self._contents())
+        os.rename(temp, self.path)
+
+    def acquire(self):
+        """
+        Try to take the lease.
+
+        Returns True if we now hold it, False if somebody else does.
+
+        """
+        lease_dir = os.path.dirname(self.path)
+        if lease_dir and not os.path.exists(lease_dir):
+            try:
+                os.makedirs(lease_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                         0o600)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            held = self._read()
+            if held and held.get('expires', 0) > time.time():
+                return False
+            # the lease is stale (or unreadable), take it over and then
+            # make sure we weren't racing another run doing the same
+            self._write()
+            time.sleep(self.settle_time)
+            held = self._read()
+            return bool(held) and held.get('owner') == self.owner
+        with os.fdopen(fd, 'w') as lf:
+            lf.write(self._contents())
+        return True
+
+    def renew(self):
+        """
+        Extend the lease by another ``duration`` seconds.
+
+        Returns False if the lease has been lost (it expired and was
+        taken over), in which case the caller must stop work on the shard.
+        An expired lease isn't renewed, since another run may be taking
+        it over, and the lease is read back after writing it, in case
+        one did at the same time.
+
+        """
+        held = self._read()
+        if not held or held.get('owner') != self.owner or \
+                held.get('expires', 0) <= time.time():
+            return False
+        self._write()
+        held = self._read()
+        return bool(held) and held.get('owner') == self.owner
+
+    def release(self):
+        """Give up the lease, if we still hold it."""
+        held = self._read()
+        if held and held.get('owner') == self.owner:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+# the snapshot of the run's watch list, shared with forked workers
+_snapshot = None
+
+
+def _sweep_shard(job):
+    """
+    Worker: sweep every watched address belonging to one shard.
+
+    Runs in a child process, so everything comes in as one picklable
+    tuple and goes back as one too: (shard, results, errors, journal),
+    where results is a dictionary of service name => {address: result
+    record} (see iter_transactions) and journal holds the RunState
+    entries the shard changed (the coordinator saves them). The
+    service list is None when the worker reads its shard from the
+    snapshot.
+
+    """
+    (service_list, shard, shard_count, lease_dir, lease_time, state,
+     provider, engine, verbose) = job
+    results = {}
+    errors = {}
+    lease = ShardLease(lease_dir, shard, shard_count, lease_time)
+    if not lease.acquire():
+        errors[shard] = "Lease held by another run"
+        return (shard, results, errors, {})
+    try:
+        if service_list is None:
+            service_list = _snapshot.service_list(shard)
+        for service in service_list.itervalues():
+            r = {}
+            addresses = [a for a in service.watch_list
+                         if shard_of(a, shard_count) == shard]
+            for address in addresses:
+                # renew for every address, so a lease only ever has to
+                # outlive a single address' worth of work
+                if not lease.renew():
+                    errors[shard] = "Lease lost, shard abandoned"
+                    break
+                for record in service.iter_transactions(verbose,
+                                                        addresses=[address],
+                                                        state=state,
+                                                        provider=provider,
+                                                        engine=engine):
+                    r[address] = record
+            results[service.service_name] = r
+            if shard in errors:
+                break
+    finally:
+        lease.release()
+    journal = state.changed_entries() if state is not None else {}
+    return (shard, results, errors, journal)
+
+
+def run_sharded(service_list,
+                shard_count,
+                lease_dir,
+                shards=None,
+                processes=None,
+                lease_time=600,
+                state=None,
+                provider=None,
+                engine=None,
+                verbose=False):
+    """
+    The coordinator: sweep ``service_list`` as ``shard_count`` shards.
+
+    ``shards`` is the list of shard numbers this host should work on
+    (default: all of them), which is how the work gets split across
+    hosts sharing ``lease_dir``. Shards run in up to ``processes``
+    worker processes (default: one per CPU). Journal entries changed
+    by the workers are merged into ``state`` (a RunState), if given.
+    Every worker reads through its own copy of ``provider`` and signs
+    with its own copy of ``engine``, if given.
+
+    The return is a tuple: (results, errors), where
+    results is a dictionary of service name => {address: result
+    record}, see TxnServiceBlockChain.iter_transactions
+    errors is a dictionary of shard => reason the shard was skipped.
+
+    """
+    global _snapshot
+    if shards is None:
+        shards = range(shard_count)
+    results = {}
+    errors = {}
+    if not shards:
+        return (results, errors)
+    shared = None
+    if hasattr(os, 'fork'):
+        # the workers are forked after this, and share it
+        _snapshot = WatchSnapshot(service_list, shard_count, shard_of)
+        shared, service_list = service_list, None
+    jobs = [(service_list, shard, shard_count, lease_dir, lease_time, state,
+             provider, engine, verbose)
+            for shard in shards]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    try:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            # map_async().get() with a timeout keeps Ctrl-C working in the
+            # parent
+            done = pool.map_async(_sweep_shard, jobs).get(0x7fffffff)
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        if shared is not None:
+            _snapshot.close()
+            _snapshot = None
+    for shard, shard_results, shard_errors, journal in done:
+        for service_name, r in shard_results.iteritems():
+            results.setdefault(service_name, {}).update(r)
+        errors.update(shard_errors)
+        if state is not None:
+            state.merge(journal)
+    return (results, errors)
@@ -0,0 +1,408 @@
+"""
+sweepsign - secp256k1 ECDSA signing
+
+Enough elliptic curve arithmetic to derive public keys and to make
+bitcoin signatures: deterministic nonces (RFC 6979), low S values and
+DER encoding.
+
+Every signature needs one multiplication of the generator point G, so
+that is made cheap: a table of j * 256**i * G (for every byte position
+i and byte value j) is computed once, after which k * G is just 32
+point additions, one per byte of k, and no doublings. Points are kept
+in Jacobian coordinates so an addition needs no modular inverse;
+sign_many() then shares the remaining inverses (one per signature mod
+P for r, one mod N for s) between all the signatures it makes, with
+Montgomery's trick, so a batch costs two inverses in total.
+
+Run this file to check the known test vectors and to measure the
+signatures per second.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import hmac
+import time
+import hashlib
+import binascii
+
+__all__ = ["public_key", "public_keys", "sign", "sign_many", "verify", "der_encode",
+           "der_decode", "benchmark"]
+
+# the secp256k1 curve y**2 = x**3 + 7 over the integers mod P,
+# with generator G of order N
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+GX = 0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798
+GY = 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8
+
+# the point at infinity, in Jacobian coordinates
+_INFINITY = (0, 1, 0)
+
+
+def _inverse(a, m):
+    return pow(a, m - 2, m)
+
+
+def _batch_inverse(values, m):
+    """Inverses of all ``values`` mod prime ``m`` for one pow()."""
+    prefix = []
+    acc = 1
+    for v in values:
+        prefix.append(acc)
+        acc = acc * v % m
+    inv = _inverse(acc, m)
+    out = [0] * len(values)
+    for i in xrange(len(values) - 1, -1, -1):
+        out[i] = prefix[i] * inv % m
+        inv = inv * values[i] % m
+    return out
+
+
+def _double(p):
+    x, y, z = p
+    if not y or not z:
+        return _INFINITY
+    yy = y * y % P
+    s = 4 * x * yy % P
+    m = 3 * x * x % P
+    x3 = (m * m - 2 * s) % P
+    return (x3, (m * (s - x3) - 8 * yy * yy) % P, 2 * y * z % P)
+
+
+def _add_affine(p, x2, y2):
+    """Jacobian point ``p`` plus the affine point (x2, y2)."""
+    x1, y1, z1 = p
+    if not z1:
+        return (x2, y2, 1)
+    zz = z1 * z1 % P
+    h = (x2 * zz - x1) % P
+    r = (y2 * z1 * zz - y1) % P
+    if not h:
+        if not r:
+            return _double(p)
+        return _INFINITY
+    hh = h * h % P
+    hhh = h * hh % P
+    v = x1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    return (x3, (r * (v - x3) - y1 * hhh) % P, z1 * h % P)
+
+
+def _add(p, q):
+    """Jacobian point ``p`` plus Jacobian point ``q``."""
+    if not q[2]:
+        return p
+    if not p[2]:
+        return q
+    x1, y1, z1 = p
+    x2, y2, z2 = q
+    z1z1 = z1 * z1 % P
+    z2z2 = z2 * z2 % P
+    u1 = x1 * z2z2 % P
+    u2 = x2 * z1z1 % P
+    s1 = y1 * z2 * z2z2 % P
+    s2 = y2 * z1 * z1z1 % P
+    h = (u2 - u1) % P
+    r = (s2 - s1) % P
+    if not h:
+        if not r:
+            return _double(p)
+        return _INFINITY
+    hh = h * h % P
+    hhh = h * hh % P
+    v = u1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    return (x3, (r * (v - x3) - s1 * hhh) % P, z1 * z2 * h % P)
+
+
+def _to_affine(points):
+    """Affine (x, y) of Jacobian ``points`` (None for infinity)."""
+    finite = [p for p in points if p[2]]
+    inverses = iter(_batch_inverse([p[2] for p in finite], P))
+    out = []
+    for p in points:
+        if not p[2]:
+            out.append(None)
+            continue
+        zi = next(inverses)
+        zi2 = zi * zi % P
+        out.append((p[0] * zi2 % P, p[1] * zi2 * zi % P))
+    return out
+
+
+_table = None
+
+
+def _generator_table():
+    """
+    The table of multiples of G: _table[i][j] is j * 256**i * G
+    (affine, j from 1 to 255; index 0 is unused).
+
+    """
+    global _table
+    if _table is None:
+        table = []
+        base = (GX, GY)
+        for i in xrange(32):
+            row = [_INFINITY]
+            for j in xrange(1, 256):
+                row.append(_add_affine(row[-1], base[0], base[1]))
+            # 256 * base is the next row's base
+            next_base = _add_affine(row[-1], base[0], base[1])
+            row = _to_affine(row[1:] + [next_base])
+            base = row.pop()
+            table.append([None] + row)
+        _table = table
+    return _table
+
+
+def _multiply_g(k):
+    """k * G in Jacobian coordinates, using the table."""
+    table = _generator_table()
+    p = _INFINITY
+    i = 0
+    while k:
+        j = k & 0xFF
+        if j:
+            x, y = table[i][j]
+            p = _add_affine(p, x, y)
+        k >>= 8
+        i += 1
+    return p
+
+
+def _multiply(k, point):
+    """k * ``point`` (affine) in Jacobian coordinates, for any point."""
+    p = _INFINITY
+    for bit in bin(k)[2:]:
+        p = _double(p)
+        if bit == "1":
+            p = _add_affine(p, point[0], point[1])
+    return p
+
+
+def _int(data):
+    return long(binascii.hexlify(data), 16)
+
+
+def _bytes32(n):
+    return binascii.unhexlify("{0:064x}".format(n))
+
+
+def public_key(secret, compressed=True):
+    """
+    Return the serialized public key of the long ``secret``.
+
+    >>> binascii.hexlify(public_key(1))
+    '0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798'
+    >>> binascii.hexlify(public_key(3, False))[:66]
+    '04f9308a019258c31049344f85f89d5229b531c845836f99b08601f113bce036f9'
+
+    """
+    return public_keys([secret], compressed)[0]
+
+
+def public_keys(secrets, compressed=True):
+    """
+    Return the serialized public keys of all the longs in ``secrets``,
+    sharing one modular inverse between them.
+
+    ``compressed`` is either one flag for all of them or a list with
+    a flag per secret.
+
+    >>> [binascii.hexlify(k)[:8] for k in public_keys([1, 1], [True, False])]
+    ['0279be66', '0479be66']
+
+    """
+    if compressed in (True, False):
+        compressed = [compressed] * len(secrets)
+    points = _to_affine([_multiply_g(secret) for secret in secrets])
+    keys = []
+    for (x, y), c in zip(points, compressed):
+        if c:
+            keys.append(chr(2 + (y & 1)) + _bytes32(x))
+        else:
+            keys.append("\x04" + _bytes32(x) + _bytes32(y))
+    return keys
+
+
+def _nonces(secret, digest):
+    """The RFC 6979 (HMAC-SHA256) nonces for signing ``digest``."""
+    x = _bytes32(secret)
+    h = _bytes32(_int(digest) % N)
+    v = "\x01" * 32
+    k = "\x00" * 32
+    k = hmac.new(k, v + "\x00" + x + h, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    k = hmac.new(k, v + "\x01" + x + h, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    while True:
+        v = hmac.new(k, v, hashlib.sha256).digest()
+        nonce = _int(v)
+        if 0 < nonce < N:
+            yield nonce
+        k = hmac.new(k, v + "\x00", hashlib.sha256).digest()
+        v = hmac.new(k, v, hashlib.sha256).digest()
+
+
+def sign_many(secret, digests):
+    """
+    Sign each of the 32 byte ``digests`` with the long ``secret``.
+
+    Returns a list of (r, s) tuples, with s in the lower half of the
+    range as bitcoin relay policy requires.
+
+    """
+    nonces = []
+    points = []
+    for digest in digests:
+        gen = _nonces(secret, digest)
+        k = next(gen)
+        nonces.append((gen, k))
+        points.append(_multiply_g(k))
+    xs = _to_affine(points)
+    k_inverses = _batch_inverse([k for gen, k in nonces], N)
+    signatures = []
+    for digest, (gen, k), xy, k_inverse in zip(digests, nonces, xs,
+                                               k_inverses):
+        z = _int(digest) % N
+        while True:
+            r = xy[0] % N
+            s = k_inverse * (z + r * secret) % N
+            if r and s:
+                break
+            # vanishingly unlikely, but RFC 6979 says what to do
+            k = next(gen)
+            xy = _to_affine([_multiply_g(k)])[0]
+            k_inverse = _inverse(k, N)
+        if s > N // 2:
+            s = N - s
+        signatures.append((r, s))
+    return signatures
+
+
+def sign(secret, digest):
+    """
+    Sign the 32 byte ``digest`` with the long ``secret``.
+
+    The return is a tuple: (r, s)
+
+    >>> r, s = sign(1, hashlib.sha256("Satoshi Nakamoto").digest())
+    >>> "{0:064x}".format(r)
+    '934b1ea10a4b3c1757e2b0c017d0b6143ce3c9a7e6a4a49860d7a6ab210ee3d8'
+    >>> "{0:064x}".format(s)
+    '2442ce9d2b916064108014783e923ec36b49743e2ffa1c4496f01a512aafd9e5'
+
+    """
+    return sign_many(secret, [digest])[0]
+
+
+def verify(pubkey, digest, signature):
+    """
+    Check the (r, s) ``signature`` of ``digest`` by the serialized
+    public key ``pubkey``. Slow, it is meant for checking.
+
+    >>> digest = hashlib.sha256("coinsweep").digest()
+    >>> sig = sign(12345, digest)
+    >>> verify(public_key(12345), digest, sig)
+    True
+    >>> verify(public_key(12346, False), digest, sig)
+    False
+
+    """
+    r, s = signature
+    if not (0 < r < N and 0 < s < N):
+        return False
+    x = _int(pubkey[1:33])
+    if pubkey[0] == "\x04":
+        y = _int(pubkey[33:65])
+    else:
+        y = pow((x * x * x + 7) % P, (P + 1) // 4, P)
+        if (y & 1) != (ord(pubkey[0]) & 1):
+            y = P - y
+    w = _inverse(s, N)
+    u1 = _int(digest) % N * w % N
+    u2 = r * w % N
+    point = _to_affine([_add(_multiply_g(u1), _multiply(u2, (x, y)))])[0]
+    return point is not None and point[0] % N == r
+
+
+def _der_int(n):
+    b = binascii.unhexlify("{0:064x}".format(n)).lstrip("\x00") or "\x00"
+    if ord(b[0]) & 0x80:
+        b = "\x00" + b
+    return "\x02" + chr(len(b)) + b
+
+
+def der_encode(signature):
+    """
+    DER encode the (r, s) ``signature``.
+
+    >>> binascii.hexlify(der_encode((1, 128)))
+    '300702010102020080'
+
+    """
+    body = _der_int(signature[0]) + _der_int(signature[1])
+    return "\x30" + chr(len(body)) + body
+
+
+def der_decode(der):
+    """
+    Decode a DER encoded signature, returning (r, s).
+    Raises ValueError if it isn't one.
+
+    >>> der_decode(der_encode((1, 128)))
+    (1L, 128L)
+
+    """
+    try:
+        if der[0] != "\x30" or ord(der[1]) != len(der) - 2:
+            raise ValueError("Not a DER signature")
+        values = []
+        at = 2
+        for i in range(2):
+            if der[at] != "\x02":
+                raise ValueError("Not a DER integer")
+            length = ord(der[at + 1])
+            values.append(_int(der[at + 2:at + 2 + length]))
+            at += 2 + length
+    except IndexError:
+        raise ValueError("Truncated DER signature")
+    return tuple(values)
+
+
+def benchmark(count=1000):
+    """
+    Time signing ``count`` digests, one at a time and as a batch.
+
+    Returns a dictionary of signatures per second: 'single' and
+    'batch', plus 'table' the seconds it took to build the table.
+
+    """
+    started = time.time()
+    _generator_table()
+    table_seconds = time.time() - started
+    digests = [hashlib.sha256(str(i)).digest() for i in xrange(count)]
+    secret = _int(hashlib.sha256("benchmark").digest()) % N
+
+    started = time.time()
+    for digest in digests:
+        sign(secret, digest)
+    single = count / (time.time() - started)
+
+    started = time.time()
+    sign_many(secret, digests)
+    batch = count / (time.time() - started)
+    return {'table': table_seconds, 'single': single, 'batch': batch}
+
+
+if __name__ == "__main__":
+    import doctest
+    results = benchmark()
+    doctest.testmod()
+    print "Table built in {0:.2f} seconds".format(results['table'])
+    print "Signatures per second, one at a time: {0:.0f}".format(
+                                                        results['single'])
+    print "Signatures per second, batched:       {0:.0f}".format(
+                                                        results['batch'])
@@ -0,0 +1,301 @@
+"""
+sweepsim - backtesting of sweep configurations
+
+Replays recorded deposit histories and a BTC/USD price series through
+the same threshold, time and destination rules a live run uses, for
+every address at once, so the effect of a change in thresholds or
+destination splits can be seen before it is made.
+
+Each simulated tick does what a run of process_transactions would do
+at that time: sweep every address whose confirmed balance is over its
+threshold and whose time threshold (its duration, or its calendar
+schedule) allows a send, paying the fee of
+estimate_fee() and splitting the rest the way build_transaction() does
+(including refusing to send when the split doesn't add up).
+
+The history is a list of deposit events (tick, address index, satoshis)
+rather than a dense address x tick matrix, since 100k addresses times
+a year of hourly ticks would not fit in memory as a matrix. Per tick
+the only work over all addresses is one vectorized eligibility test;
+payouts are computed just for the addresses that sweep.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import math
+import time
+
+# This next library needs to be installed (only for simulations)
+#    http://www.numpy.org/ or pip install numpy
+import numpy as np
+
+from sweepaddress import TimeThreshold, parse_send_amount
+from sweepblockchain import estimate_fee
+
+__all__ = ["SimConfig", "load_history", "events_from_inflows",
+           "events_from_balances", "simulate"]
+
+
+class SimConfig(object):
+    """
+    One candidate configuration to simulate, applied to every address.
+
+    ``balance_threshold`` is in satoshis, ``duration`` is an ISO 8601
+    duration and ``schedule`` a calendar schedule (or None), as used by
+    TimeThreshold, and ``destinations`` is a dictionary of address =>
+    send_amount, as in SweepAddressInfo.
+
+    """
+
+    def __init__(self, name, balance_threshold, duration, destinations,
+                 schedule=None):
+        self.name = name
+        self.balance_threshold = balance_threshold
+        self.duration = duration
+        self.destinations = destinations
+        self.schedule = schedule
+
+    @classmethod
+    def from_watch(cls, name, sweep_address):
+        """Make a SimConfig with the settings of a SweepAddressInfo."""
+        return cls(name,
+                   sweep_address.balance_threshold,
+                   sweep_address.time_threshold.duration,
+                   dict(sweep_address.destinations),
+                   getattr(sweep_address.time_threshold, 'schedule', None))
+
+    def time_threshold(self):
+        """The TimeThreshold of the configuration."""
+        threshold = TimeThreshold()
+        threshold.duration = self.duration
+        threshold.schedule = self.schedule
+        return threshold
+
+
+def events_from_inflows(inflows):
+    """
+    Turn a dense (ticks x addresses) array of deposits into events.
+
+    The return is a tuple of arrays: (ticks, address_indexes, values).
+
+    """
+    inflows = np.asarray(inflows)
+    ticks, addrs = np.nonzero(inflows > 0)
+    return (ticks, addrs, inflows[ticks, addrs].astype(np.int64))
+
+
+def events_from_balances(balances):
+    """
+    Turn a dense (ticks x addresses) array of recorded balances into
+    deposit events. Every increase of a balance counts as a deposit,
+    decreases (the recorded sweeps) are ignored.
+
+    """
+    balances = np.asarray(balances, dtype=np.int64)
+    inflows = np.diff(balances, axis=0)
+    inflows = np.vstack([balances[:1], np.clip(inflows, 0, None)])
+    return events_from_inflows(inflows)
+
+
+def load_history(file_):
+    """
+    Load a recorded history from a NumPy .npz file.
+
+    The file holds 'prices' (USD per BTC, one per tick) and either the
+    deposit events 'ticks', 'addresses' and 'values', a dense
+    'inflows' array or a dense 'balances' array (ticks x addresses).
+    It may also hold 'tick_seconds' (default 3600) and 'start', the
+    time of the first tick in seconds since the epoch (default 0), which
+    a calendar schedule is counted from.
+
+    Returns a dictionary of the keyword arguments for simulate()
+    (other than the configuration).
+
+    """
+    data = np.load(file_)
+    if 'ticks' in data.files:
+        events = (data['ticks'], data['addresses'], data['values'])
+    elif 'inflows' in data.files:
+        events = events_from_inflows(data['inflows'])
+    else:
+        events = events_from_balances(data['balances'])
+    address_count = int(events[1].max()) + 1 if len(events[1]) else 0
+    if 'address_count' in data.files:
+        address_count = int(data['address_count'])
+    tick_seconds = 3600
+    if 'tick_seconds' in data.files:
+        tick_seconds = int(data['tick_seconds'])
+    start = 0
+    if 'start' in data.files:
+        start = int(data['start'])
+    return {'events': events,
+            'prices': data['prices'],
+            'address_count': address_count,
+            'tick_seconds': tick_seconds,
+            'start': start}
+
+
+def _next_ticks(threshold, start, tick_seconds):
+    """
+    A function of a tick giving the first tick a send is allowed at
+    after a sweep at that tick (None if never), the way
+    iter_transactions decides it (see _window_opens): the next time
+    after the sweep the time threshold allows, less 5 minutes for a
+    duration. Ticks are ``tick_seconds`` apart from ``start``.
+
+    >>> t = TimeThreshold()
+    >>> t.duration = "P0Y0M0W1D0H"
+    >>> t.schedule = None
+    >>> _next_ticks(t, 0, 3600)(5)
+    29
+    >>> t.schedule = "0 0 * * *"
+    >>> _next_ticks(t, 0, 3600)(5)
+    24
+
+    """
+    margin = 0 if threshold.schedule else 300
+
+    def next_tick(t):
+        opens = threshold.next_allowed(start + t * tick_seconds)
+        if opens is None:
+            return None
+        return max(int(math.ceil(float(opens - margin - start) /
+                                 tick_seconds)), t)
+
+    return next_tick
+
+
+def simulate(config,
+             events,
+             prices,
+             address_count,
+             tick_seconds=3600,
+             confirmation_ticks=0,
+             start=0):
+    """
+    Run ``config`` (a SimConfig) over a recorded history.
+
+    ``events`` is a tuple of equal length arrays (ticks, address
+    indexes, satoshis) of the deposits, ``prices`` has the USD price of
+    a bitcoin for every tick. Deposits only count toward the balance
+    ``confirmation_ticks`` after they arrive, like the confirmations
+    required by fetch_balance. Every deposit is one more input to spend,
+    which is what drives the fees. Tick 0 is at ``start`` (seconds since
+    the epoch), for a calendar schedule.
+
+    Returns a dictionary of
+    - name: the name of the configuration
+    - sweeps: the number of sweep transactions sent
+    - failed: the number of times a sweep was refused because the
+      split of the destinations didn't fit the balance
+    - fees: the total fees paid, in satoshis
+    - amounts: destination address => satoshis received
+    - dust: satoshis lost to rounding when splitting balances
+    - left: satoshis still sitting in the addresses at the end
+    - seconds: how long the simulation took
+
+    """
+    started = time.time()
+    prices = np.asarray(prices, dtype=np.float64)
+    tick_count = len(prices)
+    ticks, addrs, values = [np.asarray(a) for a in events]
+    ticks = ticks.astype(np.int64) + confirmation_ticks
+    order = np.argsort(ticks, kind='mergesort')
+    ticks = ticks[order]
+    addrs = addrs[order].astype(np.int64)
+    values = values[order].astype(np.int64)
+    # events of tick t are bounds[t]:bounds[t + 1]
+    bounds = np.searchsorted(ticks, np.arange(tick_count + 1))
+
+    # every address swept at a tick may send again at the same tick
+    next_allowed = _next_ticks(config.time_threshold(), start, tick_seconds)
+    never = np.iinfo(np.int64).max
+
+    rules = [(dest, ) + parse_send_amount(amount)
+             for dest, amount in config.destinations.iteritems()]
+    balance_count = sum(1 for rule in rules if rule[1] == "balance")
+    output_count = len(rules)
+    # unless a rule is in dollars (and the price moves) a refused
+    # sweep can't succeed before the next deposit changes the balance
+    price_bound = any(rule[1] == "dollars" for rule in rules)
+
+    balance = np.zeros(address_count, dtype=np.int64)
+    inputs = np.zeros(address_count, dtype=np.int64)
+    # first tick each address may sweep at (never swept: right away)
+    next_tick = np.zeros(address_count, dtype=np.int64)
+    refused = np.zeros(address_count, dtype=bool)
+
+    amounts = dict((rule[0], 0) for rule in rules)
+    sweeps = 0
+    failed = 0
+    fees_paid = 0
+    dust = 0
+    for t in xrange(tick_count):
+        lo, hi = bounds[t], bounds[t + 1]
+        if hi > lo:
+            np.add.at(balance, addrs[lo:hi], values[lo:hi])
+            np.add.at(inputs, addrs[lo:hi], 1)
+            refused[addrs[lo:hi]] = False
+        due = np.flatnonzero((balance > config.balance_threshold) &
+                             (next_tick <= t) &
+                             ~refused)
+        if not due.size:
+            continue
+
+        # build_transaction, for all the due addresses at once
+        fees = estimate_fee(inputs[due], output_count)
+        spend = balance[due] - fees
+        left = spend.copy()
+        paid = []
+        for dest, kind, value in rules:
+            if kind == "percent":
+                amount = (spend * value / 100).astype(np.int64)
+            elif kind == "dollars":
+                amount = np.full(due.size, long(value / prices[t] * 1e8),
+                                 dtype=np.int64)
+            elif kind == "satoshis":
+                amount = np.full(due.size, value, dtype=np.int64)
+            else:
+                continue
+            left -= amount
+            paid.append((dest, amount))
+        ok = left >= 0
+        if balance_count:
+            share = left // balance_count
+            for dest, kind, value in rules:
+                if kind == "balance":
+                    paid.append((dest, share))
+            dust += int((left[ok] % balance_count).sum())
+        else:
+            # without a balance destination the rest would go to fees
+            ok &= left <= 0
+
+        failed += int(due.size - ok.sum())
+        if not price_bound:
+            refused[due[~ok]] = True
+        swept = due[ok]
+        if not swept.size:
+            continue
+        for dest, amount in paid:
+            amounts[dest] += int(amount[ok].sum())
+        fees_paid += int(fees[ok].sum())
+        sweeps += swept.size
+        balance[swept] = 0
+        inputs[swept] = 0
+        opens = next_allowed(t)
+        next_tick[swept] = never if opens is None else opens
+
+    return {'name': config.name,
+            'sweeps': sweeps,
+            'failed': failed,
+            'fees': fees_paid,
+            'amounts': amounts,
+            'dust': dust,
+            'left': int(balance.sum()),
+            'seconds': time.time() - started}
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,251 @@
+"""
+sweepsnapshot - defines WatchSnapshot class
+
+A WatchSnapshot is a decoded watch list packed into one flat, read-only
+block of shared memory, for worker processes (see run_sharded) to read
+instead of each unpickling the whole watch list for itself.
+
+The parent decrypts and unpickles the watch file once, and packs it into
+an anonymous shared memory map before the workers are started. A forked
+worker sees the same pages (nothing is copied, so the memory doesn't
+grow with the number of workers) and reads only the records of its own
+shard, each when it gets to it:
+- the header: the number of records, services and shards
+- the services, with empty watch lists (a small pickle)
+- for each shard, where its records start in the offset table, and
+  how many there are
+- the offset table: where each record is, the records in shard order
+- the records: the service, the balance threshold and confirmation
+  target, then the address, private key, duration and schedule, then
+  the destinations, each with its send_amount both as written and as
+  parse_send_amount() reads it
+
+The map is anonymous, so the private keys in it are never in a file;
+close() overwrites it before letting it go.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import mmap
+import copy
+import struct
+import pickle
+
+from sweepaddress import SweepAddressInfo, parse_send_amount
+
+__all__ = ["WatchSnapshot"]
+
+_MAGIC = "CSWS"
+_HEADER = struct.Struct("<4sIIII")
+_SHARD = struct.Struct("<II")
+_OFFSET = struct.Struct("<Q")
+# service, confirmation target (-1 for none), balance threshold
+_RECORD = struct.Struct("<Hiq")
+_LENGTH = struct.Struct("<H")
+# kind, value
+_AMOUNT = struct.Struct("<Bd")
+_KINDS = [None, "percent", "dollars", "satoshis", "balance"]
+
+
+def _pack_string(s):
+    s = s or ""
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    return _LENGTH.pack(len(s)) + s
+
+
+def _pack_record(service_index, watch):
+    target = getattr(watch, 'confirmation_target', None)
+    parts = [_RECORD.pack(service_index,
+                          -1 if target is None else target,
+                          watch.balance_threshold),
+             _pack_string(watch.address),
+             _pack_string(watch.private_key),
+             _pack_string(watch.time_threshold.duration),
+             _pack_string(getattr(watch.time_threshold, 'schedule', None)),
+             _LENGTH.pack(len(watch.destinations))]
+    for destination, amount in sorted(watch.destinations.iteritems()):
+        try:
+            kind, value = parse_send_amount(amount)
+        except (ValueError, IndexError):
+            # left for the sweep to report, as it would be
+            kind, value = None, 0
+        parts.extend([_pack_string(destination),
+                      _pack_string(amount),
+                      _AMOUNT.pack(_KINDS.index(kind), value)])
+    return "".join(parts)
+
+
+class WatchSnapshot(object):
+    """
+    A service list (service name => service) packed into shared memory,
+    see the module docstring.
+
+    The snapshot has to be made before the worker processes are
+    forked, for them to share it.
+
+    """
+
+    def __init__(self, service_list, shard_count=1, shard_of=None):
+        """
+        Constructor
+        Packs ``service_list``, with its addresses split into
+        ``shard_count`` shards by ``shard_of``, a function of (address,
+        shard_count) giving the shard number (see sweepshard). Without
+        one every address is in shard 0.
+
+        """
+        names = sorted(service_list)
+        shells = []
+        shards = [[] for _ in range(shard_count)]
+        for index, name in enumerate(names):
+            service = service_list[name]
+            # the service without its watches, which the records hold
+            shell = copy.copy(service)
+            shell.watch_list = {}
+            shells.append(shell)
+            for address in sorted(service.watch_list):
+                shard = shard_of(address, shard_count) if shard_of else 0
+                shards[shard].append(
+                    _pack_record(index, service.watch_list[address]))
+        services = pickle.dumps((names, shells), pickle.HIGHEST_PROTOCOL)
+        count = sum(len(records) for records in shards)
+
+        table = _HEADER.size + 4 + len(services) + _SHARD.size * shard_count
+        first = table + _OFFSET.size * count
+        size = first + sum(len(r) for records in shards for r in records)
+        self.map = mmap.mmap(-1, max(size, 1))
+        self.map.write(_HEADER.pack(_MAGIC, 1, count, len(names),
+                                    shard_count))
+        self.map.write(struct.pack("<I", len(services)) + services)
+        start = 0
+        for records in shards:
+            self.map.write(_SHARD.pack(start, len(records)))
+            start += len(records)
+        offset = first
+        for records in shards:
+            for record in records:
+                self.map.write(_OFFSET.pack(offset))
+                offset += len(record)
+        for records in shards:
+            for record in records:
+                self.map.write(record)
+        self.count = count
+        self.shard_count = shard_count
+        self._services = _HEADER.size
+        self._shards = _HEADER.size + 4 + len(services)
+        self._offsets = table
+
+    def __len__(self):
+        return self.count
+
+    def shard_records(self, shard):
+        """The numbers of the records of ``shard``."""
+        start, count = _SHARD.unpack_from(self.map,
+                                          self._shards + _SHARD.size * shard)
+        return xrange(start, start + count)
+
+    def _string(self, offset):
+        length, = _LENGTH.unpack_from(self.map, offset)
+        offset += _LENGTH.size
+        return (self.map[offset:offset + length], offset + length)
+
+    def _read(self, i):
+        """The fields of record ``i``, the service number first."""
+        offset, = _OFFSET.unpack_from(self.map,
+                                      self._offsets + _OFFSET.size * i)
+        service, target, threshold = _RECORD.unpack_from(self.map, offset)
+        offset += _RECORD.size
+        address, offset = self._string(offset)
+        private_key, offset = self._string(offset)
+        duration, offset = self._string(offset)
+        schedule, offset = self._string(offset)
+        count, = _LENGTH.unpack_from(self.map, offset)
+        offset += _LENGTH.size
+        destinations = []
+        for _ in range(count):
+            destination, offset = self._string(offset)
+            amount, offset = self._string(offset)
+            kind, value = _AMOUNT.unpack_from(self.map, offset)
+            offset += _AMOUNT.size
+            kind = _KINDS[kind]
+            if kind in ("satoshis", "balance"):
+                value = long(value)
+            destinations.append((destination, amount, kind, value))
+        return (service, target, threshold, address, private_key, duration,
+                schedule, destinations)
+
+    def destinations(self, i):
+        """
+        The destinations of record ``i``, as a list of (destination,
+        kind, value), see parse_send_amount (kind is None for an amount
+        it can't read).
+
+        """
+        return [(destination, kind, value)
+                for destination, _, kind, value in self._read(i)[7]]
+
+    def record(self, i):
+        """Record ``i`` as a SweepAddressInfo."""
+        return self._record(i)[1]
+
+    def _record(self, i):
+        """Record ``i``: (service number, SweepAddressInfo)."""
+        (service, target, threshold, address, private_key, duration,
+         schedule, destinations) = self._read(i)
+        watch = SweepAddressInfo()
+        watch.address = address
+        watch.private_key = private_key
+        watch.balance_threshold = threshold
+        watch.confirmation_target = None if target < 0 else target
+        watch.time_threshold.duration = duration
+        watch.time_threshold.schedule = schedule or None
+        watch.destinations = dict((destination, amount)
+                                  for destination, amount, _, _
+                                  in destinations)
+        return (service, watch)
+
+    def service_list(self, shard=None):
+        """
+        A service list of the records of ``shard`` (or of them all),
+        each service a copy of its own.
+
+        >>> watch = SweepAddressInfo()
+        >>> watch.address = "1Source"
+        >>> watch.private_key = "secret"
+        >>> watch.destinations = {"1Cold": "50%", "1Change": "0"}
+        >>> from sweepblockchain import TxnServiceBlockChain
+        >>> service = TxnServiceBlockChain()
+        >>> service.watch_list[watch.address] = watch
+        >>> snapshot = WatchSnapshot({"test": service})
+        >>> w = snapshot.service_list()["test"].watch_list["1Source"]
+        >>> w.private_key, sorted(w.destinations.items())
+        ('secret', [('1Change', '0'), ('1Cold', '50%')])
+        >>> snapshot.destinations(0)
+        [('1Change', 'balance', 0L), ('1Cold', 'percent', 50.0)]
+        >>> snapshot.close()
+
+        """
+        length, = struct.unpack_from("<I", self.map, self._services)
+        start = self._services + 4
+        names, shells = pickle.loads(self.map[start:start + length])
+        shards = range(self.shard_count) if shard is None else [shard]
+        for shard in shards:
+            for i in self.shard_records(shard):
+                service, watch = self._record(i)
+                shells[service].watch_list[watch.address] = watch
+        return dict(zip(names, shells))
+
+    def close(self):
+        """Overwrite the snapshot (it holds private keys) and let it go."""
+        if self.map is not None:
+            self.map.seek(0)
+            self.map.write("\0" * len(self.map))
+            self.map.close()
+            self.map = None
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,314 @@
+"""
+sweepstate - defines RunState class
+
+RunState is a journal kept between runs. For every watched address it
+remembers the last balance seen, the last time coins were sent from
+the address, the last decision made about it and the time at which
+that decision could next change. process_transactions uses it to
+avoid asking the API questions it already knows the answers to.
+
+It also learns how fast coins flow into each address, from the changes
+in balance between observations, and uses that to predict when an
+address below its threshold could cross it. Until then its balance
+isn't checked, except for a small random sample of checks that catches
+deposits the prediction didn't expect. Idle addresses are checked
+rarely (at least every max_interval), busy ones often.
+
+The journal holds no private keys, only public information about the
+addresses, so it is stored as plain JSON next to the data file.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import os
+import json
+import math
+import time
+import random
+import threading
+
+__all__ = ["RunState"]
+
+
+def _rule(sweep_address):
+    """
+    The parts of a watch that decisions depend on. If these change
+    (the user edited the watch) the remembered decision is useless.
+
+    """
+    rule = "{0}|{1}".format(sweep_address.balance_threshold,
+                            sweep_address.time_threshold.duration)
+    schedule = getattr(sweep_address.time_threshold, 'schedule', None)
+    if schedule:
+        rule += "|" + schedule
+    return rule
+
+
+class RunState(object):
+    """
+    The run-state journal.
+
+    ``self.entries`` is a dictionary of address => entry, where entry
+    is a dictionary of
+    - balance: last balance seen (satoshis)
+    - last_send: seconds since the epoch of the newest send seen,
+      or None if the address has never sent
+    - decision: the last result string for the address
+    - next_change: seconds since the epoch when the decision could
+      next change, or None if it could change at any time
+    - rule: see _rule(), to notice edited watches
+    - updated: seconds since the epoch the entry was written
+    - rate: the estimated inflow, in satoshis per second (None until
+      two balances have been seen)
+    - rate_var: the variance of that estimate
+    - base: the balance new inflow is measured from
+    - observed: seconds since the epoch the balance was last seen
+    - next_check: seconds since the epoch when the balance needs to be
+      checked again, or None if every run should check it
+    - pending_tx: the hash of a send that hasn't confirmed yet, and
+      pending_until: when to stop waiting for it (see sweeptrack)
+    - confirm_latency: about how many seconds sends from the address
+      take to confirm
+
+    The journal can be changed from several threads at once (a monitor's
+    worker and a ConfirmationTracker, say): every change and save goes
+    through ``self.lock``.
+
+    """
+
+    # the inflow rate is averaged over about this many seconds
+    rate_horizon = 7 * 24 * 3600
+    # how many standard deviations above the rate to plan for
+    confidence = 2.0
+
+    def __init__(self, file_=None, max_interval=24 * 3600, sample_rate=0.02):
+        """
+        Constructor
+        ``file_`` is the journal file, it is read if it exists.
+        Without a file the journal only lasts as long as the object.
+        ``max_interval`` is the most seconds a balance goes unchecked,
+        ``sample_rate`` is the share of the skipped checks that are
+        done anyway.
+
+        """
+        self.file_ = file_
+        self.max_interval = max_interval
+        self.sample_rate = sample_rate
+        self.entries = {}
+        self.changed = set()
+        self.lock = threading.RLock()
+        if file_ and os.path.exists(file_):
+            with open(file_) as sf:
+                try:
+                    self.entries = json.loads(sf.read())
+                except ValueError:
+                    # a damaged journal only costs us some API calls
+                    self.entries = {}
+
+    def __getstate__(self):
+        # a journal goes to worker processes (see run_sharded) without
+        # its lock
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def get(self, sweep_address):
+        """
+        Return the journal entry for ``sweep_address`` (a SweepAddressInfo),
+        or None if there isn't one or the watch has changed since.
+
+        """
+        entry = self.entries.get(sweep_address.address)
+        if entry is None or entry.get('rule') != _rule(sweep_address):
+            return None
+        return entry
+
+    def update(self, sweep_address, **kwargs):
+        """
+        Update (or create) the entry of ``sweep_address`` with the
+        keyword arguments given, see the class docstring for the keys.
+
+        A ``balance`` is also used to learn the inflow rate and plan
+        the next check; ``swept=True`` says the balance has just been
+        sent on, so new inflow starts from nothing.
+
+        """
+        swept = kwargs.pop('swept', False)
+        now = time.time()
+        with self.lock:
+            entry = self.get(sweep_address)
+            if entry is None:
+                entry = {'balance': None,
+                         'last_send': None,
+                         'decision': None,
+                         'next_change': None}
+            if kwargs.get('balance') is not None:
+                self._learn(entry, kwargs['balance'], now)
+            entry.update(kwargs)
+            if swept:
+                entry['base'] = 0
+                entry['next_check'] = None
+            elif kwargs.get('balance') is not None:
+                entry['next_check'] = self._plan(entry, sweep_address, now)
+            entry['rule'] = _rule(sweep_address)
+            entry['updated'] = now
+            self.entries[sweep_address.address] = entry
+            self.changed.add(sweep_address.address)
+        return entry
+
+    def edit(self, address, change):
+        """
+        Change the entry of ``address`` (if there is one) by calling
+        change(entry), holding the lock. Returns the entry.
+
+        """
+        with self.lock:
+            entry = self.entries.get(address)
+            if entry is not None:
+                change(entry)
+                self.changed.add(address)
+        return entry
+
+    def _learn(self, entry, balance, now):
+        """Fold the inflow since the last observation into the rate."""
+        base = entry.get('base')
+        observed = entry.get('observed')
+        entry['base'] = balance
+        entry['observed'] = now
+        if base is None or observed is None or now <= observed:
+            return
+        if balance < base:
+            # coins went out some other way, nothing to learn
+            return
+        sample = float(balance - base) / (now - observed)
+        rate = entry.get('rate')
+        if rate is None:
+            # a single sample says little, so plan for a wide spread
+            entry['rate'] = sample
+            entry['rate_var'] = sample * sample
+            return
+        # weight the sample by how much time it covers
+        a = 1 - math.exp(-(now - observed) / self.rate_horizon)
+        diff = sample - rate
+        entry['rate'] = rate + a * diff
+        entry['rate_var'] = (1 - a) * (entry.get('rate_var', 0.0) +
+                                       a * diff * diff)
+
+    def _plan(self, entry, sweep_address, now):
+        """When the balance next needs checking (None: every run)."""
+        if entry.get('rate') is None or \
+                entry['base'] > sweep_address.balance_threshold:
+            return None
+        fast = entry['rate'] + self.confidence * \
+               math.sqrt(entry.get('rate_var', 0.0))
+        wait = self.max_interval
+        if fast > 0:
+            short = sweep_address.balance_threshold + 1 - entry['base']
+            wait = min(wait, short / fast)
+        return now + wait
+
+    def balance_due(self, entry):
+        """
+        Return True if the balance of the address of journal ``entry``
+        should be checked now.
+
+        """
+        next_check = entry.get('next_check')
+        if next_check is None or time.time() >= next_check:
+            return True
+        return random.random() < self.sample_rate
+
+    def expected_balance(self, entry, now=None):
+        """
+        The balance the address of journal ``entry`` is expected to have
+        ``now``: the last one seen plus the inflow since, at the learned
+        rate.
+
+        """
+        now = now or time.time()
+        balance = entry.get('balance') or 0
+        if entry.get('rate') and entry.get('observed') is not None and \
+                entry.get('base') is not None:
+            balance = entry['base'] + entry['rate'] * \
+                      max(now - entry['observed'], 0)
+        return balance
+
+    def priority(self, sweep_address, now=None):
+        """
+        Where ``sweep_address`` goes in a run with a deadline or a call
+        budget, as a key to sort on (the highest first):
+        - 3: the journal says it needn't be looked at, which costs no
+          requests, so it is done first
+        - 2: it is expected to be over its threshold, the larger the
+          expected balance the sooner
+        - 1: the journal knows nothing about it, the larger the
+          threshold the sooner
+        - 0: it is expected to be below its threshold, the closer to
+          it the sooner
+
+        """
+        now = now or time.time()
+        entry = self.get(sweep_address)
+        threshold = sweep_address.balance_threshold
+        if entry is None:
+            return (1, threshold)
+        for key in ('next_change', 'pending_until', 'next_check'):
+            if entry.get(key) is not None and entry[key] > now:
+                return (3, 0)
+        expected = self.expected_balance(entry, now)
+        if expected > threshold:
+            return (2, expected)
+        return (0, float(expected) / (threshold or 1))
+
+    def deposit_seen(self, address):
+        """A deposit to ``address`` was seen, check its balance next time."""
+        with self.lock:
+            entry = self.entries.get(address)
+            if entry is not None and entry.get('next_check') is not None:
+                entry['next_check'] = None
+                self.changed.add(address)
+
+    def merge(self, entries):
+        """Take over ``entries`` (from another RunState, e.g. a worker)."""
+        with self.lock:
+            self.entries.update(entries)
+            self.changed.update(entries)
+
+    def changed_entries(self):
+        """Return the entries updated since this object was created."""
+        with self.lock:
+            return dict((a, dict(self.entries[a])) for a in self.changed
+                        if a in self.entries)
+
+    def save(self):
+        """
+        Write the journal, replacing the old one in a single step.
+
+        Only the entries changed through this object overwrite what is
+        in the file, so other processes (or hosts) sharing the journal
+        don't lose each other's updates.
+
+        """
+        if not self.file_:
+            return
+        with self.lock:
+            entries = {}
+            if os.path.exists(self.file_):
+                with open(self.file_) as sf:
+                    try:
+                        entries = json.loads(sf.read())
+                    except ValueError:
+                        entries = {}
+            # our own entries stay the same objects
+            entries.update((a, self.entries[a]) for a in self.changed
+                           if a in self.entries)
+            self.entries = entries
+            temp = "{0}.{1}.tmp".format(self.file_, os.getpid())
+            with open(temp, 'w') as sf:
+                sf.write(json.dumps(entries))
+            os.rename(temp, self.file_)
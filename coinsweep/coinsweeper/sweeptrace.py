@@ -0,0 +1,220 @@
+"""
+sweeptrace - trace spans of a sweep run
+
+With tracing started (start_tracing) the run is written down as spans,
+much like OpenTelemetry's: a span is a named piece of work with a start,
+a duration, attributes (the endpoint, bytes, cache hits, the decision
+reached...) and the span it is part of. A run has a "run" span, with a
+span per address in it, and in those the spans of the HTTP calls, JSON
+decoding, working out the amounts ("allocate") and the send.
+
+Each span is written as a line of JSON when it ends:
+{"trace": ..., "span": ..., "parent": ..., "name": ..., "start": ...,
+ "duration": ..., "thread": ..., "attributes": {...}}
+
+Only ``sample_rate`` of the addresses are traced (with everything in
+them), so a big run can be traced without writing millions of spans.
+
+With tracing off, span() returns a span that does nothing, and costs
+one function call.
+
+Addresses worked on in threads of their own (--concurrency) have no
+span open in their thread, so their spans go in the open run span.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import json
+import time
+import random
+import itertools
+import threading
+
+__all__ = ["span", "current", "start_tracing", "stop_tracing"]
+
+# spans written at a time
+BUFFER_SPANS = 200
+
+_tracer = None
+_local = threading.local()
+
+
+class _NoSpan(object):
+    """The span of work that isn't traced."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, name, count=1):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class _DroppedSpan(_NoSpan):
+    """A span left out by sampling: the spans in it are left out too."""
+
+    def __enter__(self):
+        _local.dropped = getattr(_local, 'dropped', 0) + 1
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        _local.dropped -= 1
+        return False
+
+
+class Span(object):
+    """One traced piece of work, see the module docstring."""
+
+    def __init__(self, tracer, name, attributes, root=False):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.root = root
+        self.trace_id = None
+        self.span_id = "{0:x}".format(next(tracer.ids))
+        self.parent = None
+        self.start = None
+
+    def __enter__(self):
+        stack = _stack()
+        parent = stack[-1] if stack else self.tracer.root
+        if parent is not None and not self.root:
+            self.parent = parent
+            self.trace_id = parent.trace_id
+        else:
+            self.trace_id = "{0:016x}".format(random.getrandbits(64))
+        if self.root:
+            self.tracer.root = self
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        duration = time.time() - self.start
+        _stack().pop()
+        if self.root:
+            self.tracer.root = None
+        if kind is not None:
+            self.attributes['error'] = repr(value)
+        self.tracer.write({'trace': self.trace_id,
+                           'span': self.span_id,
+                           'parent': self.parent and self.parent.span_id,
+                           'name': self.name,
+                           'start': self.start,
+                           'duration': duration,
+                           'thread': threading.current_thread().name,
+                           'attributes': self.attributes})
+        return False
+
+    def set(self, **attributes):
+        """Set attributes of the span."""
+        self.attributes.update(attributes)
+
+    def add(self, name, count=1):
+        """Add ``count`` to the attribute ``name`` (a counter)."""
+        self.attributes[name] = self.attributes.get(name, 0) + count
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class Tracer(object):
+    """Writes the spans of the process to a JSON lines file."""
+
+    def __init__(self, file_, sample_rate=1.0):
+        self.out = open(file_, 'a')
+        self.sample_rate = sample_rate
+        self.ids = itertools.count(1)
+        self.root = None
+        self.lock = threading.Lock()
+        self.lines = []
+
+    def span(self, name, attributes, sample=False, root=False):
+        if getattr(_local, 'dropped', 0):
+            return NO_SPAN
+        if sample and self.sample_rate < 1 and \
+                random.random() >= self.sample_rate:
+            return _DroppedSpan()
+        return Span(self, name, attributes, root)
+
+    def write(self, entry):
+        line = json.dumps(entry, default=str)
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) >= BUFFER_SPANS:
+                self._flush()
+
+    def _flush(self):
+        if self.lines:
+            self.out.write("\n".join(self.lines) + "\n")
+            self.lines = []
+        self.out.flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.out.close()
+
+
+def span(name, sample=False, root=False, **attributes):
+    """
+    A span for the work ``name``, with ``attributes``, to use in a with
+    statement. A span with ``sample`` set (an address) is only traced
+    for a ``sample_rate`` of them. A ``root`` span (the run) starts a
+    trace, and the spans opened in threads without a span of their own
+    go in it.
+
+    >>> with span("nothing", endpoint="x") as s:
+    ...     s.set(status="ok")
+    >>> s is NO_SPAN
+    True
+
+    """
+    tracer = _tracer
+    if tracer is None:
+        return NO_SPAN
+    return tracer.span(name, attributes, sample, root)
+
+
+def current():
+    """The innermost span open in this thread (NO_SPAN if none is)."""
+    if _tracer is None or getattr(_local, 'dropped', 0):
+        return NO_SPAN
+    stack = _stack()
+    return stack[-1] if stack else NO_SPAN
+
+
+def start_tracing(file_, sample_rate=1.0):
+    """
+    Write spans to ``file_`` (added to the end of it), tracing
+    ``sample_rate`` (0 to 1) of the addresses.
+
+    """
+    global _tracer
+    _tracer = Tracer(file_, sample_rate)
+
+
+def stop_tracing():
+    """Write the spans waiting and stop tracing."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.close()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
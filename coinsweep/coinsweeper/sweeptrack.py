@@ -0,0 +1,281 @@
+"""
+sweeptrack - defines ConfirmationTracker class
+
+ConfirmationTracker follows the sweeps sent until they confirm. Every
+transaction sent is added to it, and a background thread looks them up
+while the run goes on: a batch at a time through blockchain.info's
+multiaddr (one request for up to batch_size addresses), each
+transaction checked less and less often the longer it stays
+unconfirmed.
+
+What it finds goes back into the run-state journal (see RunState):
+- while a send is unconfirmed its address isn't checked again, its
+  coins are spent already
+- a send that disappeared (dropped from the mempool) is forgotten, so
+  the next run doesn't think it has to wait for the time threshold
+- the time sends take to confirm is learned per address, and the
+  first look at the next send is made about when it should confirm
+
+A send still unconfirmed stuck_after seconds after it went out is
+reported as stuck (and still followed).
+
+The tracked transactions are kept in a JSON file between runs, so the
+sends of one run are followed up by the next.
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import os
+import json
+import time
+import threading
+
+from sweepblockchain import _read_url
+
+__all__ = ["ConfirmationTracker"]
+
+MULTIADDR_URL = "https://blockchain.info/multiaddr?active={0}&n={1}"
+# transactions multiaddr returns at most
+MULTIADDR_LIMIT = 100
+# polls a transaction has to be missing from before it counts as dropped
+MISSING_POLLS = 3
+
+
+class ConfirmationTracker(object):
+    """
+    The sends being followed.
+
+    ``self.sends`` is a dictionary of tx_hash => dictionary of
+    - address: the address swept
+    - sent: seconds since the epoch it was sent
+    - status: "pending", "confirmed", "dropped" or "stuck"
+    - checks: how many times it has been looked up
+    - missing: looks in a row it wasn't found in
+    - next_poll: seconds since the epoch of its next look
+    - confirmed: seconds since the epoch it was seen confirmed
+    - block_height: the block it was confirmed in
+
+    """
+
+    def __init__(self, file_=None, state=None, stuck_after=3 * 3600,
+                 batch_size=50, min_interval=30, max_interval=1800):
+        """
+        Constructor
+        ``file_`` keeps the tracked sends between runs, ``state`` is the
+        RunState journal to feed (or None). A send unconfirmed for
+        ``stuck_after`` seconds is stuck. Up to ``batch_size`` addresses
+        are looked up per request, each transaction between
+        ``min_interval`` and ``max_interval`` seconds apart.
+
+        """
+        self.file_ = file_
+        self.state = state
+        self.stuck_after = stuck_after
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.sends = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.verbose = False
+        if file_ and os.path.exists(file_):
+            with open(file_) as tf:
+                try:
+                    self.sends = json.loads(tf.read())
+                except ValueError:
+                    self.sends = {}
+        # whatever finished last run has been reported already
+        for tx_hash in [h for h, s in self.sends.iteritems()
+                        if s['status'] in ("confirmed", "dropped")]:
+            del self.sends[tx_hash]
+
+    def _edit(self, address, change):
+        """Change the journal entry of ``address``, see RunState.edit."""
+        if self.state is None:
+            return None
+        return self.state.edit(address, change)
+
+    def add(self, address, tx_hash):
+        """Follow the send ``tx_hash`` from ``address``."""
+        now = time.time()
+        first = self.min_interval
+
+        def pending(entry):
+            entry['pending_tx'] = tx_hash
+            entry['pending_until'] = now + self.stuck_after
+
+        entry = self._edit(address, pending)
+        # look first about when the address' sends usually confirm
+        if entry is not None and entry.get('confirm_latency'):
+            first = max(first, entry['confirm_latency'] / 2)
+        with self.lock:
+            self.sends[tx_hash] = {'address': address,
+                                   'sent': now,
+                                   'status': "pending",
+                                   'checks': 0,
+                                   'missing': 0,
+                                   'next_poll': now + first,
+                                   'confirmed': None,
+                                   'block_height': None}
+
+    def start(self, verbose=False):
+        """Start following the sends in a background thread."""
+        self.verbose = verbose
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread and save the tracked sends."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.save()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.poll()
+            self.stopping.wait(self._wait())
+
+    def _wait(self):
+        """Seconds until the next look is due."""
+        with self.lock:
+            polls = [s['next_poll'] for s in self.sends.itervalues()
+                     if s['status'] in ("pending", "stuck")]
+        if not polls:
+            return self.min_interval
+        return min(max(min(polls) - time.time(), 1), self.max_interval)
+
+    def _due(self, now):
+        """The addresses with sends due a look, in batches."""
+        with self.lock:
+            addresses = sorted(set(s['address'] for s in self.sends.itervalues()
+                                   if s['status'] in ("pending", "stuck") and
+                                   s['next_poll'] <= now))
+        return [addresses[i:i + self.batch_size]
+                for i in range(0, len(addresses), self.batch_size)]
+
+    def poll(self, now=None):
+        """
+        Look up the sends that are due a look, a batch of addresses per
+        request.
+
+        The return is a tuple: (changed, errors), where
+        changed is a list of the tx hashes whose status changed.
+
+        """
+        changed = []
+        errors = {}
+        for batch in self._due(now or time.time()):
+            url = MULTIADDR_URL.format("|".join(batch), MULTIADDR_LIMIT)
+            content, e = _read_url(url, None, self.verbose)
+            if not e:
+                try:
+                    changed.extend(self._update(set(batch),
+                                                json.loads(content)))
+                except (ValueError, KeyError, TypeError) as ex:
+                    e = {url: "Bad multiaddr response - {0}".format(ex)}
+            if e:
+                errors.update(e)
+                # try again later, like an unconfirmed transaction
+                with self.lock:
+                    for send in self.sends.itervalues():
+                        if send['address'] in batch:
+                            self._reschedule(send, time.time())
+        return (changed, errors)
+
+    def _reschedule(self, send, now):
+        send['checks'] += 1
+        wait = self.min_interval * 2 ** min(send['checks'], 16)
+        send['next_poll'] = now + min(wait, self.max_interval)
+
+    def _update(self, batch, data):
+        """Apply a multiaddr response for the addresses ``batch``."""
+        now = time.time()
+        found = dict((tx['hash'], tx) for tx in data.get('txs', []))
+        complete = len(data.get('txs', [])) < MULTIADDR_LIMIT
+        changed = []
+        with self.lock:
+            for tx_hash, send in self.sends.iteritems():
+                if send['address'] not in batch or \
+                        send['status'] not in ("pending", "stuck"):
+                    continue
+                tx = found.get(tx_hash)
+                if tx is not None and tx.get('block_height'):
+                    send['status'] = "confirmed"
+                    send['confirmed'] = now
+                    send['block_height'] = tx['block_height']
+                    changed.append(tx_hash)
+                    self._confirmed(send, tx_hash)
+                    continue
+                if tx is None and complete:
+                    send['missing'] += 1
+                    if send['missing'] >= MISSING_POLLS:
+                        send['status'] = "dropped"
+                        changed.append(tx_hash)
+                        self._dropped(send, tx_hash)
+                        continue
+                elif tx is not None:
+                    send['missing'] = 0
+                if send['status'] == "pending" and \
+                        now - send['sent'] > self.stuck_after:
+                    send['status'] = "stuck"
+                    changed.append(tx_hash)
+                self._reschedule(send, now)
+        return changed
+
+    def _confirmed(self, send, tx_hash):
+        if self.verbose:
+            print "Confirmed: {0} in block {1}".format(tx_hash,
+                                                      send['block_height'])
+        latency = send['confirmed'] - send['sent']
+
+        def confirmed(entry):
+            old = entry.get('confirm_latency')
+            entry['confirm_latency'] = latency if old is None \
+                                       else old + 0.3 * (latency - old)
+            if entry.get('pending_tx') == tx_hash:
+                entry['pending_tx'] = None
+                entry['pending_until'] = None
+
+        self._edit(send['address'], confirmed)
+
+    def _dropped(self, send, tx_hash):
+        if self.verbose:
+            print "Dropped: {0}".format(tx_hash)
+
+        def dropped(entry):
+            # the send never happened, so nothing to wait for: the next
+            # run looks at the address (and its history) afresh
+            for key in ('pending_tx', 'pending_until', 'last_send',
+                        'next_change', 'next_check', 'decision'):
+                entry[key] = None
+
+        self._edit(send['address'], dropped)
+
+    def report(self):
+        """
+        The tracked sends by status, as a dictionary of status => list
+        of (tx_hash, send dictionary).
+
+        """
+        r = {}
+        with self.lock:
+            for tx_hash, send in sorted(self.sends.iteritems()):
+                r.setdefault(send['status'], []).append((tx_hash,
+                                                         dict(send)))
+        return r
+
+    def save(self):
+        """Write the tracked sends, replacing the old file in one step."""
+        if not self.file_:
+            return
+        with self.lock:
+            contents = json.dumps(self.sends)
+        temp = "{0}.{1}.tmp".format(self.file_, os.getpid())
+        with open(temp, 'w') as tf:
+            tf.write(contents)
+        os.rename(temp, self.file_)
@@ -0,0 +1,283 @@
+"""
+sweeptx - builds, signs and broadcasts sweep transactions locally
+
+With a LocalTxEngine the private key of a watched address never leaves
+this machine: the sweep transaction is built from the address's
+unspent outputs, every input is signed here (see sweepsign) and only
+the signed transaction is sent out, to the pushtx API.
+
+Only P2PKH watched addresses can be signed for (the key's address,
+compressed or not, must be the watched address); the destinations can
+be P2PKH or P2SH addresses.
+
+Signing uses the legacy SIGHASH_ALL digest, which hashes the whole
+transaction once per input. The part before each input is hashed only
+once for all of them, but the rest still makes it quadratic in the
+number of inputs, which is one more reason standard transactions are
+limited to 100kB (about 680 inputs).
+
+:author:     Ron Helwig
+:contact:    ron@ronhelwig.com
+"""
+
+import struct
+import hashlib
+import binascii
+
+from sweepkeys import decode_wif, address_from_pubkey, script_for_address
+from sweepsign import public_key, sign_many, der_encode
+from sweepblockchain import _read_url
+
+__all__ = ["LocalTxEngine", "key_for_address", "sign_transaction",
+           "transaction_id"]
+
+SIGHASH_ALL = 1
+# transaction version, lock time and input sequence
+VERSION = 1
+LOCK_TIME = 0
+SEQUENCE = 0xFFFFFFFF
+
+
+def _varint(n):
+    if n < 0xFD:
+        return chr(n)
+    if n <= 0xFFFF:
+        return "\xfd" + struct.pack("<H", n)
+    if n <= 0xFFFFFFFF:
+        return "\xfe" + struct.pack("<L", n)
+    return "\xff" + struct.pack("<Q", n)
+
+
+def _push(data):
+    """A script push of ``data`` (shorter than 76 bytes)."""
+    return chr(len(data)) + data
+
+
+def _outpoint(utxo):
+    """The serialized outpoint of a blockchain.info style unspent output."""
+    if 'tx_hash_big_endian' in utxo:
+        tx_hash = binascii.unhexlify(utxo['tx_hash_big_endian'])[::-1]
+    else:
+        # blockchain.info's tx_hash is already in serialized order
+        tx_hash = binascii.unhexlify(utxo['tx_hash'])
+    return tx_hash + struct.pack("<L", utxo['tx_output_n'])
+
+
+def key_for_address(private_key, address):
+    """
+    Decode ``private_key`` (WIF or hex) and check it belongs to
+    ``address``.
+
+    The return is a tuple: (secret, pubkey)
+    Raises ValueError if the key is invalid or for another address.
+
+    >>> secret, pubkey = key_for_address(
+    ...     "5HpHagT65TZzG1PH3CSu63k8DbpvD8s5ip4nEB3kEsreAnchuDf",
+    ...     "1EHNa6Q4Jz2uvNExL497mE43ikXhwF6kZm")
+    >>> secret
+    1L
+    >>> key_for_address("KwDiBf89QgGbjEhKnhXJuH7LrciVrZi3qYjgd9M7rFU73sVHnoWn",
+    ...                 "1EHNa6Q4Jz2uvNExL497mE43ikXhwF6kZm")
+    Traceback (most recent call last):
+    ...
+    ValueError: Private key is not the key of 1EHNa6Q4Jz2uvNExL497mE43ikXhwF6kZm
+
+    """
+    secret, compressed = decode_wif(private_key)
+    candidates = [compressed]
+    if len(private_key.strip()) == 64:
+        # a hex key doesn't say which form its address uses
+        candidates.append(not compressed)
+    for c in candidates:
+        pubkey = public_key(secret, c)
+        if address_from_pubkey(pubkey) == address:
+            return (secret, pubkey)
+    raise ValueError("Private key is not the key of {0}".format(address))
+
+
+def _serialize(inputs, script_sigs, outputs):
+    parts = [struct.pack("<l", VERSION), _varint(len(inputs))]
+    sequence = struct.pack("<L", SEQUENCE)
+    for outpoint, script_sig in zip(inputs, script_sigs):
+        parts.append(outpoint + _varint(len(script_sig)) + script_sig +
+                     sequence)
+    parts.append(outputs)
+    parts.append(struct.pack("<L", LOCK_TIME))
+    return "".join(parts)
+
+
+def _serialize_outputs(outputs):
+    """``outputs`` is a list of (address, satoshis)."""
+    parts = [_varint(len(outputs))]
+    for address, value in outputs:
+        script = script_for_address(address)
+        parts.append(struct.pack("<Q", value) + _varint(len(script)) + script)
+    return "".join(parts)
+
+
+def sign_transaction(unspent, outputs, secret, pubkey):
+    """
+    Build a transaction spending all of ``unspent`` (blockchain.info
+    style unspent outputs of the P2PKH address of ``pubkey``) to
+    ``outputs`` (a list of (address, satoshis)), signed with the long
+    ``secret``.
+
+    Returns the raw transaction (a string of bytes).
+
+    >>> secret, pubkey = key_for_address(
+    ...     "KwDiBf89QgGbjEhKnhXJuH7LrciVrZi3qYjgd9M7rFU73sVHnoWn",
+    ...     "1BgGZ9tcN4rm9KBzDn7KprQz87SZ26SAMH")
+    >>> utxo = {'tx_hash_big_endian': "ab" * 32, 'tx_output_n': 0,
+    ...         'value': 50000}
+    >>> raw = sign_transaction([utxo], [("3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy",
+    ...                                  40000)], secret, pubkey)
+    >>> len(raw), transaction_id(raw) == transaction_id(raw)
+    (189, True)
+    >>> _check_signatures(raw, [utxo], pubkey)
+    True
+
+    """
+    inputs = [_outpoint(u) for u in unspent]
+    output_data = _serialize_outputs(outputs)
+    sequence = struct.pack("<L", SEQUENCE)
+    prev_script = script_for_address(address_from_pubkey(pubkey))
+    # each input's part of the signature hash: its own has the script
+    # of the output it spends, the others have empty scripts
+    empty = [outpoint + "\x00" + sequence for outpoint in inputs]
+    tail = output_data + struct.pack("<L", LOCK_TIME) + \
+           struct.pack("<L", SIGHASH_ALL)
+    head = hashlib.sha256(struct.pack("<l", VERSION) + _varint(len(inputs)))
+    digests = []
+    for i, outpoint in enumerate(inputs):
+        h = head.copy()
+        h.update(outpoint + _varint(len(prev_script)) + prev_script +
+                 sequence)
+        h.update("".join(empty[i + 1:]))
+        h.update(tail)
+        digests.append(hashlib.sha256(h.digest()).digest())
+        head.update(empty[i])
+
+    script_sigs = [_push(der_encode(sig) + chr(SIGHASH_ALL)) + _push(pubkey)
+                   for sig in sign_many(secret, digests)]
+    return _serialize(inputs, script_sigs, output_data)
+
+
+def _check_signatures(raw, unspent, pubkey):
+    """Check every input signature of ``raw`` (slow, for tests)."""
+    from sweepsign import verify, der_decode
+    count = len(unspent)
+    at = 4 + len(_varint(count))
+    script_sigs = []
+    for i in range(count):
+        at += 36
+        length = ord(raw[at])
+        script_sigs.append(raw[at + 1:at + 1 + length])
+        at += 1 + length + 4
+    outputs = raw[at:-4]
+    prev_script = script_for_address(address_from_pubkey(pubkey))
+    inputs = [_outpoint(u) for u in unspent]
+    for i, script_sig in enumerate(script_sigs):
+        der = script_sig[1:1 + ord(script_sig[0])][:-1]
+        blank = ["" for _ in inputs]
+        blank[i] = prev_script
+        preimage = _serialize(inputs, blank, outputs) + \
+                   struct.pack("<L", SIGHASH_ALL)
+        digest = hashlib.sha256(hashlib.sha256(preimage).digest()).digest()
+        if not verify(pubkey, digest, der_decode(der)):
+            return False
+    return True
+
+
+def transaction_id(raw):
+    """The transaction id (hash, as shown by explorers) of ``raw``."""
+    return binascii.hexlify(
+                hashlib.sha256(hashlib.sha256(raw).digest()).digest()[::-1])
+
+
+class LocalTxEngine(object):
+    """
+    Signs sweeps here and broadcasts only the signed transaction.
+
+    """
+
+    def __init__(self, pushtx_url="https://blockchain.info/pushtx"):
+        """
+        Constructor
+        ``pushtx_url`` is where the raw transaction is POSTed (as tx=).
+
+        """
+        self.pushtx_url = pushtx_url
+
+    def build(self, address_info, unspent, amounts, fees, verbose=False):
+        """
+        Build and sign the sweep of ``address_info`` (a SweepAddressInfo)
+        paying ``amounts`` (destination => satoshis) from ``unspent``,
+        the confirmed outputs the balance was worked out from.
+
+        The return is a tuple: (raw, errors), where
+        raw is the signed transaction as hex.
+
+        """
+        address = address_info.address
+        try:
+            secret, pubkey = key_for_address(address_info.private_key,
+                                             address)
+        except ValueError as e:
+            return (None, {address: str(e)})
+        spend = unspent or []
+        if not spend:
+            return (None, {address: "No confirmed unspent outputs"})
+        # outputs of nothing are just dust
+        outputs = sorted((dest, long(value))
+                         for dest, value in amounts.iteritems() if value > 0)
+        paid = sum(value for dest, value in outputs)
+        total = sum(long(u['value']) for u in spend)
+        # splitting the balance can leave a satoshi or so over
+        if total - paid < 0 or total - paid > fees + len(amounts):
+            return (None, {address: "Error: unspent outputs ({0}) don't "
+                                    "match the amounts ({1}) and fees "
+                                    "({2})".format(total, paid, fees)})
+        try:
+            raw = sign_transaction(spend, outputs, secret, pubkey)
+        except (ValueError, KeyError) as e:
+            return (None, {address: "Error: can't build transaction - "
+                                    "{0}".format(e)})
+        if verbose:
+            print "Signed {0} inputs, {1} bytes".format(len(spend), len(raw))
+        return (binascii.hexlify(raw), {})
+
+    def transaction_id(self, raw):
+        """The transaction id of the signed transaction ``raw`` (hex)."""
+        return transaction_id(binascii.unhexlify(raw))
+
+    def send(self, address_info, unspent, amounts, fees, verbose=False):
+        """
+        Build, sign and broadcast the sweep.
+
+        The return is a tuple: (tx_hash, errors)
+
+        """
+        raw, errors = self.build(address_info, unspent, amounts, fees,
+                                 verbose)
+        if errors:
+            return ("", errors)
+        return self.broadcast(raw, verbose)
+
+    def broadcast(self, raw, verbose=False):
+        """
+        Broadcast the signed transaction ``raw`` (hex).
+
+        The return is a tuple: (tx_hash, errors)
+
+        """
+        response, errors = _read_url(self.pushtx_url, {'tx': raw}, verbose)
+        if errors:
+            return ("", errors)
+        if verbose:
+            print "Broadcast response: {0}".format(response)
+        return (self.transaction_id(raw), errors)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()